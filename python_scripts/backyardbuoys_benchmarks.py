@@ -0,0 +1,1039 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+BackyardBuoys ERDDAP - Benchmarks
+=================================
+
+This module contains timing benchmarks for the performance-sensitive parts
+of the BackyardBuoys ERDDAP pipeline. The benchmarks run on synthetic data
+shaped like the Backyard Buoys API responses, so they do not need network
+access or any of the configuration files.
+
+Key Functions:
+    - make_synthetic_api_data() : Build a synthetic API variable dictionary
+    - bench_observation_pivot() : Time the long-to-wide observation pivot
+    - bench_columnar_decode() : Time and memory of API response decoding
+    - bench_startup_imports() : Start-up import time of each CLI process
+    - make_synthetic_qc_data() : Build a synthetic dataframe for the QC tests
+    - bench_qartod_engine() : Timing of the native QARTOD engine
+    - bench_qartod_time() : Cost of building the QARTOD time axis
+    - bench_incremental_qc() : Parity and timing of incremental QC reruns
+    - bench_flag_packing() : Parity and timing of QARTOD flag packing
+    - bench_netcdf_encoding() : File size and write/read time of each netCDF encoding profile
+    - bench_time_encoding() : Cost of encoding the netCDF times as epoch seconds
+    - bench_history_load() : Time and peak memory of loading a year of netCDF files
+
+Example Usage:
+    # Run all of the benchmarks
+    python backyardbuoys_benchmarks.py
+
+    # Run a single benchmark
+    python backyardbuoys_benchmarks.py pivot
+
+Organization: Backyard Buoys
+"""
+
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import tempfile
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import backyardbuoys_dataaccess as bb_da
+import backyardbuoys_processdata as bb_process
+import backyardbuoys_qualitycontrol as bb_qc
+import backyardbuoys_qcflags as bb_flags
+
+
+SURFACE_VARS = ['WaveHeightSig', 'WavePeriodMean', 'WaveDirMean',
+                'WaveDirMeanSpread', 'WavePeriodPeak', 'WaveDirPeak',
+                'WaveDirPeakSpread', 'WaterTemp']
+
+
+def make_synthetic_api_data(nrows, seed=0, platforms=('SPOT-00001', 'SPOT-00002'),
+                            smartflag=True, time_step=1800):
+    """
+    Build a synthetic Backyard Buoys API variable dictionary.
+
+    Parameters
+    ----------
+    nrows : int
+        Approximate total number of records, summed over all variables
+    seed : int, optional
+        Seed for the random number generator
+    platforms : tuple of str, optional
+        Platform IDs to cycle through over the record
+    smartflag : bool, optional
+        If True, add subsurface (smart mooring) water temperature records
+    time_step : int, optional
+        Time between observations, in seconds
+
+    Returns
+    -------
+    dict
+        Dictionary in the format returned by
+        backyardbuoys_dataaccess.bbapi_get_location_data
+    """
+
+    rng = np.random.default_rng(seed)
+    nvars = len(SURFACE_VARS) + (1 if smartflag else 0)
+    ntimes = max(nrows // nvars, 1)
+    t0 = 1704067200
+
+    api_data = {}
+    for ii, varname in enumerate(SURFACE_VARS):
+        # Randomly drop a few percent of the records of each
+        # variable, so that the variables do not align exactly
+        keep = rng.random(ntimes) > 0.03*(ii > 0)
+        timestamps = t0 + time_step*np.flatnonzero(keep)
+        npts = len(timestamps)
+        plats = np.array(platforms)[(timestamps - t0) // (30*86400) % len(platforms)]
+        var_data = {'timestamp': timestamps.tolist(),
+                    'value': rng.random(npts).tolist(),
+                    'lat': (47.9 + 0.01*rng.random(npts)).tolist(),
+                    'lon': (-124.6 + 0.01*rng.random(npts)).tolist(),
+                    'depth': [0.0]*npts,
+                    'platform_id': plats.tolist(),
+                    'type': ['spotter']*npts}
+
+        if smartflag and (varname == 'WaterTemp'):
+            smart_times = t0 + time_step*np.arange(ntimes)
+            nsmart = len(smart_times)
+            smart_data = {'timestamp': smart_times.tolist(),
+                          'value': rng.random(nsmart).tolist(),
+                          'lat': [47.9]*nsmart,
+                          'lon': [-124.6]*nsmart,
+                          'depth': [-5.0]*nsmart,
+                          'platform_id': [platforms[0]]*nsmart,
+                          'type': ['smart_mooring']*nsmart}
+            for key in var_data.keys():
+                var_data[key] = var_data[key] + smart_data[key]
+
+        api_data[varname] = {'units': '', 'data': var_data}
+
+    return api_data
+
+
+def make_synthetic_api_payload(api_data):
+    """
+    Convert a synthetic API variable dictionary into the raw JSON
+    payload returned by the Backyard Buoys data API.
+
+    Parameters
+    ----------
+    api_data : dict
+        Dictionary from make_synthetic_api_data
+
+    Returns
+    -------
+    bytes
+        JSON response body
+    """
+
+    variables = []
+    for varname in api_data.keys():
+        var_data = api_data[varname]['data']
+        fields = list(var_data.keys())
+        entries = [dict(zip(fields, values))
+                   for values in zip(*[var_data[field] for field in fields])]
+        variables.append({'var_id': varname,
+                          'units': api_data[varname]['units'],
+                          'data': entries})
+
+    return json.dumps({'variables': variables}).encode()
+
+
+def _time_call(func, repeat=3, clock=time.perf_counter):
+
+    # Return the best time (in seconds) of several calls
+    best = np.inf
+    for _ in range(repeat):
+        start = clock()
+        func()
+        best = min(best, clock() - start)
+    return best
+
+
+# In[ ]:
+
+
+def _merge_variable_by_key(tot_dat, test_dat, varname, key_cols=('pt_id', 'platform_id')):
+
+    # Reference implementation of the keyed merge used by the
+    # previous dataframe build, to append each new variable
+    # to the total dataframe.
+    #
+    # Rows are matched on the key columns (point ID and platform ID)
+    # through a hash index of the existing data, rather than by
+    # scanning the full total dataframe for every incoming row, so
+    # the merge is linear in the number of rows.
+
+    if test_dat is None:
+        return tot_dat
+    elif (tot_dat is None) and (test_dat is not None):
+        # Return the test data as the initial dataset
+        return test_dat.copy()
+
+    if len(test_dat) == 1:
+        tot_dat.loc[0,varname] = test_dat.loc[0,varname]
+        return tot_dat
+    elif len(test_dat) == 0:
+        return tot_dat
+
+    # Build a hash index of the existing data keys. Only the first
+    # occurrence of each key is indexed, so that a new data point is
+    # always matched to the first matching row of the existing data
+    key_cols = list(key_cols)
+    base_keys = pd.MultiIndex.from_frame(tot_dat[key_cols])
+    first_inds = ~base_keys.duplicated(keep='first')
+    base_rows = np.flatnonzero(first_inds)
+
+    # Look up every new data point in the index in a single pass
+    # (-1 indicates that no match was found)
+    lookup = base_keys[first_inds].get_indexer(pd.MultiIndex.from_frame(test_dat[key_cols]))
+    matched = lookup >= 0
+
+    basematchinds = base_rows[lookup[matched]]  # Indices in the existing total_data
+    matchinds = np.flatnonzero(matched)         # Indices in the new test_dat
+    nonmatchinds = np.flatnonzero(~matched)     # Indices in test_dat that don't match total_data
+
+    # Handle data merging based on matching results
+    if len(matchinds) == len(tot_dat):
+        # Perfect match - all timestamps align, just add the variable column
+        tot_dat.loc[basematchinds,varname] = test_dat[varname].to_numpy()[matchinds]
+    else:
+        # Partial or no match - need to merge carefully
+
+        # First, add matching data points to their correct locations
+        if len(matchinds) > 0:
+            tot_dat.loc[basematchinds,varname] = test_dat[varname].to_numpy()[matchinds]
+
+        # Then append non-matching data as new rows
+        # Fill missing columns with NaNs
+        if len(nonmatchinds) > 0:
+            # Create the variable column if it doesn't exist yet
+            if varname not in tot_dat.columns:
+                print('   ...Variable does not yet exist: ', varname)
+                tot_dat.loc[:,varname] = np.nan*np.ones(len(tot_dat))
+            # Concatenate the non-matching rows
+            tot_dat = pd.concat([tot_dat,
+                                 test_dat.iloc[nonmatchinds,:]]).reset_index(drop=True)
+            print('   ...Some mismatched for ' + varname + ': ' + str(len(nonmatchinds)) + ' points')
+
+    return tot_dat
+
+
+def _fold_observations_by_variable(api_data):
+
+    # Reference implementation of the previous dataframe build,
+    # which stringified a point ID for every record, and then
+    # folded each variable into the dataframes one at a time
+
+    total_data = None
+    smart_data = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for varname in api_data.keys():
+            var_df = pd.DataFrame(data=api_data[varname]['data']).rename(columns={'value': varname})
+            var_df['pt_id'] = [str(var_df['timestamp'][ii])
+                               for ii in range(0, len(var_df))]
+            surface_df = var_df[var_df['depth'] == 0].reset_index(drop=True)
+            smart_df = var_df[var_df['depth'] != 0].reset_index(drop=True)
+            if len(surface_df) > 0:
+                total_data = _merge_variable_by_key(total_data, surface_df, varname)
+            if len(smart_df) > 0:
+                smart_data = _merge_variable_by_key(smart_data, smart_df, varname)
+
+    total_data['time'] = pd.to_datetime(total_data.timestamp, unit='s', errors='coerce')
+    if smart_data is not None:
+        smart_data['time'] = pd.to_datetime(smart_data.timestamp, unit='s', errors='coerce')
+
+    return total_data, smart_data
+
+
+def bench_observation_pivot(sizes=(10_000, 100_000, 1_000_000), repeat=3):
+    """
+    Time the observation pivot used by get_data_by_location and
+    get_data_by_platform against the previous per-variable fold.
+
+    Parameters
+    ----------
+    sizes : tuple of int, optional
+        Total number of API records to pivot for each benchmark
+    repeat : int, optional
+        Number of timed calls; the best time is reported
+
+    Returns
+    -------
+    pandas.DataFrame
+        Timing results, one row per size
+    """
+
+    results = []
+    for nrows in sizes:
+        api_data = make_synthetic_api_data(nrows)
+
+        # Check that both approaches place the same values
+        new_total, new_smart = bb_process.pivot_observations(api_data)
+        old_total, old_smart = _fold_observations_by_variable(api_data)
+        for new_df, old_df in [(new_total, old_total), (new_smart, old_smart)]:
+            old_df = old_df.drop(columns='pt_id')
+            pd.testing.assert_frame_equal(new_df, old_df, check_dtype=False)
+
+        old_time = _time_call(lambda: _fold_observations_by_variable(api_data), repeat)
+        new_time = _time_call(lambda: bb_process.pivot_observations(api_data), repeat)
+        results.append({'records': nrows,
+                        'observations': len(new_total),
+                        'fold_s': old_time,
+                        'pivot_s': new_time,
+                        'speedup': old_time/new_time})
+        print('   {:>9,d} records: fold {:8.3f} s, pivot {:8.3f} s ({:.1f}x)'.format(
+              nrows, old_time, new_time, old_time/new_time))
+
+    return pd.DataFrame(results)
+
+
+# In[ ]:
+
+
+def _decode_records_by_variable(content):
+
+    # Reference implementation of the previous response decoding,
+    # which parsed the response with the standard json module, and
+    # restructured each variable's records into lists of values
+
+    lines = json.loads(content)
+    var_data = {}
+    for line in lines['variables']:
+        var_name = line['var_id']
+        var_data[var_name] = {}
+        var_data[var_name]['units'] = line['units']
+        extract_data = {}
+        for item in line['data'][0]:
+            extract_data[item] = []
+        for entry in line['data']:
+            for item in entry:
+                extract_data[item].append(entry[item])
+        var_data[var_name]['data'] = extract_data
+
+    return var_data
+
+
+def _memory_call(func):
+
+    # Return the memory (in MB) retained by the result of
+    # a call, and the peak memory allocated during the call
+    tracemalloc.start()
+    result = func()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained/1e6, peak/1e6
+
+
+def bench_columnar_decode(ndays=365, time_step=1800, repeat=3):
+    """
+    Time the columnar decoding of a Backyard Buoys API response, from the
+    raw JSON body through to the surface and smart mooring dataframes,
+    against the previous list-based decoding.
+
+    Parameters
+    ----------
+    ndays : int, optional
+        Length of the synthetic record, in days
+    time_step : int, optional
+        Time between observations, in seconds
+    repeat : int, optional
+        Number of timed calls; the best CPU time is reported
+
+    Returns
+    -------
+    pandas.DataFrame
+        CPU time and memory use for each decoder
+    """
+
+    nvars = len(SURFACE_VARS) + 1
+    api_data = make_synthetic_api_data(nvars*ndays*86400//time_step, time_step=time_step)
+    content = make_synthetic_api_payload(api_data)
+    print('   Payload: {:,d} records, {:.1f} MB of JSON ({})'.format(
+          sum([len(api_data[var]['data']['timestamp']) for var in api_data]),
+          len(content)/1e6, 'orjson' if bb_da.orjson is not None else 'json'))
+
+    decoders = {'list': _decode_records_by_variable,
+                'columnar': lambda body: bb_da._decode_bbapi_variables(
+                                             bb_da._parse_json_response(body))}
+
+    # Check that both decoders produce the same dataframes
+    list_frames = bb_process.pivot_observations(decoders['list'](content))
+    columnar_frames = bb_process.pivot_observations(decoders['columnar'](content))
+    for list_df, columnar_df in zip(list_frames, columnar_frames):
+        pd.testing.assert_frame_equal(list_df, columnar_df, check_dtype=False)
+
+    results = []
+    for name, decoder in decoders.items():
+        decode_time = _time_call(lambda: decoder(content), repeat, clock=time.process_time)
+        frames_time = _time_call(lambda: bb_process.pivot_observations(decoder(content)),
+                                 repeat, clock=time.process_time)
+        decode_retained, decode_peak = _memory_call(lambda: decoder(content))
+        results.append({'decoder': name,
+                        'decode_cpu_s': decode_time,
+                        'decode_retained_mb': decode_retained,
+                        'decode_peak_mb': decode_peak,
+                        'to_frames_cpu_s': frames_time})
+        print('   {:>8s}: decode {:6.3f} s CPU, {:6.1f} MB retained, {:6.1f} MB peak; '
+              'to dataframes {:6.3f} s CPU'.format(
+              name, decode_time, decode_retained, decode_peak, frames_time))
+
+    return pd.DataFrame(results)
+
+
+# In[ ]:
+
+
+# Heavy third-party modules imported on the code path of each
+# backyardbuoys_main.py process, on top of the main module itself
+PROCESS_IMPORTS = {'addDataset': [],
+                   'addMetadata': ['google.auth.transport.requests', 'google.oauth2.credentials',
+                                   'google_auth_oauthlib.flow', 'googleapiclient.discovery'],
+                   'addData': ['xarray', 'netCDF4', 'ioos_qc.config',
+                               'ioos_qc.streams', 'ioos_qc.stores']}
+
+# Modules that were previously imported by every process
+EAGER_IMPORTS = (['matplotlib.pyplot'] + PROCESS_IMPORTS['addMetadata'] +
+                 PROCESS_IMPORTS['addData'])
+
+
+def _import_time(modules, repeat=3):
+
+    # Return the best total import time (in seconds) of a fresh
+    # interpreter importing the modules, from "python -X importtime"
+    code = '; '.join(['import ' + module for module in modules]) or 'pass'
+    scriptdir = os.path.dirname(os.path.abspath(__file__))
+    best = np.inf
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                              cwd=scriptdir, capture_output=True, text=True, check=True)
+        total_us = 0
+        for line in proc.stderr.splitlines():
+            # Only count the top-level imports (those not indented),
+            # as their cumulative times include their own imports
+            fields = line.split('|')
+            if (not(line.startswith('import time:')) or (len(fields) != 3) or
+                fields[2].startswith('  ') or not(fields[1].strip().isdigit())):
+                continue
+            total_us += int(fields[1])
+        best = min(best, total_us/1e6)
+    return best
+
+
+def bench_startup_imports(repeat=5):
+    """
+    Time the module imports of each backyardbuoys_main.py process type,
+    with the heavy dependencies (Google API client, xarray, netCDF4,
+    ioos_qc) imported on the code paths that use them, against the
+    previous start-up, which imported all of them (and matplotlib)
+    for every process.
+
+    Parameters
+    ----------
+    repeat : int, optional
+        Number of fresh interpreters timed; the best time is reported
+
+    Returns
+    -------
+    pandas.DataFrame
+        Import times for each process type
+    """
+
+    # Skip any optional modules that are not installed here
+    def installed(modules):
+        return [module for module in modules
+                if importlib.util.find_spec(module.split('.')[0]) is not None]
+
+    interpreter_time = _import_time([], repeat)
+    eager_time = _import_time(['backyardbuoys_main'] + installed(EAGER_IMPORTS), repeat) - interpreter_time
+
+    results = []
+    for process_name, modules in PROCESS_IMPORTS.items():
+        lazy_time = _import_time(['backyardbuoys_main'] + installed(modules), repeat) - interpreter_time
+        results.append({'process': process_name,
+                        'eager_s': eager_time,
+                        'lazy_s': lazy_time,
+                        'speedup': eager_time/lazy_time})
+        print('   {:>11s}: all imports {:6.3f} s, imports on use {:6.3f} s ({:.1f}x)'.format(
+              process_name, eager_time, lazy_time, eager_time/lazy_time))
+
+    return pd.DataFrame(results)
+
+
+# In[ ]:
+
+
+QC_SENSORS = ['sea_surface_wave_significant_height',
+              'sea_surface_wave_period_at_variance_spectral_density_maximum',
+              'sea_surface_wave_from_direction_at_variance_spectral_density_maximum',
+              'sea_surface_wave_directional_spread_at_variance_spectral_density_maximum',
+              'sea_surface_wave_mean_period',
+              'sea_surface_wave_from_direction',
+              'sea_surface_wave_directional_spread',
+              'sea_surface_wave_frequency_at_variance_spectral_density_maximum',
+              'sea_surface_wave_mean_frequency',
+              'sea_water_temperature']
+
+
+def make_synthetic_qc_data(ndays=365, time_step=1800, seed=0):
+    """
+    Build a synthetic dataframe of surface wave data, in the form passed
+    to backyardbuoys_qualitycontrol.process_qartod_tests.
+
+    The data include gaps, missing values, flat-lined stretches, spikes,
+    wrapped directions, and a few repeated time stamps, so that every
+    branch of the QARTOD tests is exercised.
+
+    Parameters
+    ----------
+    ndays : int, optional
+        Length of the synthetic record, in days
+    time_step : int, optional
+        Time between observations, in seconds
+    seed : int, optional
+        Seed for the random number generator
+
+    Returns
+    -------
+    tuple of (pandas.DataFrame, dict)
+        The data, and QC limits for each sensor
+    """
+
+    rng = np.random.default_rng(seed)
+    ntimes = ndays*86400//time_step
+
+    # Time axis with gaps, and a few repeated time stamps
+    steps = np.full(ntimes, time_step)
+    steps[rng.random(ntimes) < 0.01] = 3*time_step
+    steps[rng.random(ntimes) < 0.002] = 0
+    timestamps = 1704067200 + np.cumsum(steps)
+
+    data = {'time': pd.to_datetime(timestamps, unit='s')}
+    for sensor in QC_SENSORS:
+        if 'direction' in sensor and 'spread' not in sensor:
+            values = np.mod(np.cumsum(rng.normal(0, 20, ntimes)), 360)
+        elif 'spread' in sensor:
+            values = 30 + 10*rng.random(ntimes)
+        elif 'frequency' in sensor:
+            values = 0.05 + 0.2*rng.random(ntimes)
+        elif 'period' in sensor:
+            values = 2 + 18*rng.random(ntimes)
+        elif 'height' in sensor:
+            values = np.abs(np.cumsum(rng.normal(0, 0.1, ntimes))) + 0.2
+        else:
+            values = 12 + np.cumsum(rng.normal(0, 0.05, ntimes))
+
+        # Add spikes, out of range values, and flat-lined stretches
+        spikes = rng.random(ntimes) < 0.005
+        values[spikes] = values[spikes] + rng.choice([-1, 1], spikes.sum())*50*rng.random(spikes.sum())
+        for start in rng.integers(0, ntimes, 20):
+            values[start:start + rng.integers(2, 40)] = values[start]
+        values[rng.random(ntimes) < 0.01] = np.nan
+        data[sensor] = values
+
+    qc_limits = {sensor: bb_qc.load_sensor_qartod_config(sensor)[sensor]
+                 for sensor in QC_SENSORS}
+
+    return pd.DataFrame(data), qc_limits
+
+
+def bench_qartod_engine(ndays=365, repeat=3, workers=4):
+    """
+    Time process_qartod_tests with each engine on a synthetic record,
+    with and without worker processes. The flags of the engines (and of
+    the worker processes) are checked against each other by the tests
+    in tests/test_qartod_parity.py.
+
+    Parameters
+    ----------
+    ndays : int, optional
+        Length of the synthetic record, in days
+    repeat : int, optional
+        Number of timed calls; the best time is reported
+    workers : int, optional
+        Number of worker processes to compare against a single process
+
+    Returns
+    -------
+    pandas.DataFrame
+        Timing results for each engine and number of workers
+    """
+
+    qc_data, qc_limits = make_synthetic_qc_data(ndays)
+    print('   {:,d} observations of {:d} sensors'.format(len(qc_data), len(QC_SENSORS)))
+
+    def run_engine(engine, engine_workers=1):
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return bb_qc.process_qartod_tests(qc_data, qc_data.columns, qc_limits,
+                                              engine=engine, workers=engine_workers)
+
+    # Start the worker processes, so that they are not timed below
+    run_engine('native', workers)
+
+    print('   ({:d} CPUs available)'.format(os.cpu_count()))
+    results = []
+    for engine in ['ioos_qc', 'native']:
+        for engine_workers in [1, workers]:
+            engine_time = _time_call(lambda: run_engine(engine, engine_workers), repeat)
+            results.append({'engine': engine, 'workers': engine_workers, 'time_s': engine_time})
+            print('   {:>8s}, {:d} worker(s): {:8.3f} s'.format(engine, engine_workers, engine_time))
+
+    return pd.DataFrame(results)
+
+
+def _legacy_qartod_time(times):
+
+    # The QARTOD time axis as it was built before, through
+    # pandas Timestamps, formatted strings, and datetime objects
+    return np.array([datetime.datetime.strptime(ii, '%Y-%m-%d %H:%M:%S') for ii in
+                     [ii.strftime('%Y-%m-%d %H:%M:%S') for ii in
+                      [pd.Timestamp(ii) for ii in times]]])
+
+
+def bench_qartod_time(nsamples=100000, repeat=5, seed=0):
+    """
+    Time the construction of the QARTOD time axis in
+    process_qartod_tests, through the former string round trip and
+    through integer seconds since 1970-01-01, and check that both
+    give the same times.
+
+    Parameters
+    ----------
+    nsamples : int, optional
+        Number of time samples
+    repeat : int, optional
+        Number of timed calls; the best time is reported
+    seed : int, optional
+        Seed for the random number generator
+
+    Returns
+    -------
+    pandas.DataFrame
+        Timing results for each method, per 100,000 samples
+    """
+
+    # Sub-second times, to check that both methods truncate them
+    rng = np.random.default_rng(seed)
+    timestamps = 1704067200 + np.cumsum(rng.integers(0, 3600, nsamples))
+    times = (timestamps.astype('datetime64[s]').astype('datetime64[ns]') +
+             rng.integers(0, 10**9, nsamples).astype('timedelta64[ns]'))
+
+    legacy_times = _legacy_qartod_time(times).astype('datetime64[s]')
+    native_times = bb_qc.qartod_time_seconds(times).astype('datetime64[s]')
+    np.testing.assert_array_equal(legacy_times, native_times)
+
+    results = []
+    for method, method_func in [('string round trip', lambda: _legacy_qartod_time(times)),
+                                ('epoch seconds', lambda: bb_qc.qartod_time_seconds(times))]:
+        method_time = _time_call(method_func, repeat)*100000/nsamples
+        results.append({'method': method, 'time_per_100k_s': method_time})
+        print('   {:>17s}: {:10.6f} s per 100k samples'.format(method, method_time))
+
+    return pd.DataFrame(results)
+
+
+def _make_qc_dataset(qc_data, loc_id, qc_limits):
+
+    # Run the QC tests on a synthetic dataframe, and convert it into
+    # an xarray dataset, in the same way as process_newdata
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        ds_qc = bb_process.get_buoy_qcflags(qc_data, loc_id, qc_limits=qc_limits)
+    ds_xr = pd.concat([qc_data, ds_qc], axis=1).set_index('time').to_xarray()
+    ds_xr = ds_xr.rename({varname: varname.replace('_qartod_', '_qc_')
+                          for varname in ds_xr.keys() if '_qartod_' in varname})
+
+    return ds_xr.expand_dims(dim={'location_id': [loc_id]}, axis=0).sortby('time')
+
+
+def bench_incremental_qc(ndays=31, new_days=1, repeat=3):
+    """
+    Check that rerunning the QC tests from the start of the new data
+    (rerun_qc_tests_since) gives the same flags as rerunning them on
+    all of the data (rerun_qc_tests), and time both.
+
+    The data are built as in an update run: a record of existing
+    data, with its QC flags, is merged with newly pulled data (which
+    overlaps the end of the existing data), and the existing records
+    that the new data overlaps are dropped. The flags of the new data
+    are found without the existing data. (tests/test_incremental_qc.py
+    checks the flags of a full update run.)
+
+    Parameters
+    ----------
+    ndays : int, optional
+        Length of the synthetic record, in days
+    new_days : int, optional
+        Length of the newly pulled data, in days
+    repeat : int, optional
+        Number of timed calls; the best time is reported
+
+    Returns
+    -------
+    pandas.DataFrame
+        Timing results for each method
+    """
+
+    import xarray as xr
+
+    loc_id = 'synthetic'
+    qc_data, qc_limits = make_synthetic_qc_data(ndays)
+    qc_data = qc_data.drop(columns=[col for col in qc_data.columns if 'frequency' in col])
+    qc_data = qc_data.drop_duplicates(subset='time').reset_index(drop=True)
+    direction_cols = [col for col in qc_data.columns if 'from_direction' in col]
+
+    ntimes = len(qc_data)
+    nnew = ntimes*new_days//ndays
+    noverlap = nnew//4
+    print('   {:,d} observations, {:,d} of them new'.format(ntimes, nnew))
+
+    def quiet(func):
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return func()
+
+    results = []
+    for missing_directions in [False, True]:
+        case_data = qc_data.copy()
+        if not(missing_directions):
+            # Without missing directions before the new data, only
+            # the new data (and the data it looks back over) is rerun
+            case_data.loc[:ntimes-nnew, direction_cols] = case_data.loc[:ntimes-nnew, direction_cols].fillna(0.0)
+
+        old_ds = _make_qc_dataset(case_data.iloc[:ntimes-nnew+noverlap], loc_id, qc_limits)
+        new_ds = _make_qc_dataset(case_data.iloc[ntimes-nnew:].reset_index(drop=True), loc_id, qc_limits)
+        ds_all = quiet(lambda: bb_process.check_duplicates(xr.concat([old_ds, new_ds], dim='time').sortby('time')))
+        since = new_ds['time'].data[0]
+
+        full_ds = quiet(lambda: bb_process.rerun_qc_tests(ds_all.copy(deep=True), loc_id,
+                                                          qc_limits=qc_limits))
+        incremental_ds = quiet(lambda: bb_process.rerun_qc_tests_since(ds_all.copy(deep=True), loc_id,
+                                                                       since, qc_limits=qc_limits))
+        nchanged = 0
+        for varname in full_ds.keys():
+            if '_qc_' in varname:
+                np.testing.assert_array_equal(full_ds[varname].to_numpy(),
+                                              incremental_ds[varname].to_numpy())
+                nchanged += int(np.sum(full_ds[varname].to_numpy() != ds_all[varname].to_numpy()))
+
+        case_name = 'missing directions' if missing_directions else 'no missing directions'
+        print('   {:s}: flags match a full rerun ({:,d} flags changed by the rerun)'.format(case_name, nchanged))
+        for method, method_func in [('full', lambda: bb_process.rerun_qc_tests(ds_all.copy(deep=True), loc_id,
+                                                                               qc_limits=qc_limits)),
+                                    ('incremental', lambda: bb_process.rerun_qc_tests_since(ds_all.copy(deep=True), loc_id,
+                                                                                            since, qc_limits=qc_limits))]:
+            method_time = _time_call(lambda: quiet(method_func), repeat)
+            results.append({'case': case_name, 'method': method, 'time_s': method_time})
+            print('      {:>11s}: {:8.3f} s'.format(method, method_time))
+
+    return pd.DataFrame(results)
+
+
+def _legacy_pack_flags(flags_df):
+
+    # The packed QARTOD flags as they were built before (in
+    # concat_test_results_into_string), one column at a time,
+    # and returned as a list
+    packed = np.zeros(len(flags_df)).astype(int)
+    fact = len(flags_df.columns) - 1
+    for column in flags_df.columns:
+        packed = packed + (flags_df.loc[:,column].astype(float) * (10**fact)).astype(int)
+        fact = fact - 1
+
+    return [ii for ii in packed]
+
+
+def bench_flag_packing(nsamples=1_000_000, repeat=3, seed=0):
+    """
+    Check that the vectorized flag packing (pack_flags) gives the same
+    codes as the former column loop, and that unpacking them gives back
+    the flags, and time packing and unpacking.
+
+    Parameters
+    ----------
+    nsamples : int, optional
+        Number of observations
+    repeat : int, optional
+        Number of timed calls; the best time is reported
+    seed : int, optional
+        Seed for the random number generator
+
+    Returns
+    -------
+    pandas.DataFrame
+        Timing results for each method
+    """
+
+    rng = np.random.default_rng(seed)
+    flags_df = pd.DataFrame({'sensor_qartod_' + test: rng.choice([1, 2, 3, 4, 9], nsamples)
+                             for test in bb_flags.QARTOD_TESTS})
+
+    def pack():
+        return bb_flags.pack_flags(bb_flags.to_flag_planes([flags_df[col] for col in flags_df.columns]))
+
+    codes = pack()
+    np.testing.assert_array_equal(codes, _legacy_pack_flags(flags_df))
+    np.testing.assert_array_equal(bb_flags.unpack_flags(codes, len(bb_flags.QARTOD_TESTS)),
+                                  flags_df.to_numpy().T)
+    print('   {:,} observations: packed codes match, and unpack to the same flags'.format(nsamples))
+
+    results = []
+    for method, method_func in [('column loop', lambda: _legacy_pack_flags(flags_df)),
+                                ('vectorized pack', pack),
+                                ('vectorized unpack', lambda: bb_flags.unpack_flags(codes))]:
+        method_time = _time_call(method_func, repeat)
+        results.append({'method': method, 'time_s': method_time})
+        print('   {:>17s}: {:8.3f} s'.format(method, method_time))
+
+    return pd.DataFrame(results)
+
+
+def _make_netcdf_dataset(ndays, loc_id):
+
+    # Build a synthetic dataset with all of the variables written to
+    # the netCDF files, rounded to two decimal places, as the Backyard
+    # Buoys API data are (so that they compress like real data)
+    qc_data, qc_limits = make_synthetic_qc_data(ndays)
+    qc_data[QC_SENSORS] = qc_data[QC_SENSORS].round(2)
+    ds_xr = _make_qc_dataset(qc_data, loc_id, qc_limits)
+    ntimes = ds_xr.sizes['time']
+    ds_xr['buoy_id'] = (('location_id', 'time'), np.full((1, ntimes), 'SPOT-00001', dtype=object))
+    ds_xr['latitude'] = (('location_id', 'time'), np.full((1, ntimes), 47.91))
+    ds_xr['longitude'] = (('location_id', 'time'), np.full((1, ntimes), -124.73))
+
+    return ds_xr
+
+
+def _write_netcdf_months(ds_xr, loc_id, outdir):
+
+    # Write a dataset into monthly netCDF files in the same way as
+    # write_netcdf, without the global metadata (which needs the
+    # location metadata files), and return the file paths
+    from netCDF4 import Dataset
+
+    ncpaths = []
+    for (year, month), ds_month in ds_xr.groupby(['time.year', 'time.month']):
+        ncpath = os.path.join(outdir, bb_process.get_netcdf_filename(loc_id, year, month))
+        with Dataset(ncpath, 'w', format='NETCDF4') as dataset:
+            dataset.createDimension('location_id', 1)
+            dataset.createDimension('time', ds_month.sizes['time'])
+            bb_process.netcdf_add_variables(dataset, loc_id, ds_month.sortby('time'))
+        ncpaths.append(ncpath)
+
+    return ncpaths
+
+
+def bench_netcdf_encoding(ndays=365, repeat=3):
+    """
+    Write a year of synthetic data into monthly netCDF files with each
+    encoding profile (NETCDF_ENCODING_PROFILES), and report the total
+    file size, the write and read times, and the largest change in the
+    wave data from storing it in a smaller type.
+
+    Parameters
+    ----------
+    ndays : int, optional
+        Length of the synthetic record, in days
+    repeat : int, optional
+        Number of timed calls; the best time is reported
+
+    Returns
+    -------
+    pandas.DataFrame
+        Size and timing results for each profile
+    """
+
+    import xarray as xr
+
+    loc_id = 'benchmark'
+    ds_xr = _make_netcdf_dataset(ndays, loc_id)
+    print('   {:,} observations, in {} monthly files'.format(ds_xr.sizes['time'],
+                                                           len(np.unique(ds_xr['time'].dt.month))))
+
+    wave_vars = [varname for varname in QC_SENSORS
+                 if varname.startswith('sea_surface_wave_') and varname in ds_xr.keys()]
+    results = []
+    default_encoding = bb_process.NETCDF_ENCODING
+    try:
+        for profile in bb_process.NETCDF_ENCODING_PROFILES:
+            bb_process.NETCDF_ENCODING = profile
+            with tempfile.TemporaryDirectory() as outdir:
+                write_time = _time_call(lambda: _write_netcdf_months(ds_xr, loc_id, outdir), repeat)
+                ncpaths = sorted(os.path.join(outdir, ncfile) for ncfile in os.listdir(outdir))
+                file_size = sum(os.path.getsize(ncpath) for ncpath in ncpaths)
+                read_time = _time_call(lambda: xr.concat([xr.load_dataset(ncpath) for ncpath in ncpaths],
+                                                         dim='time'), repeat)
+
+                # Check that the flags are unchanged, and find the
+                # largest change in the stored wave data
+                ds_read = xr.concat([xr.load_dataset(ncpath) for ncpath in ncpaths], dim='time')
+                flag_vars = [varname for varname in ds_read.keys() if '_qc_' in varname]
+                for varname in flag_vars:
+                    np.testing.assert_array_equal(ds_read[varname].to_numpy(),
+                                                  bb_flags.read_flag_planes(ds_xr, [varname]))
+                wave_error = max(float(np.nanmax(np.abs(ds_read[varname].to_numpy().astype(float) -
+                                                        ds_xr[varname].to_numpy())))
+                                 for varname in wave_vars if varname in ds_read.keys())
+
+            results.append({'profile': profile, 'size_mb': file_size/1e6,
+                            'write_s': write_time, 'read_s': read_time,
+                            'max_wave_error': wave_error})
+            print('   {:>18s}: {:7.2f} MB, write {:6.3f} s, read {:6.3f} s, '
+                  'largest wave data change {:.1e}'.format(profile, file_size/1e6, write_time,
+                                                           read_time, wave_error))
+    finally:
+        bb_process.NETCDF_ENCODING = default_encoding
+
+    return pd.DataFrame(results)
+
+
+def _legacy_epoch_seconds(times):
+
+    # The netCDF times as they were encoded before, through
+    # datetime objects and timedeltas, one time at a time
+    reftime = datetime.datetime(1970,1,1)
+    return [(pd.Timestamp(ii).to_pydatetime()-reftime).total_seconds() for ii in times]
+
+
+def bench_time_encoding(nsamples=100000, repeat=5, seed=0):
+    """
+    Time the encoding of the netCDF times as seconds since 1970-01-01,
+    one time at a time through datetime objects (as before) and with
+    datetime64_to_epoch, and check that both give the same seconds.
+
+    Parameters
+    ----------
+    nsamples : int, optional
+        Number of time samples
+    repeat : int, optional
+        Number of timed calls; the best time is reported
+    seed : int, optional
+        Seed for the random number generator
+
+    Returns
+    -------
+    pandas.DataFrame
+        Timing results for each method, per 100,000 samples
+    """
+
+    rng = np.random.default_rng(seed)
+    timestamps = 1704067200 + np.cumsum(rng.integers(0, 3600, nsamples))
+    times = timestamps.astype('datetime64[s]').astype('datetime64[ns]')
+
+    np.testing.assert_array_equal(_legacy_epoch_seconds(times),
+                                  bb_process.datetime64_to_epoch(times))
+
+    results = []
+    for method, method_func in [('datetime objects', lambda: _legacy_epoch_seconds(times)),
+                                ('int64 nanoseconds', lambda: bb_process.datetime64_to_epoch(times))]:
+        method_time = _time_call(method_func, repeat)*100000/nsamples
+        results.append({'method': method, 'time_per_100k_s': method_time})
+        print('   {:>17s}: {:10.6f} s per 100k samples'.format(method, method_time))
+
+    return pd.DataFrame(results)
+
+
+def _legacy_load_netcdf_files(ncpaths):
+
+    # The netCDF files as they were loaded before, in full,
+    # and concatenated onto the dataset one file at a time
+    import xarray as xr
+
+    ds = None
+    for ncpath in ncpaths:
+        ds_temp = xr.load_dataset(ncpath)
+        if ds is None:
+            ds = ds_temp
+        else:
+            ds = xr.concat([ds, ds_temp], dim='time')
+
+    return ds.sortby('time')
+
+
+def bench_history_load(ndays=365, repeat=3):
+    """
+    Load a year of monthly netCDF files (as in a full-year rebuild) one
+    file at a time, as before, and with load_netcdf_files, and check
+    that both give the same dataset. Report the time and the peak
+    memory of each.
+
+    Parameters
+    ----------
+    ndays : int, optional
+        Length of the synthetic record, in days
+    repeat : int, optional
+        Number of timed calls; the best time is reported
+
+    Returns
+    -------
+    pandas.DataFrame
+        Timing and memory results for each method
+    """
+
+    import xarray as xr
+
+    loc_id = 'benchmark'
+    ds_xr = _make_netcdf_dataset(ndays, loc_id)
+
+    results = []
+    with tempfile.TemporaryDirectory() as outdir:
+        ncpaths = _write_netcdf_months(ds_xr, loc_id, outdir)
+        print('   {:,} observations, in {} monthly files'.format(ds_xr.sizes['time'], len(ncpaths)))
+
+        xr.testing.assert_identical(_legacy_load_netcdf_files(ncpaths),
+                                    bb_process.load_netcdf_files(ncpaths))
+
+        for method, method_func in [('file by file', lambda: _legacy_load_netcdf_files(ncpaths)),
+                                    ('all files', lambda: bb_process.load_netcdf_files(ncpaths))]:
+            method_time = _time_call(method_func, repeat)
+            retained, peak = _memory_call(method_func)
+            results.append({'method': method, 'time_s': method_time,
+                            'retained_mb': retained, 'peak_mb': peak})
+            print('   {:>13s}: {:6.3f} s, {:7.2f} MB retained, {:7.2f} MB peak'.format(
+                method, method_time, retained, peak))
+
+    return pd.DataFrame(results)
+
+
+# In[ ]:
+
+
+BENCHMARKS = {'pivot': bench_observation_pivot,
+              'decode': bench_columnar_decode,
+              'startup': bench_startup_imports,
+              'qartod': bench_qartod_engine,
+              'qartod_time': bench_qartod_time,
+              'incremental_qc': bench_incremental_qc,
+              'flags': bench_flag_packing,
+              'netcdf_encoding': bench_netcdf_encoding,
+              'time_encoding': bench_time_encoding,
+              'history_load': bench_history_load}
+
+
+if __name__ == "__main__":
+
+    bench_names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+    for bench_name in bench_names:
+        if bench_name not in BENCHMARKS:
+            print('Unknown benchmark: ' + bench_name)
+            print('Available benchmarks: ' + ', '.join(BENCHMARKS.keys()))
+            sys.exit(2)
+        print('Benchmark: ' + bench_name)
+        BENCHMARKS[bench_name]()
@@ -8,13 +8,6 @@
 import os
 import shutil
 
-import google.auth
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
 import pandas as pd
 import numpy as np
 import json
@@ -82,12 +75,8 @@ def get_auth_dir():
                contains the authorization tokens
     """
     
-    # Get the current working directory
-    basedir = os.path.dirname(__file__)
-
     # Load in the directory info json
-    with open(os.path.join(basedir,'bb_dirs.json'), 'r') as dir_json:
-        dir_info = json.load(dir_json)
+    dir_info = bb.get_dirs_info()
     # Get the base directory which contains the authorization tokens
     auth_dir = dir_info['auth_token']
         
@@ -106,6 +95,12 @@ def get_user_token():
     and then creates a new authoization taken.
     """
 
+    # The Google API client libraries are imported within the functions
+    # that use them, so that they are only loaded when the sheets are read
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     creds = None
     SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
     
@@ -148,6 +143,10 @@ def create(title):
     TODO(developer) - See https://developers.google.com/identity
     for guides on implementing OAuth2 for the application.
     """
+
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
     
     auth_dir = get_auth_dir()
     token_path = os.path.join(auth_dir, 'token.json')
@@ -181,6 +180,10 @@ def batch_get_values(spreadsheet_id, _range_names, sheet_name=None):
     TODO(developer) - See https://developers.google.com/identity
     for guides on implementing OAuth2 for the application.
     """
+
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
     
     auth_dir = get_auth_dir()
     token_path = os.path.join(auth_dir, 'token.json')
@@ -704,8 +707,7 @@ def make_metadata_json(basedir, bb_loc, loc_meta, spotters_dict, rebuildFlag=Fal
             os.mkdir(os.path.join(sourcedir, 'archive'))
             
         # Load in the existing metadata json
-        with open(filepath, 'r') as meta_json:
-            check_json = json.load(meta_json)
+        check_json = bb.load_json_file(filepath)
         
         # Compare the metadata in the new data dictionary
         # to that loaded in from the existing metadata json
@@ -829,8 +831,7 @@ def make_location_info_json(basedir, loc_id, rebuild_flag=False, rebuild_period=
     # If the info path already exists, 
     # load in the info json, and update the relevant fields
     if os.path.exists(infodir):
-        with open(infodir, 'r') as info_json:
-            infodict = json.load(info_json)
+        infodict = bb.load_json_file(infodir)
             
         # Extract out a list of all spotter IDs for a location
         # Filter out empty strings that may result from trailing commas or empty fields
@@ -937,7 +938,7 @@ def make_location_info_json(basedir, loc_id, rebuild_flag=False, rebuild_period=
                             new_spotter_list.append(spotter)
 
                             # Get the timestamp of the wave height data
-                            max_timestamp = max([spot_locdata['WaveHeightSig']['data']['timestamp'][i] for i in keep_inds])
+                            max_timestamp = int(max([spot_locdata['WaveHeightSig']['data']['timestamp'][i] for i in keep_inds]))
                             ref_date = datetime.datetime(1970,1,1)
                             if wavedate is None:
                                 wavedate = (ref_date + 
@@ -971,7 +972,7 @@ def make_location_info_json(basedir, loc_id, rebuild_flag=False, rebuild_period=
                     return False
                 
                 # Get the timestamp of the wave height data
-                max_timestamp = max(all_locdata['WaveHeightSig']['data']['timestamp'])
+                max_timestamp = int(max(all_locdata['WaveHeightSig']['data']['timestamp']))
                 ref_date = datetime.datetime(1970,1,1)
                 wavedate = (ref_date + 
                             datetime.timedelta(seconds=max_timestamp))
@@ -1066,9 +1067,9 @@ def make_location_info_json(basedir, loc_id, rebuild_flag=False, rebuild_period=
                 
         ref_date = datetime.datetime(1970,1,1)
         startdate = (ref_date + 
-                     datetime.timedelta(seconds=min(all_locdata['WaveHeightSig']['data']['timestamp'])))
+                     datetime.timedelta(seconds=int(min(all_locdata['WaveHeightSig']['data']['timestamp']))))
         wavedate = (ref_date + 
-                     datetime.timedelta(seconds=max(all_locdata['WaveHeightSig']['data']['timestamp'])))
+                     datetime.timedelta(seconds=int(max(all_locdata['WaveHeightSig']['data']['timestamp']))))
         
         activeFlag = False
         if loc_info['status'] == 'active':
@@ -1115,8 +1116,7 @@ def make_location_info_json(basedir, loc_id, rebuild_flag=False, rebuild_period=
         if not(os.path.exists(os.path.join(sourcedir, 'archive'))):
             os.mkdir(os.path.join(sourcedir, 'archive'))
             
-        with open(infodir,'r') as info_json:
-            check_json = json.load(info_json)
+        check_json = bb.load_json_file(infodir)
             
         if ((infodict['loc_history'] != check_json['loc_history']) 
             or
@@ -1241,8 +1241,7 @@ def make_qcdata_json(basedir, bb_loc, qc_df=None, rebuildFlag=False):
         if not(os.path.exists(os.path.join(sourcedir, 'archive'))):
             os.mkdir(os.path.join(sourcedir, 'archive'))
             
-        with open(filepath, 'r') as qartod_json:
-            check_json = json.load(qartod_json)
+        check_json = bb.load_json_file(filepath)
             
         if datadict['qartod_limits'] != check_json['qartod_limits']:
             archive_name = bb_loc + '_qartod_' + datetime.datetime.now().strftime('%Y%m%d') + '.json'
@@ -1327,8 +1326,7 @@ def make_smart_qartod_json(basedir, bb_loc, qc_df=None, rebuildFlag=False):
         if not(os.path.exists(os.path.join(sourcedir, 'archive'))):
             os.mkdir(os.path.join(sourcedir, 'archive'))
             
-        with open(filepath, 'r') as smart_qartod_json:
-            check_json = json.load(smart_qartod_json)
+        check_json = bb.load_json_file(filepath)
             
         if datadict['qartod_limits'] != check_json['qartod_limits']:
             archive_name = bb_loc + '_smart_qartod_' + datetime.datetime.now().strftime('%Y%m%d') + '.json'
@@ -14,6 +14,8 @@ Key Functions:
     - bbapi_get_location_data() : Get time-series data for a location
     - bbapi_get_platform_data() : Get data for a specific buoy platform
     - smartmooring() : Get smart mooring sensor data from Sofar API
+    - get_http_session() : Pooled HTTP session shared by all API requests
+    - get_api_cache_stats() : Hit/miss counts of the API response cache
 
 Data Sources:
     - Backyard Buoys API: Primary source for processed wave and temperature data
@@ -29,31 +31,203 @@ import os
 import sys
 import getopt
 import gc
+import hashlib
+import json
+import threading
 import time
 
 import numpy as np
 import pandas as pd
 import requests
-import xarray as xr
 
-import matplotlib
-from matplotlib import pyplot as plt
-
-import ioos_qc
-from ioos_qc import qartod
-from ioos_qc.config import Config
-from ioos_qc.streams import PandasStream
-from ioos_qc.stores import PandasStore
+# orjson is an optional, faster JSON parser
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Import BackyardBuoys utility functions
 import backyardbuoys_general_functions as bb   
 
 
+# Record fields decoded into typed columns by _decode_variable_columns
+COLUMN_FLOAT_FIELDS = ['value', 'lat', 'lon', 'depth']
+COLUMN_CATEGORICAL_FIELDS = ['platform_id']
+
+
+# ============================================================================
+# Shared HTTP Session
+# ============================================================================
+
+# Settings for the pooled HTTP session shared by all API requests.
+# These can be changed with configure_http_session().
+HTTP_POOL_SIZE = 10                        # Connections kept alive per host
+HTTP_MAX_RETRIES = 3                       # Attempts per request
+HTTP_BACKOFF_SECONDS = 5                   # Base delay for exponential backoff
+HTTP_RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+HTTP_TIMEOUT = (10, 120)                   # (connect, read) timeouts in seconds
+
+_http_session = None
+_http_lock = threading.Lock()
+_http_stats = {'requests': 0, 'retries': 0, 'closed_connections': 0}
+
+
+def configure_http_session(pool_size=None, max_retries=None, backoff_seconds=None):
+    """
+    Change the settings of the shared HTTP session.
+
+    Any existing session is closed, and a new session with the given
+    settings is created on the next request.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Number of connections to keep alive per host.
+    max_retries : int, optional
+        Number of attempts before a request is abandoned.
+    backoff_seconds : int, optional
+        Base delay for exponential backoff between attempts.
+    """
+
+    global HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_BACKOFF_SECONDS
+
+    if pool_size is not None:
+        HTTP_POOL_SIZE = pool_size
+    if max_retries is not None:
+        HTTP_MAX_RETRIES = max_retries
+    if backoff_seconds is not None:
+        HTTP_BACKOFF_SECONDS = backoff_seconds
+
+    close_http_session()
+
+
+def get_http_session():
+    """
+    Return the shared, pooled HTTP session, creating it if needed.
+
+    The session keeps connections alive between requests, so that
+    repeated calls to the Backyard Buoys and Sofar APIs reuse existing
+    TCP/TLS connections rather than opening a new one for every call.
+
+    Returns
+    -------
+    requests.Session
+        Session shared by all API requests in this process.
+    """
+
+    global _http_session
+
+    with _http_lock:
+        if _http_session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                    pool_maxsize=HTTP_POOL_SIZE)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+            _http_session = session
+
+    return _http_session
+
+
+def close_http_session():
+    """
+    Close the shared HTTP session, and release its connections.
+    """
+
+    global _http_session
+
+    with _http_lock:
+        if _http_session is not None:
+            # Keep a count of the connections from the closed session
+            _http_stats['closed_connections'] += _count_opened_connections(_http_session)
+            _http_session.close()
+            _http_session = None
+
+
+def _count_opened_connections(session):
+
+    # Count the connections opened by all of the connection pools
+    # of a session (each pool keeps a running count). The same
+    # adapter may be mounted for more than one URL prefix.
+    nconnections = 0
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            nconnections += pools[key].num_connections
+    return nconnections
+
+
+def get_http_stats():
+    """
+    Return counters for the requests made through the shared session.
+
+    Returns
+    -------
+    dict
+        {'requests': int,             # Requests sent (including retries)
+         'retries': int,              # Requests that were retried
+         'connections_opened': int,   # New connections opened
+         'connections_reused': int}   # Requests sent on a kept-alive connection
+    """
+
+    with _http_lock:
+        nopened = _http_stats['closed_connections']
+        if _http_session is not None:
+            nopened += _count_opened_connections(_http_session)
+        stats = {'requests': _http_stats['requests'],
+                 'retries': _http_stats['retries'],
+                 'connections_opened': nopened,
+                 'connections_reused': max(_http_stats['requests'] - nopened, 0)}
+
+    return stats
+
+
+def add_http_stats(http_stats):
+    """
+    Add the counters of requests made in another process (e.g., a
+    worker process of update_all_locations) to those of this process.
+
+    Parameters
+    ----------
+    http_stats : dict
+        Counters, as returned by get_http_stats (the connections
+        reused are found again from the totals).
+    """
+
+    with _http_lock:
+        _http_stats['requests'] += http_stats.get('requests', 0)
+        _http_stats['retries'] += http_stats.get('retries', 0)
+        # The connections of the other process are counted as
+        # those of a closed session
+        _http_stats['closed_connections'] += http_stats.get('connections_opened', 0)
+
+
+def print_http_stats():
+    """
+    Print a summary of the connections used by the shared HTTP session.
+    """
+
+    stats = get_http_stats()
+    if stats['requests'] == 0:
+        return
+    print('HTTP requests: ' + str(stats['requests']) +
+          ' (' + str(stats['connections_opened']) + ' connections opened, ' +
+          str(stats['connections_reused']) + ' reused, ' +
+          str(stats['retries']) + ' retried)')
+
+
 def _request_get_with_retry(url, params=None, headers=None, request_label='API request',
-                            timeout=(10, 120), max_retries=3, base_backoff_seconds=5):
+                            timeout=None, max_retries=None, base_backoff_seconds=None):
     """
     Perform a GET request with retry logic for transient network errors.
 
+    Requests are sent through the shared, pooled HTTP session (see
+    get_http_session), and follow the shared retry policy: timeouts,
+    connection errors and retryable status codes (HTTP_RETRY_STATUS_CODES)
+    are retried with exponential backoff.
+
     Parameters
     ----------
     url : str
@@ -66,10 +240,13 @@ def _request_get_with_retry(url, params=None, headers=None, request_label='API r
         Human-readable label for logging.
     timeout : tuple, optional
         (connect_timeout, read_timeout) in seconds.
+        Defaults to HTTP_TIMEOUT.
     max_retries : int, optional
         Number of attempts before raising an exception.
+        Defaults to HTTP_MAX_RETRIES.
     base_backoff_seconds : int, optional
         Base delay for exponential backoff.
+        Defaults to HTTP_BACKOFF_SECONDS.
 
     Returns
     -------
@@ -77,21 +254,621 @@ def _request_get_with_retry(url, params=None, headers=None, request_label='API r
         HTTP response object.
     """
 
+    if timeout is None:
+        timeout = HTTP_TIMEOUT
+    if max_retries is None:
+        max_retries = HTTP_MAX_RETRIES
+    if base_backoff_seconds is None:
+        base_backoff_seconds = HTTP_BACKOFF_SECONDS
+
+    session = get_http_session()
     for attempt in range(1, max_retries + 1):
+        with _http_lock:
+            _http_stats['requests'] += 1
+            if attempt > 1:
+                _http_stats['retries'] += 1
         try:
-            return requests.get(url=url, params=params, headers=headers, timeout=timeout)
+            response = session.get(url=url, params=params, headers=headers, timeout=timeout)
         except requests.exceptions.Timeout as exc:
             if attempt == max_retries:
                 raise
             wait_seconds = base_backoff_seconds * (2 ** (attempt - 1))
             print(f'{request_label} timed out (attempt {attempt}/{max_retries}). Retrying in {wait_seconds}s...')
             time.sleep(wait_seconds)
+            continue
         except requests.exceptions.RequestException as exc:
             if attempt == max_retries:
                 raise
             wait_seconds = base_backoff_seconds * (2 ** (attempt - 1))
             print(f'{request_label} failed (attempt {attempt}/{max_retries}): {exc}. Retrying in {wait_seconds}s...')
             time.sleep(wait_seconds)
+            continue
+
+        # Retry on transient server errors, returning the last
+        # response if the request does not succeed
+        if (response.status_code in HTTP_RETRY_STATUS_CODES) and (attempt < max_retries):
+            wait_seconds = base_backoff_seconds * (2 ** (attempt - 1))
+            print(f'{request_label} returned status {response.status_code} (attempt {attempt}/{max_retries}). Retrying in {wait_seconds}s...')
+            time.sleep(wait_seconds)
+            continue
+
+        return response
+
+
+def _parse_json_response(content):
+    """
+    Parse a JSON response body, using orjson when it is installed.
+
+    Parameters
+    ----------
+    content : bytes or str
+        Raw JSON response body (e.g., ``response.content``).
+
+    Returns
+    -------
+    object
+        Parsed JSON payload.
+    """
+
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _decode_variable_columns(entries):
+    """
+    Decode the records of one API variable into columnar arrays.
+
+    Parameters
+    ----------
+    entries : list of dict
+        Records for a single variable, as returned by the API (one dict
+        per observation, e.g. {'timestamp': ..., 'value': ..., ...}).
+
+    Returns
+    -------
+    dict
+        Dictionary of columns, one per record field. Timestamps are
+        decoded as int64 (float64 if any are missing), value, lat, lon
+        and depth as float64, platform_id as a pandas Categorical, and
+        any other fields as object arrays.
+    """
+
+    columns = {}
+    for item in entries[0]:
+        # Pull each field out of the records in a single pass
+        values = [entry.get(item) for entry in entries]
+
+        if item == 'timestamp':
+            try:
+                columns[item] = np.array(values, dtype=np.int64)
+            except (TypeError, ValueError):
+                columns[item] = np.array(values, dtype=float)
+        elif item in COLUMN_FLOAT_FIELDS:
+            try:
+                columns[item] = np.array(values, dtype=float)
+            except (TypeError, ValueError):
+                # Non-numeric values (e.g., categorical conditions)
+                columns[item] = np.array(values, dtype=object)
+        elif item in COLUMN_CATEGORICAL_FIELDS:
+            columns[item] = pd.Categorical(values)
+        else:
+            columns[item] = np.array(values, dtype=object)
+
+    return columns
+
+
+def _decode_bbapi_variables(lines):
+    """
+    Restructure a Backyard Buoys data API payload by variable name.
+
+    Parameters
+    ----------
+    lines : dict
+        Parsed JSON payload from the get_location_data or
+        get_platform_data endpoint.
+
+    Returns
+    -------
+    dict or None
+        Dictionary keyed by variable name, each containing 'units' and
+        'data' (columnar arrays, see _decode_variable_columns), or None
+        if the payload contains no variables.
+    """
+
+    if not isinstance(lines, dict) or ('variables' not in lines):
+        return None
+
+    # Check if any data was returned
+    if len(lines['variables']) == 0:
+        # No data available for this location/time range
+        return None
+
+    var_data = {}
+    for line in lines['variables']:
+        # Get the variable name (e.g., 'WaveHeightSig')
+        var_name = line['var_id']
+        if len(line['data']) == 0:
+            continue
+
+        var_data[var_name] = {}
+        var_data[var_name]['units'] = line['units']
+        var_data[var_name]['data'] = _decode_variable_columns(line['data'])
+
+    if len(var_data) == 0:
+        return None
+
+    return var_data
+
+
+# ============================================================================
+# API Response Cache
+# ============================================================================
+
+# Settings for the on-disk cache of Backyard Buoys API responses.
+# These can be changed with configure_api_cache(). Entries are stored
+# as JSON (parsed responses) and npz (decoded time series) files.
+API_CACHE_ENABLED = False           # Cache the API responses (off unless enabled)
+API_CACHE_TTLS = {                  # Seconds for which a cached response is reused
+    'get_locations': 10*60,
+    'get_platforms': 60*60,
+    'get_location_data': 10*60,
+    'get_platform_data': 10*60,
+}
+API_CACHE_MAX_AGE = 24*60*60        # Seconds before a cached time series is pulled again in full
+API_CACHE_TAIL_OVERLAP = 6*60*60    # Seconds at the end of a cached time series that are always pulled again
+API_CACHE_MAX_BYTES = 2*1024**3     # Size of the cache, above which the oldest entries are removed
+
+_api_cache_dir = None
+_api_cache_lock = threading.Lock()
+_api_cache_stats = {}
+
+
+def configure_api_cache(enabled=None, cache_dir=None, ttls=None, max_bytes=None):
+    """
+    Change the settings of the API response cache.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Whether API responses are cached.
+    cache_dir : str, optional
+        Directory for the cached responses. Defaults to
+        backyardbuoys_general_functions.get_api_cache_dir().
+    ttls : dict, optional
+        Time-to-live (in seconds) of the cached responses, keyed by
+        endpoint name (e.g., {'get_locations': 600}).
+    max_bytes : int, optional
+        Size of the cache (in bytes), above which the entries
+        written longest ago are removed.
+    """
+
+    global API_CACHE_ENABLED, API_CACHE_MAX_BYTES, _api_cache_dir
+
+    if enabled is not None:
+        API_CACHE_ENABLED = enabled
+    if cache_dir is not None:
+        _api_cache_dir = cache_dir
+    if ttls is not None:
+        API_CACHE_TTLS.update(ttls)
+    if max_bytes is not None:
+        API_CACHE_MAX_BYTES = max_bytes
+
+
+def get_api_cache_stats():
+    """
+    Return the API cache counters for this process.
+
+    Returns
+    -------
+    dict
+        Counters keyed by endpoint name:
+        {'get_locations': {'hit': int,       # Served from the cache
+                           'partial': int,   # Part of the time range pulled
+                           'miss': int},     # Pulled in full
+         ...}
+    """
+
+    with _api_cache_lock:
+        return {endpoint: dict(counts) for endpoint, counts in _api_cache_stats.items()}
+
+
+def print_api_cache_stats():
+    """
+    Print a summary of the API cache hits and misses.
+    """
+
+    stats = get_api_cache_stats()
+    if len(stats) == 0:
+        return
+    print('API cache (hit/partial/miss):')
+    for endpoint, counts in stats.items():
+        print('   ' + endpoint + ': ' + str(counts['hit']) + '/' +
+              str(counts['partial']) + '/' + str(counts['miss']))
+
+
+def reset_api_cache_stats():
+    """
+    Reset the API cache counters for this process.
+    """
+
+    with _api_cache_lock:
+        _api_cache_stats.clear()
+
+
+def _count_api_cache(endpoint, outcome):
+
+    # Count a cache hit, partial hit or miss for an endpoint
+    with _api_cache_lock:
+        counts = _api_cache_stats.setdefault(endpoint, {'hit': 0, 'partial': 0, 'miss': 0})
+        counts[outcome] += 1
+
+
+def _get_api_cache_path(endpoint, key_items, extension='.json'):
+
+    # Build the path of the cache file for an endpoint request,
+    # named by a hash of the request URL and parameters
+    global _api_cache_dir
+
+    if _api_cache_dir is None:
+        _api_cache_dir = bb.get_api_cache_dir()
+
+    key = json.dumps([endpoint] + list(key_items), sort_keys=True, default=str)
+    key_hash = hashlib.sha1(key.encode()).hexdigest()
+
+    return os.path.join(_api_cache_dir, endpoint + '_' + key_hash + extension)
+
+
+def _encode_timeseries_entry(entry):
+
+    # Split a time series cache entry into a JSON header and a
+    # dictionary of numeric arrays, for storage in an npz file
+    # (so that no pickled objects are ever written or loaded).
+    # Categorical columns are stored as integer codes, with their
+    # categories in the header, and other non-numeric columns
+    # (which came from the parsed JSON response) in the header.
+    header = {key: entry[key] for key in entry if key != 'data'}
+    header['variables'] = {}
+    arrays = {}
+    for ii, (var_name, var) in enumerate(entry['data'].items()):
+        columns = {}
+        for jj, (item, values) in enumerate(var['data'].items()):
+            array_name = 'v' + str(ii) + '_' + str(jj)
+            if isinstance(values, pd.Categorical):
+                columns[item] = {'kind': 'categorical', 'array': array_name,
+                                 'categories': values.categories.tolist()}
+                arrays[array_name] = values.codes
+            elif values.dtype.kind in 'biuf':
+                columns[item] = {'kind': 'array', 'array': array_name}
+                arrays[array_name] = values
+            else:
+                columns[item] = {'kind': 'object', 'values': values.tolist()}
+        header['variables'][var_name] = {'units': var['units'], 'columns': columns}
+
+    return header, arrays
+
+
+def _decode_timeseries_entry(header, arrays):
+
+    # Rebuild a time series cache entry from its JSON
+    # header and arrays (see _encode_timeseries_entry)
+    entry = {key: header[key] for key in header if key != 'variables'}
+    entry['data'] = {}
+    for var_name, var in header['variables'].items():
+        var_data = {}
+        for item, column in var['columns'].items():
+            if column['kind'] == 'categorical':
+                var_data[item] = pd.Categorical.from_codes(arrays[column['array']],
+                                                           column['categories'])
+            elif column['kind'] == 'array':
+                var_data[item] = arrays[column['array']]
+            else:
+                var_data[item] = np.array(column['values'], dtype=object)
+        entry['data'][var_name] = {'units': var['units'], 'data': var_data}
+
+    return entry
+
+
+def _read_api_cache(path):
+
+    # Load a cache entry, treating a missing or
+    # unreadable entry as not being cached
+    if not(os.path.exists(path)):
+        return None
+    try:
+        if path.endswith('.npz'):
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            header = json.loads(str(arrays.pop('header')))
+            return _decode_timeseries_entry(header, arrays)
+        with open(path, 'r') as f:
+            return json.load(f)
+    except Exception as exc:
+        print('Unable to read API cache entry ' + path + ': ' + str(exc))
+        return None
+
+
+def _write_api_cache(path, entry):
+
+    # Write the entry to a temporary file, and then move it into
+    # place, so that other processes never read a partial entry
+    tmp_path = path + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path.endswith('.npz'):
+            header, arrays = _encode_timeseries_entry(entry)
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, header=np.array(json.dumps(header)), **arrays)
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as exc:
+        print('Unable to write API cache entry ' + path + ': ' + str(exc))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+
+    _evict_api_cache()
+
+
+def _evict_api_cache():
+
+    # Remove the cache entries written more than API_CACHE_MAX_AGE
+    # seconds ago (which are no longer used), and then, while the
+    # cache is larger than API_CACHE_MAX_BYTES, the entries written
+    # longest ago. Entries removed by another process at the same
+    # time are skipped.
+    now = time.time()
+    entries = []
+    for entry_name in os.listdir(_api_cache_dir):
+        entry_path = os.path.join(_api_cache_dir, entry_name)
+        try:
+            entry_stat = os.stat(entry_path)
+            if now - entry_stat.st_mtime > API_CACHE_MAX_AGE:
+                os.remove(entry_path)
+            else:
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+        except OSError:
+            continue
+
+    cache_bytes = sum([entry_size for _, entry_size, _ in entries])
+    for _, entry_size, entry_path in sorted(entries):
+        if cache_bytes <= API_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+        cache_bytes -= entry_size
+
+
+def _parse_api_time(time_str):
+
+    # Convert an API time string (e.g., '2024-01-01T00:00:00Z')
+    # into Unix epoch seconds, returning None if it cannot be parsed
+    try:
+        api_time = datetime.datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%SZ')
+    except (TypeError, ValueError):
+        return None
+    return int(api_time.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def _format_api_time(epoch_time):
+
+    # Convert Unix epoch seconds into an API time string
+    api_time = datetime.datetime.fromtimestamp(epoch_time, tz=datetime.timezone.utc)
+    return api_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _select_columns(columns, keep):
+
+    # Subset each column of a variable's data
+    return {item: values[keep] for item, values in columns.items()}
+
+
+def _merge_time_range(var_data, new_data, range_start, range_end):
+
+    # Replace the records of each variable that fall within
+    # [range_start, range_end] (range_end of None is open-ended)
+    # with the records newly pulled for that time range
+    if new_data is None:
+        new_data = {}
+
+    merged = {}
+    for var_name in list(var_data.keys()) + [var for var in new_data if var not in var_data]:
+        old_var = var_data.get(var_name)
+        new_var = new_data.get(var_name)
+
+        if old_var is not None:
+            timestamps = old_var['data']['timestamp']
+            keep = timestamps < range_start
+            if range_end is not None:
+                keep = keep | (timestamps > range_end)
+            old_var = {'units': old_var['units'],
+                       'data': _select_columns(old_var['data'], keep)}
+
+        if (old_var is None) or (len(old_var['data']['timestamp']) == 0):
+            merged_var = new_var
+        elif (new_var is None) or (set(new_var['data'].keys()) != set(old_var['data'].keys())):
+            merged_var = old_var if new_var is None else new_var
+        else:
+            # Combine the records, and put them in time order
+            columns = {}
+            for item, values in old_var['data'].items():
+                if isinstance(values, pd.Categorical):
+                    columns[item] = pd.api.types.union_categoricals([values, new_var['data'][item]])
+                else:
+                    columns[item] = np.concatenate([values, new_var['data'][item]])
+            order = np.argsort(columns['timestamp'], kind='stable')
+            merged_var = {'units': new_var['units'],
+                          'data': _select_columns(columns, order)}
+
+        if merged_var is not None:
+            merged[var_name] = merged_var
+
+    return merged
+
+
+def _get_json_cached(endpoint, url, params=None, request_label='API request'):
+    """
+    Return the parsed JSON response of an API request, reusing a cached
+    response if it is within the time-to-live of the endpoint.
+
+    Parameters
+    ----------
+    endpoint : str
+        Endpoint name, used for the time-to-live and the statistics.
+    url : str
+        URL to request.
+    params : dict, optional
+        Query parameters.
+    request_label : str, optional
+        Human-readable label for logging.
+
+    Returns
+    -------
+    object
+        Parsed JSON payload.
+    """
+
+    if not(API_CACHE_ENABLED):
+        response = _request_get_with_retry(url=url, params=params, request_label=request_label)
+        return _parse_json_response(response.content)
+
+    path = _get_api_cache_path(endpoint, [url, params])
+    entry = _read_api_cache(path)
+    if ((entry is not None) and
+        (time.time() - entry['fetched_at'] < API_CACHE_TTLS.get(endpoint, 0))):
+        _count_api_cache(endpoint, 'hit')
+        return entry['payload']
+
+    _count_api_cache(endpoint, 'miss')
+    response = _request_get_with_retry(url=url, params=params, request_label=request_label)
+    payload = _parse_json_response(response.content)
+    if response.status_code == 200:
+        _write_api_cache(path, {'fetched_at': time.time(), 'payload': payload})
+
+    return payload
+
+
+def _get_timeseries_cached(endpoint, url, params, request_label='API request'):
+    """
+    Return the decoded variable data of a time-series API request,
+    using cached data for the part of the time range already pulled.
+
+    Each cached entry holds the decoded data for one request (without
+    its time range), along with the time range that it covers. Only the
+    parts of the requested time range that are not covered are pulled
+    from the API: an earlier start, and/or the end of the record. The
+    last API_CACHE_TAIL_OVERLAP seconds of the cached data are always
+    pulled again with the end of the record, and the cached data for an
+    open-ended request is reused without pulling for the time-to-live
+    of the endpoint.
+
+    Parameters
+    ----------
+    endpoint : str
+        Endpoint name, used for the time-to-live and the statistics.
+    url : str
+        URL to request.
+    params : dict
+        Query parameters, including 'time_start' and, optionally,
+        'time_end' (in the format 'YYYY-MM-DDTHH:MM:SSZ').
+    request_label : str, optional
+        Human-readable label for logging.
+
+    Returns
+    -------
+    dict or None
+        Variable data, in the format returned by _decode_bbapi_variables.
+    """
+
+    base_params = {key: val for key, val in params.items()
+                   if key not in ['time_start', 'time_end']}
+    time_start = params.get('time_start')
+    time_end = params.get('time_end')
+
+    def fetch_range(range_start, range_end, check_status=True):
+        range_params = dict(base_params)
+        range_params['time_start'] = range_start
+        if range_end is not None:
+            range_params['time_end'] = range_end
+        response = _request_get_with_retry(url=url, params=range_params,
+                                           request_label=request_label)
+        # An error response must not be merged into the cached
+        # data as an empty time range
+        if check_status:
+            response.raise_for_status()
+        return _decode_bbapi_variables(_parse_json_response(response.content))
+
+    # Requests that cannot be placed in time are not cached
+    req_start = _parse_api_time(time_start)
+    req_end = _parse_api_time(time_end)
+    if ((not(API_CACHE_ENABLED)) or (req_start is None) or
+        ((time_end is not None) and (req_end is None))):
+        return fetch_range(time_start, time_end, check_status=False)
+
+    now = int(time.time())
+    path = _get_api_cache_path(endpoint, [url, base_params], '.npz')
+    entry = _read_api_cache(path)
+    if (entry is not None) and (now - entry['created_at'] > API_CACHE_MAX_AGE):
+        entry = None
+
+    # Work out which parts of the requested time range need to be pulled
+    if ((entry is None) or (req_start > entry['end']) or
+        ((req_end is not None) and (req_end < entry['start']))):
+        # Nothing usable is cached - pull the full time range
+        outcome = 'miss'
+        entry = None
+        fetch_ranges = [(req_start, req_end)]
+    else:
+        fetch_ranges = []
+        if req_start < entry['start']:
+            fetch_ranges.append((req_start, entry['start']))
+        fresh = (entry['open_ended'] and
+                 (now - entry['fetched_at'] < API_CACHE_TTLS.get(endpoint, 0)))
+        if ((req_end is None) or (req_end > entry['end'])) and not(fresh):
+            fetch_ranges.append((max(entry['end'] - API_CACHE_TAIL_OVERLAP, req_start), req_end))
+        outcome = 'partial' if len(fetch_ranges) > 0 else 'hit'
+    _count_api_cache(endpoint, outcome)
+
+    if entry is None:
+        entry = {'created_at': now, 'fetched_at': now, 'start': req_start,
+                 'end': req_start, 'open_ended': False, 'data': {}}
+
+    # Pull each uncovered time range, and merge it into the cached data
+    for range_start, range_end in fetch_ranges:
+        range_data = fetch_range(_format_api_time(range_start),
+                                 None if range_end is None else _format_api_time(range_end))
+        entry['data'] = _merge_time_range(entry['data'], range_data, range_start, range_end)
+        entry['start'] = min(entry['start'], range_start)
+        if (range_end is None) or (range_end >= now):
+            # The data has been pulled up to the present
+            entry['end'] = now
+            entry['open_ended'] = True
+            entry['fetched_at'] = now
+        elif range_end > entry['end']:
+            entry['end'] = range_end
+            entry['open_ended'] = False
+    if len(fetch_ranges) > 0:
+        _write_api_cache(path, entry)
+
+    # Return the cached data within the requested time range
+    var_data = {}
+    for var_name, cached_var in entry['data'].items():
+        timestamps = cached_var['data']['timestamp']
+        keep = timestamps >= req_start
+        if req_end is not None:
+            keep = keep & (timestamps <= req_end)
+        if np.any(keep):
+            var_data[var_name] = {'units': cached_var['units'],
+                                  'data': _select_columns(cached_var['data'], keep)}
+
+    if len(var_data) == 0:
+        return None
+
+    return var_data
 
 
 # ============================================================================
@@ -159,9 +936,10 @@ def bbapi_get_locations(recentFlag=False):
     if recentFlag:
         api_url = api_url + '?newest_data=true'
     
-    # Make GET request to the API
+    # Make GET request to the API (or reuse a recent cached response)
     try:
-        response = _request_get_with_retry(
+        json_response = _get_json_cached(
+            'get_locations',
             url=api_url,
             request_label='Backyard Buoys get_locations request'
         )
@@ -170,7 +948,7 @@ def bbapi_get_locations(recentFlag=False):
         return {}
     
     # Parse the JSON response into a numpy array
-    lines = np.array(response.json())
+    lines = np.array(json_response)
     
     # Restructure the data into a dictionary keyed by location ID
     # This makes it easier to look up specific locations
@@ -229,13 +1007,13 @@ def bbapi_get_location_data(loc_id, vars_to_get='ALL', time_start=None, time_end
             'variable_id': {
                 'units': str,
                 'data': {
-                    'timestamp': list of int,  # Unix epoch time
-                    'value': list of float,
-                    'lat': list of float,
-                    'lon': list of float,
-                    'depth': list of float,    # 0 for surface
-                    'platform_id': list of str, # Spotter buoy ID
-                    'type': list of str
+                    'timestamp': ndarray of int64,  # Unix epoch time
+                    'value': ndarray of float64,
+                    'lat': ndarray of float64,
+                    'lon': ndarray of float64,
+                    'depth': ndarray of float64,    # 0 for surface
+                    'platform_id': Categorical,     # Spotter buoy ID
+                    'type': ndarray of object
                 }
             }
         }
@@ -279,6 +1057,9 @@ def bbapi_get_location_data(loc_id, vars_to_get='ALL', time_start=None, time_end
     - depth=0 indicates surface measurements from the wave buoy
     - depth≠0 indicates subsurface measurements from smart mooring sensors
     - Returns empty 'variables' list if no data matches the query
+    - Each variable's records are decoded directly into columns (see
+      _decode_variable_columns); orjson is used to parse the response
+      when it is installed
     
     See Also
     --------
@@ -304,9 +1085,13 @@ def bbapi_get_location_data(loc_id, vars_to_get='ALL', time_start=None, time_end
     if time_end is not None:
         params['time_end'] = time_end
         
-    # Make GET request to the API with query parameters
+    # Make GET request to the API with query parameters, pulling only
+    # the part of the time range that is not already cached. Each
+    # variable is decoded into columns of numpy arrays, organized by
+    # variable name.
     try:
-        response = _request_get_with_retry(
+        location_data = _get_timeseries_cached(
+            'get_location_data',
             url=api_url,
             params=params,
             request_label=f'Backyard Buoys get_location_data request for {loc_id}'
@@ -315,46 +1100,6 @@ def bbapi_get_location_data(loc_id, vars_to_get='ALL', time_start=None, time_end
         print(f'Backyard Buoys get_location_data request failed for {loc_id} after retries: {exc}')
         return None
 
-    # Parse the JSON response
-    lines = response.json()
-
-    if not isinstance(lines, dict) or ('variables' not in lines):
-        return None
-    
-    # Check if any data was returned
-    if len(lines['variables']) == 0:
-        # No data available for this location/time range
-        return None
-    
-    # Restructure the data into a more convenient format
-    # Organize by variable name instead of list index
-    location_data = {}
-    for line in lines['variables']:
-        # Get the variable name (e.g., 'WaveHeightSig')
-        var_name = line['var_id']
-        
-        # Create a dictionary for this variable
-        location_data[var_name] = {}
-        
-        # Store the units (e.g., 'm' for wave height)
-        location_data[var_name]['units'] = line['units']
-        
-        # Restructure the data array into a dictionary of lists
-        # This makes it easier to work with in pandas/numpy
-        extract_data = {}
-        
-        # Initialize empty lists for each data field
-        for item in line['data'][0]:
-            extract_data[item] = []
-
-        # Populate the lists with data from each time point
-        for entry in line['data']:
-            for item in entry:
-                extract_data[item].append(entry[item])
-            
-        # Store the extracted data
-        location_data[var_name]['data'] = extract_data
-        
     return location_data
 
 
@@ -380,16 +1125,16 @@ def bbapi_get_platforms(inactiveFlag=False, retiredFlag=False,
     elif offlineFlag:
         api_url = api_url + '?status=offline'
     
-    # Make the API request
+    # Make the API request (or reuse a recent cached response)
     try:
-        response = _request_get_with_retry(
+        json_response = _get_json_cached(
+            'get_platforms',
             url=api_url,
             request_label='Backyard Buoys get_platforms request'
         )
     except requests.exceptions.RequestException as exc:
         print(f'Backyard Buoys get_platforms request failed after retries: {exc}')
         return None
-    json_response = response.json()
     
     # Check if the response is empty or contains an error message
     # The API returns {'error': 'No platforms found'} when empty
@@ -463,7 +1208,8 @@ def bbapi_get_platform_data(platform_id, vars_to_get='ALL', time_start=None, tim
     -------
     dict
         Platform data from API response containing time-series measurements
-        and buoy metadata
+        and buoy metadata, organized by variable name, in the same columnar
+        structure as bbapi_get_location_data
     
     Examples
     --------
@@ -514,9 +1260,12 @@ def bbapi_get_platform_data(platform_id, vars_to_get='ALL', time_start=None, tim
     if time_end is not None:
         params['time_end'] = time_end
 
-    # Make GET request to the API
+    # Make GET request to the API, pulling only the part of the time
+    # range that is not already cached. Each variable is decoded into
+    # columns of numpy arrays, organized by variable name.
     try:
-        response = _request_get_with_retry(
+        platform_data = _get_timeseries_cached(
+            'get_platform_data',
             url=api_url,
             params=params,
             request_label=f'Backyard Buoys get_platform_data request for {platform_id}'
@@ -524,47 +1273,7 @@ def bbapi_get_platform_data(platform_id, vars_to_get='ALL', time_start=None, tim
     except requests.exceptions.RequestException as exc:
         print(f'Backyard Buoys get_platform_data request failed for {platform_id} after retries: {exc}')
         return None
-    
-    # Parse and return the JSON response
-    lines = response.json()
 
-    if not isinstance(lines, dict) or ('variables' not in lines):
-        return None
-    
-    # Check if any data was returned
-    if len(lines['variables']) == 0:
-        # No data available for this location/time range
-        return None
-    
-    # Restructure the data into a more convenient format
-    # Organize by variable name instead of list index
-    platform_data = {}
-    for line in lines['variables']:
-        # Get the variable name (e.g., 'WaveHeightSig')
-        var_name = line['var_id']
-        
-        # Create a dictionary for this variable
-        platform_data[var_name] = {}
-        
-        # Store the units (e.g., 'm' for wave height)
-        platform_data[var_name]['units'] = line['units']
-        
-        # Restructure the data array into a dictionary of lists
-        # This makes it easier to work with in pandas/numpy
-        extract_data = {}
-        
-        # Initialize empty lists for each data field
-        for item in line['data'][0]:
-            extract_data[item] = []
-
-        # Populate the lists with data from each time point
-        for entry in line['data']:
-            for item in entry:
-                extract_data[item].append(entry[item])
-            
-        # Store the extracted data
-        platform_data[var_name]['data'] = extract_data
-        
     return platform_data
 
 
@@ -783,6 +1492,9 @@ def smartmooring(basedir, apikey_file, spotterID, startDate, endDate):
     get_buoydata_sofarapi : Get surface wave data
     bbapi_get_location_data : Get all data via Backyard Buoys API
     """
+
+    # xarray is only needed for the legacy smart mooring download
+    import xarray as xr
     
     # Load the Sofar API key from file
     headers = {}
@@ -10,17 +10,148 @@ system. Functions include path management, configuration loading, and metadata
 access.
 
 Key Functions:
+    - load_json_file() : Loads a JSON file, reusing it while unchanged
+    - get_dirs_info() : Loads the directory configuration (bb_dirs.json)
     - get_datadir() : Returns base data directory path
     - get_location_metadata() : Loads location metadata from JSON
     - load_googleinfo_json() : Loads Google Sheets configuration
     - load_bbapi_info_json() : Loads API endpoint configuration
+    - load_user_info_json() : Loads user (email) configuration
 
 Author: Seth Travis
 Organization: Backyard Buoys
 """
 
 import os
+import copy
 import json
+import threading
+
+
+# ============================================================================
+# Configuration and Metadata File Registry
+# ============================================================================
+
+# Parsed JSON files, keyed by path. Each entry holds the modification
+# time and size of the file when it was loaded, so that a file is only
+# read again once it has been changed on disk.
+_json_registry = {}
+_json_registry_lock = threading.Lock()
+_json_registry_stats = {'reads': 0, 'saved': 0}
+
+
+def load_json_file(path):
+    """
+    Load a JSON file, reusing the parsed contents while the file is unchanged.
+
+    The configuration and metadata JSON files are loaded many times in each
+    run (e.g., the location metadata is loaded for every netCDF file that
+    is written). Each file is read from disk once per process, and is only
+    read again when its modification time or size changes.
+
+    Parameters
+    ----------
+    path : str
+        Path to the JSON file
+
+    Returns
+    -------
+    dict or list
+        Parsed JSON contents. A new copy is returned on every call, so
+        the caller is free to modify it.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the file does not exist
+
+    See Also
+    --------
+    get_file_read_stats : Counts of files read and reads saved
+    """
+
+    path = os.path.abspath(path)
+    file_stat = os.stat(path)
+    file_key = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    with _json_registry_lock:
+        cached = _json_registry.get(path)
+        if (cached is not None) and (cached[0] == file_key):
+            _json_registry_stats['saved'] += 1
+            return copy.deepcopy(cached[1])
+
+    # Read (or re-read) the file from disk
+    with open(path, 'r') as json_file:
+        data = json.load(json_file)
+
+    with _json_registry_lock:
+        _json_registry[path] = (file_key, data)
+        _json_registry_stats['reads'] += 1
+
+    return copy.deepcopy(data)
+
+
+def get_file_read_stats():
+    """
+    Return the JSON file registry counters for this process.
+
+    Returns
+    -------
+    dict
+        {'reads': int,   # Files read from disk
+         'saved': int}   # Loads served without reading the file
+    """
+
+    with _json_registry_lock:
+        return dict(_json_registry_stats)
+
+
+def reset_file_read_stats():
+    """
+    Reset the JSON file registry counters for this process.
+    """
+
+    with _json_registry_lock:
+        _json_registry_stats['reads'] = 0
+        _json_registry_stats['saved'] = 0
+
+
+def print_file_read_stats():
+    """
+    Print a summary of the JSON files read and the file reads saved.
+    """
+
+    stats = get_file_read_stats()
+    if stats['reads'] + stats['saved'] == 0:
+        return
+    print('Configuration/metadata files: ' + str(stats['reads']) + ' read, ' +
+          str(stats['saved']) + ' reads saved')
+
+
+def get_dirs_info():
+    """
+    Load the directory configuration (bb_dirs.json).
+
+    Returns
+    -------
+    dict
+        Directory configuration.
+
+        Expected structure:
+        {
+            'erddap_data': str,   # Base data directory
+            'info_jsons': str,    # Directory of the info JSON files
+            'auth_token': str,    # Directory of the authorization tokens
+            'erddap_files': str,  # Directory of the ERDDAP datasets.xml files
+            'api_cache': str      # (Optional) API response cache directory
+        }
+
+    Notes
+    -----
+    bb_dirs.json is kept in the same directory as the Python scripts.
+    """
+
+    return load_json_file(os.path.join(os.path.dirname(__file__), 'bb_dirs.json'))
 
 
 def get_location_metadata(loc_id):
@@ -102,9 +233,8 @@ def get_location_metadata(loc_id):
         # Metadata file not found - return None
         return None
     else:
-        # Open and load the metadata JSON file
-        with open(pathdir) as meta_json:
-            meta = json.load(meta_json)
+        # Load the metadata JSON file
+        meta = load_json_file(pathdir)
     
     # Return only the 'metadata' portion of the JSON
     # (The JSON also contains 'creation_date' at the top level)
@@ -127,7 +257,6 @@ def get_location_info(loc_id):
     """
     
     import os
-    import json
     
     # Construct the path to the location info JSON file
     basedir = get_datadir()
@@ -138,8 +267,7 @@ def get_location_info(loc_id):
         return None  # Info file not found
     else:
         # Load the location info JSON
-        with open(pathdir) as info_json:
-            loc_info = json.load(info_json)
+        loc_info = load_json_file(pathdir)
     
         
     return loc_info
@@ -189,18 +317,44 @@ def get_datadir():
     get_location_metadata : Load metadata for a location
     """
     
-    # Get the current working directory
-    basedir = os.path.dirname(__file__)
-    
     # Load in the directory info json
-    with open(os.path.join(basedir,'bb_dirs.json'), 'r') as dir_json:
-        dir_info = json.load(dir_json)
+    dir_info = get_dirs_info()
     # Get the base directory which contains the erddap data
     basedir = dir_info['erddap_data']
         
     return basedir
 
 
+def get_api_cache_dir():
+    """
+    Get the directory used to cache API responses.
+
+    Returns
+    -------
+    str
+        Path to the API response cache directory
+
+    Notes
+    -----
+    The directory can be set with the optional 'api_cache' entry of
+    bb_dirs.json. Otherwise, an 'api_cache' directory within the base
+    data directory is used.
+
+    See Also
+    --------
+    backyardbuoys_dataaccess.get_api_cache_stats : Cache hit/miss counts
+    """
+
+    # Load in the directory info json
+    dir_info = get_dirs_info()
+
+    # Use the configured cache directory, if there is one
+    if 'api_cache' in dir_info:
+        return dir_info['api_cache']
+
+    return os.path.join(dir_info['erddap_data'], 'api_cache')
+
+
 def load_googleinfo_json():
     """
     Load Google Sheets configuration information.
@@ -250,18 +404,13 @@ def load_googleinfo_json():
     backyardbuoys_build_metadata.get_all_qcdata : Retrieve QC limits from sheets
     """
     
-    # Get the current working directory to determine environment
-    basedir = os.path.dirname(__file__)
-    
     # Load in the directory info json
-    with open(os.path.join(basedir,'bb_dirs.json'), 'r') as dir_json:
-        dir_info = json.load(dir_json)
+    dir_info = get_dirs_info()
     # Get the base directory which contains the erddap data
     infodir = dir_info['info_jsons']
     
-    # Open and load the Google Sheets configuration JSON file
-    with open(os.path.join(infodir, 'google_info.json'), 'r') as f:
-        googleinfo = json.load(f)
+    # Load the Google Sheets configuration JSON file
+    googleinfo = load_json_file(os.path.join(infodir, 'google_info.json'))
     
     return googleinfo
 
@@ -316,23 +465,53 @@ def load_bbapi_info_json():
     backyardbuoys_dataaccess.bbapi_get_platform_data : Use platform data endpoint
     """
     
-    # Get the current working directory to determine environment
-    basedir = os.path.dirname(__file__)
-
     # Load in the directory info json
-    with open(os.path.join(basedir,'bb_dirs.json'), 'r') as dir_json:
-        dir_info = json.load(dir_json)
+    dir_info = get_dirs_info()
     
     # Get the base directory which contains the erddap data
     infodir = dir_info['info_jsons']
     
-    # Open and load the API configuration JSON file
-    with open(os.path.join(infodir, 'bbapi_info.json'), 'r') as f:
-        bbapiinfo = json.load(f)
+    # Load the API configuration JSON file
+    bbapiinfo = load_json_file(os.path.join(infodir, 'bbapi_info.json'))
     
     return bbapiinfo
 
 
+def load_user_info_json():
+    """
+    Load the user configuration information.
+
+    Loads the JSON configuration file containing the email settings used
+    to send error and new dataset reports.
+
+    Returns
+    -------
+    dict
+        Configuration dictionary with the email settings.
+
+        Expected structure:
+        {
+            'email_fromaddr': str,  # Sender address
+            'email_login': str,     # Email server login
+            'email_passwd': str,    # Email server password
+            'smtpserver': str       # Email server address
+        }
+
+    See Also
+    --------
+    send_emailreport : Send an email report
+    """
+
+    # Load in the directory info json
+    dir_info = get_dirs_info()
+    infodir = dir_info['info_jsons']
+
+    # Load the user configuration JSON file
+    userinfo = load_json_file(os.path.join(infodir, 'user_info.json'))
+
+    return userinfo
+
+
 def send_emailreport(msgtxt, subj, fromaddr=None, toaddr=None,
                      login=None, passwd=None, smtpserver=None, htmlflag=False):
     
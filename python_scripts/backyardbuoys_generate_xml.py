@@ -18,8 +18,6 @@ import backyardbuoys_general_functions as bb
 import backyardbuoys_dataaccess as bb_da
 import backyardbuoys_processdata as bb_process
 
-import json
-
 
 # In[ ]:
 
@@ -36,14 +34,8 @@ server in building out the datasets to post online.
 # Create a function to send error emails
 def send_newdataset_email(locName, smart_flag=False):
 
-    # Load in the directory info json
-    basedir = os.path.dirname(__file__)
-    with open(os.path.join(basedir,'bb_dirs.json'), 'r') as dir_json:
-        dir_info = json.load(dir_json)
-    # Get the base directory which contains the erddap data
-    infodir = dir_info['info_jsons']
-    with open(os.path.join(infodir, 'user_info.json'), 'r') as infofile:
-        user_info = json.load(infofile)
+    # Load in the user info json
+    user_info = bb.load_user_info_json()
 
     newdata_msg = "A new dataset has been added for location " + locName + ".\n\n"
     if smart_flag:
@@ -72,12 +64,8 @@ def get_datasetxml_dir():
     basedir - base directory path containing ERDDAP info files
     """
     
-    # Get the current working directory
-    basedir = os.path.dirname(__file__)
-
     # Load in the directory info json
-    with open(os.path.join(basedir,'bb_dirs.json'), 'r') as dir_json:
-        dir_info = json.load(dir_json)
+    dir_info = bb.get_dirs_info()
     # Get the base directory for the ERDDAP files
     xmldir = dir_info['erddap_files']
         
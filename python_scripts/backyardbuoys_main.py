@@ -15,6 +15,7 @@ Command-line Arguments:
     -l, --location  : Location ID or "all"
     -r, --rebuild   : Rebuild datasets from scratch (true/false)
     -q, --qctests   : Rerun quality control tests (true/false)
+    -w, --workers   : Number of locations to update at once (addData, "all")
 
 Example Usage:
     # Update data for a single location
@@ -23,6 +24,9 @@ Example Usage:
     # Rebuild all datasets with new QC tests
     python backyardbuoys_main.py -p addData -l all -r true -q true
     
+    # Update all locations, four at a time
+    python backyardbuoys_main.py -p addData -l all -w 4
+    
     # Add metadata for a location
     python backyardbuoys_main.py -p addMetadata -l gambell
     
@@ -34,8 +38,6 @@ Organization: Backyard Buoys
 """
 
 import datetime
-import json
-import os
 import sys
 import getopt
 import gc
@@ -44,6 +46,7 @@ import traceback
 
 # Import BackyardBuoys modules
 import backyardbuoys_general_functions as bb
+import backyardbuoys_dataaccess as bb_da
 import backyardbuoys_processdata as bb_process
 import backyardbuoys_build_metadata as bb_meta
 import backyardbuoys_generate_xml as bb_xml
@@ -80,12 +83,13 @@ def main():
     # ========================================================================
     try:
         # Parse options and arguments
-        # Short options: h, u, p:, l:, r:, t:, q:
-        # Long options: help, process=, location=, rebuild=, qctests=
+        # Short options: h, u, p:, l:, r:, t:, q:, w:, c:
+        # Long options: help, process=, location=, rebuild=, qctests=, workers=, apiCache=
         opts, args = getopt.getopt(
             sys.argv[1:], 
-            "hu:p:l:r:t:q:", 
-            ["help", "process=", "location=", "rebuild=", "rebuildPeriod=", "qctests="]
+            "hu:p:l:r:t:q:w:c:", 
+            ["help", "process=", "location=", "rebuild=", "rebuildPeriod=", "qctests=",
+             "workers=", "apiCache="]
         )
     except Exception as inst:
         # Print error if option parsing fails
@@ -101,6 +105,8 @@ def main():
     rebuildFlag = False         # Was -r/--rebuild provided?
     rebuildPeriodFlag = False   # Was -rp/--rebuildPeriod provided?
     qctestFlag = False          # Was -q/--qctests provided?
+    workersFlag = False         # Was -w/--workers provided?
+    apiCacheFlag = False        # Was -c/--apiCache provided?
 
     # ========================================================================
     # Process Each Command-Line Option
@@ -122,6 +128,8 @@ def main():
             print('   -r/rebuild')
             print('   -rp/rebuildPeriod')
             print('   -q/qctests')
+            print('   -w/workers')
+            print('   -c/apiCache')
             print('\n  "help":')
             print('     Help listing to provide information on using the project')
             print('\n  "process":')
@@ -149,6 +157,17 @@ def main():
             print('     Flags whether quality control tests for the datasets should be rerun.')
             print('     Note: this can only be used from the "addData" process')
             print('     Valid qctests flags are "true"/"false"')
+            print('\n  "workers":')
+            print('     (OPTIONAL) Number of locations to update at the same time,')
+            print('     each in a separate process. Output for each location is')
+            print('     written to {data directory}/{location}/logs/{location}_update.log')
+            print('     Note: this can only be used from the "addData" process with "-l all"')
+            print('     Valid workers values are positive integers (default is 1)')
+            print('\n  "apiCache":')
+            print('     (OPTIONAL) Flags whether responses from the Backyard Buoys API')
+            print('     should be cached on disk, so that repeated runs only pull the')
+            print('     data that is not already cached (including in each worker).')
+            print('     Valid apiCache flags are "true"/"false" (default is "false")')
             sys.exit()
             
         elif o in ("-p", "--process"):
@@ -175,6 +194,16 @@ def main():
             # Set QC test flag and store qctest option
             qctestFlag = True
             qctestName = a
+            
+        elif o in ("-w", "--workers"):
+            # Set workers flag and store workers option
+            workersFlag = True
+            workersName = a
+            
+        elif o in ("-c", "--apiCache"):
+            # Set API cache flag and store API cache option
+            apiCacheFlag = True
+            apiCacheName = a
         else:
             # Catch any unhandled options
             assert False, "unhandled option"
@@ -381,6 +410,53 @@ def main():
             qctestFlag = False
         
         
+    # ========================================================================
+    # Validate Workers Option
+    # ========================================================================
+    workers = 1
+    if workersFlag:
+        # Ensure that the number of workers is a positive integer
+        try:
+            workers = int(workersName)
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            print('Invalid option given for workers flag: ' + workersName)
+            print('Valid options are positive integers (e.g., "-w 4")')
+            print('\nPlease restart the program again, using a minimum syntax of:')
+            print("backyardbuoys_main -p <processName> -l <locationName>")
+            print('If you need addition options, please try:')
+            print("backyardbuoys_main -h")
+            # Exit the program unsuccessfully
+            sys.exit(2)
+            
+        # The workers flag is only used when updating all locations
+        if not((processName == 'addData') and locFlag and (locName.lower() == 'all')):
+            print('The workers flag can only be used for the "addData" process with "-l all".')
+            print('Flag will be ignored, and process will continue.')
+            workers = 1
+        
+        
+    # ========================================================================
+    # Validate API Cache Option
+    # ========================================================================
+    if apiCacheFlag:
+        # Convert the API cache option string to a boolean value
+        if apiCacheName.lower() == 'true':
+            bb_da.configure_api_cache(enabled=True)
+        elif apiCacheName.lower() == 'false':
+            bb_da.configure_api_cache(enabled=False)
+        else:
+            print('Invalid option given for apiCache flag: ' + apiCacheName)
+            print('Valid options include "true"/"false"')
+            print('\nPlease restart the program again, using a minimum syntax of:')
+            print("backyardbuoys_main -p <processName> -l <locationName>")
+            print('If you need addition options, please try:')
+            print("backyardbuoys_main -h")
+            # Exit the program unsuccessfully
+            sys.exit(2)
+        
+        
     # ================================================ #
     # Determine that the location is valid, and check  #
     # if the location is "all"                         #
@@ -438,14 +514,8 @@ def main():
     # Create a function to send error emails
     def send_error_email(processName, locName, e):
 
-        # Load in the directory info json
-        basedir = os.path.dirname(__file__)
-        with open(os.path.join(basedir,'bb_dirs.json'), 'r') as dir_json:
-            dir_info = json.load(dir_json)
-        # Get the base directory which contains the erddap data
-        infodir = dir_info['info_jsons']
-        with open(os.path.join(infodir, 'user_info.json'), 'r') as infofile:
-            user_info = json.load(infofile)
+        # Load in the user info json
+        user_info = bb.load_user_info_json()
 
         error_msg = "An error occured while performing " + processName + " for location " + locName + ".\n\n" + "Error message:\n" + str(e)
         error_sbj = "Backyard Buoys - Error in " + processName + "; Location: " + locName
@@ -473,7 +543,8 @@ def main():
                 # Update data for all active locations
                 bb_process.update_all_locations(
                     rebuild_flag=rebuildFlag, 
-                    rerun_tests=qctestFlag
+                    rerun_tests=qctestFlag,
+                    workers=workers
                 )
             else:
                 # Update data for a single location
@@ -546,6 +617,12 @@ def main():
         sys.exit(2)
 
 
+    # Report on the API connections and files used during this run
+    bb_da.print_http_stats()
+    bb_da.print_api_cache_stats()
+    bb.print_file_read_stats()
+    bb_process.print_netcdf_write_stats()
+
     # Exit the program successfully
     sys.exit(0)
 
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+BackyardBuoys ERDDAP - Pipeline State
+=====================================
+
+This module keeps the state of the processing pipeline in a small SQLite
+database in the data directory (backyardbuoys_pipeline_state.db), so that a
+processing run can tell where to resume pulling the data of a location, and
+whether there is anything new to process, without opening its netCDF files.
+
+For each location and data stream ('spotter' for the surface data, 'smart'
+for the smart mooring data), the state records:
+
+    - last_ingested : time of the last record written to the netCDF files
+    - last_success : time of the last successful run
+    - qc_config_hash : hash of the QC limits used in the last successful run
+    - qc_time_interval : median time step (in seconds) of the data the QC
+      tests were run on in the last successful run
+
+and for each spotter of a location, its authorization to archive its data
+and to share it with NDBC/NWS, as of the last successful run. The time each
+location took to process in its last run is also kept, to estimate the time
+saved by skipping locations with no new data.
+
+Key Functions:
+    - get_state_path() : Path of the pipeline state database
+    - get_stream_state() : Get the state of a data stream of a location
+    - record_stream_state() : Record a successful run of a data stream
+    - get_spotter_authorizations() : Get the recorded spotter authorizations of a location
+    - record_spotter_authorizations() : Record the spotter authorizations of a location
+    - get_run_seconds() : Get the time a location took to process in its last run
+    - record_run_seconds() : Record the time a location took to process
+    - qc_config_hash() : Hash of a set of QC limits
+
+Example Usage:
+    import backyardbuoys_pipeline_state as bb_state
+
+    state = bb_state.get_stream_state('location_id', 'spotter')
+    if state is not None:
+        print(state['last_ingested'])
+
+Organization: Backyard Buoys
+"""
+
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+
+import backyardbuoys_general_functions as bb
+
+
+# Constants
+STATE_FILENAME = 'backyardbuoys_pipeline_state.db'  # Database file, in the data directory
+STATE_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'  # ISO 8601 format for the stored times
+STATE_TIMEOUT = 30  # Seconds to wait for a database lock (e.g., held by another worker)
+STREAMS = ['spotter', 'smart']  # Data streams of a location
+
+_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stream_state (
+    loc_id TEXT NOT NULL,
+    stream TEXT NOT NULL,
+    last_ingested TEXT,
+    last_success TEXT,
+    qc_config_hash TEXT,
+    qc_time_interval REAL,
+    PRIMARY KEY (loc_id, stream)
+);
+CREATE TABLE IF NOT EXISTS spotter_state (
+    loc_id TEXT NOT NULL,
+    spotter_id TEXT NOT NULL,
+    can_data_archive TEXT,
+    can_share_ndbc_nws TEXT,
+    updated TEXT,
+    PRIMARY KEY (loc_id, spotter_id)
+);
+CREATE TABLE IF NOT EXISTS location_state (
+    loc_id TEXT NOT NULL PRIMARY KEY,
+    last_run TEXT,
+    last_run_seconds REAL
+);
+"""
+
+
+# ============================================================================
+# Database
+# ============================================================================
+
+def get_state_path():
+    """
+    Path of the pipeline state database.
+
+    Returns
+    -------
+    str
+        Path of the database, in the base data directory
+    """
+
+    return os.path.join(bb.get_datadir(), STATE_FILENAME)
+
+
+def _connect():
+
+    # Open the database (creating it, and its tables, if need be).
+    # Each call opens its own connection, so that the state can be
+    # used from the worker processes of update_all_locations.
+    connection = sqlite3.connect(get_state_path(), timeout=STATE_TIMEOUT)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(_STATE_SCHEMA)
+
+    # Add the columns added since a database was created
+    columns = [row['name'] for row in connection.execute('PRAGMA table_info(stream_state)')]
+    if 'qc_time_interval' not in columns:
+        with connection:
+            connection.execute('ALTER TABLE stream_state ADD COLUMN qc_time_interval REAL')
+
+    return connection
+
+
+def _format_time(time):
+
+    # Format a datetime (or None) for storage
+    if time is None:
+        return None
+    if getattr(time, 'tzinfo', None) is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return time.strftime(STATE_DATETIME_FORMAT)
+
+
+def _parse_time(time_str):
+
+    # Parse a stored time (or None) into a datetime
+    if time_str is None:
+        return None
+
+    return datetime.datetime.strptime(time_str, STATE_DATETIME_FORMAT)
+
+
+# ============================================================================
+# Data Streams
+# ============================================================================
+
+def get_stream_state(loc_id, stream='spotter'):
+    """
+    Get the state of a data stream of a location.
+
+    Parameters
+    ----------
+    loc_id : str
+        Location ID
+    stream : str, optional
+        Data stream ('spotter' or 'smart')
+
+    Returns
+    -------
+    dict or None
+        'last_ingested' and 'last_success' (datetimes, in UTC),
+        'qc_config_hash', and 'qc_time_interval', or None if no run
+        has been recorded
+    """
+
+    if not(os.path.exists(get_state_path())):
+        return None
+
+    with contextlib.closing(_connect()) as connection:
+        row = connection.execute('SELECT last_ingested, last_success, qc_config_hash, qc_time_interval '
+                                 'FROM stream_state WHERE loc_id = ? AND stream = ?',
+                                 (loc_id, stream)).fetchone()
+    if row is None:
+        return None
+
+    return {'last_ingested': _parse_time(row['last_ingested']),
+            'last_success': _parse_time(row['last_success']),
+            'qc_config_hash': row['qc_config_hash'],
+            'qc_time_interval': row['qc_time_interval']}
+
+
+def record_stream_state(loc_id, stream, last_ingested, qc_hash=None, last_success=None,
+                        qc_time_interval=None):
+    """
+    Record a successful run of a data stream of a location.
+
+    Parameters
+    ----------
+    loc_id : str
+        Location ID
+    stream : str
+        Data stream ('spotter' or 'smart')
+    last_ingested : datetime.datetime
+        Time of the last record written to the netCDF files
+    qc_hash : str, optional
+        Hash of the QC limits used in the run (see qc_config_hash)
+    last_success : datetime.datetime, optional
+        Time of the run (default: now)
+    qc_time_interval : float, optional
+        Median time step (in seconds) of the data the QC tests were run on
+    """
+
+    if last_success is None:
+        last_success = datetime.datetime.now(datetime.timezone.utc)
+
+    with contextlib.closing(_connect()) as connection:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO stream_state '
+                               '(loc_id, stream, last_ingested, last_success, qc_config_hash, '
+                               'qc_time_interval) VALUES (?, ?, ?, ?, ?, ?)',
+                               (loc_id, stream, _format_time(last_ingested),
+                                _format_time(last_success), qc_hash, qc_time_interval))
+
+
+# ============================================================================
+# Spotter Authorizations
+# ============================================================================
+
+def get_spotter_authorizations(loc_id):
+    """
+    Get the spotter authorizations of a location, as of the last
+    successful run.
+
+    Parameters
+    ----------
+    loc_id : str
+        Location ID
+
+    Returns
+    -------
+    dict
+        {spotter ID: {'can_data_archive': ..., 'can_share_ndbc_nws': ...}}
+    """
+
+    if not(os.path.exists(get_state_path())):
+        return {}
+
+    with contextlib.closing(_connect()) as connection:
+        rows = connection.execute('SELECT spotter_id, can_data_archive, can_share_ndbc_nws '
+                                  'FROM spotter_state WHERE loc_id = ?', (loc_id,)).fetchall()
+
+    return {row['spotter_id']: {'can_data_archive': row['can_data_archive'],
+                                'can_share_ndbc_nws': row['can_share_ndbc_nws']}
+            for row in rows}
+
+
+def record_spotter_authorizations(loc_id, authorizations):
+    """
+    Record the spotter authorizations of a location, replacing
+    those recorded before.
+
+    Parameters
+    ----------
+    loc_id : str
+        Location ID
+    authorizations : dict
+        {spotter ID: {'can_data_archive': ..., 'can_share_ndbc_nws': ...}}
+    """
+
+    updated = _format_time(datetime.datetime.now(datetime.timezone.utc))
+    with contextlib.closing(_connect()) as connection:
+        with connection:
+            connection.execute('DELETE FROM spotter_state WHERE loc_id = ?', (loc_id,))
+            connection.executemany('INSERT INTO spotter_state '
+                                   '(loc_id, spotter_id, can_data_archive, can_share_ndbc_nws, updated) '
+                                   'VALUES (?, ?, ?, ?, ?)',
+                                   [(loc_id, spotter, auth.get('can_data_archive'),
+                                     auth.get('can_share_ndbc_nws'), updated)
+                                    for spotter, auth in authorizations.items()])
+
+
+# ============================================================================
+# Run Times
+# ============================================================================
+
+def get_run_seconds(loc_id):
+    """
+    Get the time a location took to process in its last run.
+
+    Parameters
+    ----------
+    loc_id : str
+        Location ID
+
+    Returns
+    -------
+    float or None
+        Processing time (s), or None if no run has been recorded
+    """
+
+    if not(os.path.exists(get_state_path())):
+        return None
+
+    with contextlib.closing(_connect()) as connection:
+        row = connection.execute('SELECT last_run_seconds FROM location_state WHERE loc_id = ?',
+                                 (loc_id,)).fetchone()
+    if row is None:
+        return None
+
+    return row['last_run_seconds']
+
+
+def record_run_seconds(loc_id, run_seconds):
+    """
+    Record the time a location took to process.
+
+    Parameters
+    ----------
+    loc_id : str
+        Location ID
+    run_seconds : float
+        Processing time (s)
+    """
+
+    last_run = _format_time(datetime.datetime.now(datetime.timezone.utc))
+    with contextlib.closing(_connect()) as connection:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO location_state '
+                               '(loc_id, last_run, last_run_seconds) VALUES (?, ?, ?)',
+                               (loc_id, last_run, float(run_seconds)))
+
+
+# ============================================================================
+# QC Configuration
+# ============================================================================
+
+def qc_config_hash(qc_limits):
+    """
+    Hash of a set of QC limits (e.g., the compiled QARTOD limits of a
+    location), which changes whenever any of the limits change.
+
+    Parameters
+    ----------
+    qc_limits : dict
+        QC limits
+
+    Returns
+    -------
+    str
+        Hex digest of the limits
+    """
+
+    qc_json = json.dumps(qc_limits, sort_keys=True, default=str)
+
+    return hashlib.sha256(qc_json.encode()).hexdigest()
@@ -10,30 +10,28 @@ import shutil
 import numpy as np
 import pandas as pd
 import requests
-import xarray as xr
-
-import netCDF4
-from netCDF4 import Dataset
 
 import os
 import sys
 import getopt
 import gc
+import contextlib
+import concurrent.futures
+import multiprocessing
+import time
+import warnings
 
 import json
+import hashlib
 
 
-import ioos_qc
-from ioos_qc import qartod
-from ioos_qc.config import Config
-from ioos_qc.streams import PandasStream
-from ioos_qc.stores import PandasStore
-
 import backyardbuoys_general_functions as bb    
 import backyardbuoys_qualitycontrol as bb_qc
+import backyardbuoys_qcflags as bb_flags
 import backyardbuoys_dataaccess as bb_da
 import backyardbuoys_build_metadata as bb_meta
 import backyardbuoys_generate_xml as bb_xml
+import backyardbuoys_pipeline_state as bb_state
 
 
 
@@ -42,24 +40,154 @@ from importlib import reload
 # Constants
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'  # ISO 8601 format for timestamps
 LOG_DATETIME_FORMAT = '%Y-%b-%d %H:%M:%S'  # Format for log messages
+REBUILD_FETCH_WORKERS = 24  # Max concurrent (spotter, window) requests during a rebuild
+INCREMENTAL_QC = False  # On updates, recompute QC flags only from the new data onward
+APPEND_NETCDF = False  # Write monthly files with an unlimited time dimension, and append new records to them
+APPEND_NETCDF_IN_PLACE = False  # Append into the published file itself, rather than into a copy that replaces it (ERDDAP may read a partly appended file)
+NETCDF_TIME_CHUNK = 1024  # Records per chunk along an unlimited time dimension
+NETCDF_APPEND_BLOCK = 256  # Records per block fingerprint in the netCDF index (used to find the records to rewrite when appending)
+NETCDF_ENCODING = 'default'  # Encoding profile of the netCDF files (from NETCDF_ENCODING_PROFILES)
+PIPELINE_STATE = False  # On updates, get the pull window from the pipeline state (not the netCDF files), and skip locations with no new data
+REBUILD_WINDOW_MONTHS = None  # Months of data pulled, processed, and written at a time in rebuilds (None: the whole record at once)
+
+# Encoding profiles of the netCDF files. Each profile may set:
+#   'zlib', 'complevel', 'shuffle' - zlib compression of the variables along time
+#   'time_chunk' - records per chunk along time (None: one chunk for the whole
+#                  file, as ERDDAP reads all of a variable from each file)
+#   'datatypes'  - {part of a variable name: data type}, to store variables
+#                  in smaller types than the f8 data and i4 QC flags
+#                  (the first part found in the name is used)
+# Each chunked variable adds a few kB of chunk index to a file, so
+# compression only pays off for files with more records than a
+# month of half-hourly data (see the netcdf_encoding benchmark).
+NETCDF_ENCODING_PROFILES = {
+    'default': {},
+    'compact': {'datatypes': {'_qc_': 'i1', 'sea_surface_wave_': 'f4'}},
+    'compressed': {'zlib': True, 'complevel': 4, 'shuffle': True, 'time_chunk': None},
+    'compressed_compact': {'zlib': True, 'complevel': 4, 'shuffle': True, 'time_chunk': None,
+                           'datatypes': {'_qc_': 'i1', 'sea_surface_wave_': 'f4'}},
+}
+
+# Counts of the monthly netCDF files written, and skipped as unchanged
+_netcdf_write_stats = {'written': 0, 'skipped': 0}
+
+# The netCDF indexes (by path) checked against the data directories
+# during this run (see load_netcdf_index)
+_netcdf_index_checked = set()
 
 # # General Functions
 
 # In[ ]:
 
 
+def datetime64_to_epoch(times):
+
+    # Convert datetime64 times into seconds since 1970-01-01, as
+    # floats (with NaN for missing times), for all of the times at
+    # once, from the int64 nanoseconds of the times. The whole seconds
+    # and the fractions of a second are converted separately, so
+    # that whole seconds are exact.
+    times = np.asarray(times).astype('datetime64[ns]')
+    times_ns = times.view('int64')
+    seconds = (times_ns // 10**9) + (times_ns % 10**9)/1e9
+
+    return np.where(np.isnat(times), np.nan, seconds)
+
+
+# In[ ]:
+
+
+def format_time_range(times):
+
+    # Format the first and last of a set of (sorted) times for the
+    # log, e.g., '2024-01-01T00:00:00Z - 2024-01-31T23:30:00Z'
+    times = np.asarray(times)[[0, -1]].astype('datetime64[s]')
+
+    return ' - '.join([ii + 'Z' for ii in np.datetime_as_string(times)])
+
+
+# In[ ]:
+
+
+def load_netcdf_files(ncpaths):
+
+    # Load a set of netCDF files into a single dataset. The files
+    # are read in full, as the months loaded are written again
+    # with the new data.
+    #
+    # The variables along time are read straight into arrays that
+    # hold all of the files, rather than concatenating the files
+    # (which copies the data read so far for every file), so the
+    # peak memory is little more than that of the loaded dataset.
+    #
+    # Returns None if there is no data in the files.
+
+    # xarray and netCDF4 are imported within the functions that use
+    # them, so that they are not loaded for every command line call
+    import xarray as xr
+
+    ds_files = []
+    try:
+        # Open each file, keeping those with any data
+        ds_parts = []
+        for ncpath in ncpaths:
+            ds_file = xr.open_dataset(ncpath)
+            ds_files.append(ds_file)
+            if ds_file.sizes.get('time', 0) > 0:
+                ds_parts.append(ds_file)
+
+        if len(ds_parts) == 0:
+            return None
+        if any([set(ds_part.variables) != set(ds_parts[0].variables) for ds_part in ds_parts]):
+            # If the files have different variables, let
+            # xarray fill in the missing variables
+            ds = xr.concat([ds_part.load() for ds_part in ds_parts], dim='time')
+        else:
+            # Read each variable along time from each file
+            # into its place in a single array
+            ntimes = [ds_part.sizes['time'] for ds_part in ds_parts]
+            offsets = np.concatenate([[0], np.cumsum(ntimes)])
+            ds = xr.Dataset(coords={name: ds_parts[0][name].variable.load()
+                                    for name in ds_parts[0].coords if 'time' not in ds_parts[0][name].dims},
+                            attrs=ds_parts[0].attrs)
+            for varname, var in ds_parts[0].variables.items():
+                if 'time' not in var.dims:
+                    continue
+                axis = var.dims.index('time')
+                shape = list(var.shape)
+                shape[axis] = int(offsets[-1])
+                values = np.empty(shape, dtype=np.result_type(*[ds_part[varname].dtype
+                                                                for ds_part in ds_parts]))
+                for ds_part, start, end in zip(ds_parts, offsets[:-1], offsets[1:]):
+                    index = [slice(None)]*len(shape)
+                    index[axis] = slice(int(start), int(end))
+                    values[tuple(index)] = ds_part[varname].to_numpy()
+                variable = xr.Variable(var.dims, values, attrs=var.attrs, encoding=var.encoding)
+                if varname in ds_parts[0].coords:
+                    ds = ds.assign_coords({varname: variable})
+                else:
+                    ds[varname] = variable
+    finally:
+        for ds_file in ds_files:
+            ds_file.close()
+
+    if not(ds.indexes['time'].is_monotonic_increasing):
+        ds = ds.sortby('time')
+
+    return ds
+
+
+# In[ ]:
+
+
 def load_existing_netcdf(loc_id, rebuild_period=None):
 
     # If rebuild_period is specified, it should be a list of up to two datetime objects
 
     
-    # Get the directory containing the data
-    basedir = bb.get_datadir()
-    datadir = os.path.join(basedir, loc_id)
-    if os.path.exists(os.path.join(basedir, loc_id + '_smart')):
-        smartdir = os.path.join(basedir, loc_id + '_smart') 
-    else:
-        smartdir = None
+    # Get the monthly netCDF files of the location (and the
+    # directories they are in) from the netCDF index
+    netcdf_index = load_netcdf_index(loc_id)
     
     # Initialize a flag, indicating if their is
     # older data than the data returned
@@ -68,23 +196,18 @@ def load_existing_netcdf(loc_id, rebuild_period=None):
     olderFlag = False
     
     
-    # Check the base data directories
-    if not(os.path.exists(datadir)):
+    # Check for the base data files
+    # (excluding the smart mooring files)
+    datafiles = sorted([ii for ii in netcdf_index
+                        if not(parse_netcdf_filename(loc_id, ii)[2])])
+    if len(datafiles) == 0:
         print('No data file exists')
         ds = None
     else:
-    
-        # Create a file list of all the existing netCDFs
-        # that correspond to the datafile
-        # Exclude smart mooring files (those with '_smart' in the filename)
-        datafiles = sorted([ii for ii in os.listdir(datadir) 
-                            if (loc_id in ii) and ('.nc' in ii) and ('_smart' not in ii)])
 
-        # Extract out the data year for all the files
-        dataperiods = [ii[3+len(loc_id)+1:ii.find('.nc')]
-                       for ii in datafiles]
-        datayears = [int(ii[:4]) for ii in dataperiods]
-        datamonths = [int(ii[4:]) for ii in dataperiods]
+        # Extract out the data year and month for all the files
+        datayears = [parse_netcdf_filename(loc_id, ii)[0] for ii in datafiles]
+        datamonths = [parse_netcdf_filename(loc_id, ii)[1] for ii in datafiles]
 
         # Find the most recent year, with a maximum prior
         # year being one year before the current year
@@ -107,15 +230,9 @@ def load_existing_netcdf(loc_id, rebuild_period=None):
                     datafiles = [datafiles[ii] for ii in np.where(valid_rebuild_files)[0]]
                     datadates = [datadates[ii] for ii in np.where(valid_rebuild_files)[0]]
 
-                    ds = None
-                    for datafile in datafiles:
-                        ds_temp = xr.load_dataset(os.path.join(datadir, datafile))
-                        if ds is None:
-                            ds = ds_temp
-                        else:
-                            ds = xr.concat([ds, ds_temp], dim='time')
+                    ds = load_netcdf_files([get_netcdf_path(loc_id, datafile, netcdf_index)
+                                            for datafile in datafiles])
                     if ds is not None:
-                        ds = ds.sortby('time')
                         olderFlag = True
                 else:
                     print('No data files found within the specified rebuild period.')
@@ -128,11 +245,12 @@ def load_existing_netcdf(loc_id, rebuild_period=None):
                     olderFlag = True
 
                 print('Loading in data from "' + lastfile + '"')
-                ds = xr.load_dataset(os.path.join(datadir, lastfile))
+                ds = load_netcdf_files([get_netcdf_path(loc_id, lastfile, netcdf_index)])
             
-            dimnames = [ii for ii in ds.dims]
-            varnames = [ii for ii in ds.data_vars]
-            if (len(dimnames) == 0) and (len(varnames) == 0):
+            if ds is None:
+                print('ERROR! Old data file has no data!')
+                print('Do not load in this data file.')
+            elif (len(ds.dims) == 0) and (len(ds.data_vars) == 0):
                 print('ERROR! Old data file has no dimensions or variables!')
                 print('Do not load in this data file.')
                 ds = None
@@ -143,33 +261,16 @@ def load_existing_netcdf(loc_id, rebuild_period=None):
     
     
     
-    # Check the base data directories
-    if smartdir is None:
-        # Check if smart files exist in the main directory
-        if os.path.exists(datadir):
-            smart_files = [ii for ii in os.listdir(datadir) 
-                          if (loc_id in ii) and ('.nc' in ii) and ('_smart' in ii)]
-            if len(smart_files) > 0:
-                smartdir = datadir
-            else:
-                ds_smart = None
-        else:
-            ds_smart = None
-    
-    if smartdir is not None:
-    
-        # Create a file list of all the existing netCDFs
-        # that correspond to the smart mooring datafile
-        datafiles = sorted([ii for ii in os.listdir(smartdir) 
-                            if (loc_id in ii) and ('.nc' in ii) and ('_smart' in ii)])
+    # Check for the smart mooring data files
+    datafiles = sorted([ii for ii in netcdf_index
+                        if parse_netcdf_filename(loc_id, ii)[2]])
+    if len(datafiles) == 0:
+        ds_smart = None
+    else:
 
-        # Extract out the data year for all the files
-        # Smart files are named like: bb_<loc_id>_smart_<YYYYMM>.nc
-        # So we need to skip past 'bb_', loc_id, and '_smart_' to get the period
-        dataperiods = [ii[3+len(loc_id)+7:ii.find('.nc')]
-                       for ii in datafiles]
-        datayears = [int(ii[:4]) for ii in dataperiods]
-        datamonths = [int(ii[4:]) for ii in dataperiods]
+        # Extract out the data year and month for all the files
+        datayears = [parse_netcdf_filename(loc_id, ii)[0] for ii in datafiles]
+        datamonths = [parse_netcdf_filename(loc_id, ii)[1] for ii in datafiles]
 
         # Find the most recent year, with a maximum prior
         # year being one year before the current year
@@ -192,15 +293,9 @@ def load_existing_netcdf(loc_id, rebuild_period=None):
                     datafiles = [datafiles[ii] for ii in np.where(valid_rebuild_files)[0]]
                     datadates = [datadates[ii] for ii in np.where(valid_rebuild_files)[0]]
 
-                    ds_smart = None
-                    for datafile in datafiles:
-                        ds_temp = xr.load_dataset(os.path.join(smartdir, datafile))
-                        if ds_smart is None:
-                            ds_smart = ds_temp
-                        else:
-                            ds_smart = xr.concat([ds_smart, ds_temp], dim='time')
+                    ds_smart = load_netcdf_files([get_netcdf_path(loc_id, datafile, netcdf_index)
+                                                  for datafile in datafiles])
                     if ds_smart is not None:
-                        ds_smart = ds_smart.sortby('time')
                         olderFlag = True
                 else:
                     print('No smart data files found within the specified rebuild period.')
@@ -213,11 +308,12 @@ def load_existing_netcdf(loc_id, rebuild_period=None):
                     olderFlag = True
 
                 print('Loading in data from "' + lastfile + '"')
-                ds_smart = xr.load_dataset(os.path.join(smartdir, lastfile))
+                ds_smart = load_netcdf_files([get_netcdf_path(loc_id, lastfile, netcdf_index)])
             
-            dimnames = [ii for ii in ds.dims]
-            varnames = [ii for ii in ds.data_vars]
-            if (len(dimnames) == 0) and (len(varnames) == 0):
+            if ds_smart is None:
+                print('ERROR! Old smartdata file has no data!')
+                print('Do not load in this data file.')
+            elif (len(ds_smart.dims) == 0) and (len(ds_smart.data_vars) == 0):
                 print('ERROR! Old smartdata file has no dimensions or variables!')
                 print('Do not load in this data file.')
                 ds_smart = None
@@ -229,475 +325,500 @@ def load_existing_netcdf(loc_id, rebuild_period=None):
     return ds, ds_smart, olderFlag
 
 
+# # Pipeline State Functions
+
+# In[ ]:
+
+
+def get_qc_config_hash(loc_id, smartflag=False):
+
+    # Get the hash of the QC limits of a location (see
+    # bb_state.qc_config_hash), or None if the location
+    # has no QC limits file
+    try:
+        qc_limits = bb_qc.get_compiled_qc_limits(loc_id, smartflag)
+    except FileNotFoundError:
+        return None
+
+    return bb_state.qc_config_hash(qc_limits)
+
+
+# In[ ]:
+
+
+def get_qc_time_interval(ds_xr):
+
+    # Get the median time step (in seconds) of a dataset, with
+    # which the flat line test converts its time periods into a
+    # number of observations (see bb_qc.qartod_time_interval)
+    return bb_qc.qartod_time_interval(bb_qc.qartod_time_seconds(ds_xr['time'].to_numpy()))
+
+
+# In[ ]:
+
+
+def check_qc_state(loc_id, time_interval, smartflag=False):
+
+    # Check if the QC flags of the existing data of a location can be
+    # kept, when the tests are only rerun from the new data onward
+    # (see rerun_qc_tests_since): if, per the pipeline state, the last
+    # run used the same QC limits, and the same median time step of
+    # the data the tests were run on, as the tests would be run with
+    # now. Without the pipeline state, the flags cannot be checked.
+    if not(PIPELINE_STATE):
+        return False
+    stream_state = bb_state.get_stream_state(loc_id, 'smart' if smartflag else 'spotter')
+    if stream_state is None:
+        return False
+
+    return ((stream_state['qc_config_hash'] == get_qc_config_hash(loc_id, smartflag)) and
+            (stream_state['qc_time_interval'] == time_interval))
+
+
+# In[ ]:
+
+
+def load_spotter_authorizations(loc_id):
+
+    # Get the authorization of each spotter of a location to
+    # archive its data, and to share it with NDBC/NWS, from
+    # the metadata info json of the location
+    basedir = bb.get_datadir()
+    infodir = os.path.join(basedir, loc_id, 'metadata', loc_id +'_info.json')
+    if not(os.path.exists(infodir)):
+        return {}
+    infodict = bb.load_json_file(infodir)
+    if 'spotter_data' not in infodict.keys():
+        return {}
+
+    return {spotter: {'can_data_archive': spotter_data.get('can_data_archive'),
+                      'can_share_ndbc_nws': spotter_data.get('can_share_ndbc_nws')}
+            for spotter, spotter_data in infodict['spotter_data'].items()}
+
+
+# In[ ]:
+
+
+def get_state_pull_window(loc_id):
+
+    # Get the time from which to pull new data for a location,
+    # in the same way as process_newdata does from the last
+    # monthly netCDF file, but from the pipeline state and the
+    # netCDF index, without opening any netCDF files.
+    #
+    # Returns a dictionary with the pull start time ('pull_starttime')
+    # and the last time of the existing data ('lasttime'), or None
+    # if the state of the location is not known, or does not match
+    # the netCDF files (e.g., if files were written after the state
+    # was last recorded), in which case the files are used.
+    netcdf_index = load_netcdf_index(loc_id)
+    curyear = datetime.datetime.now().year
+
+    lasttimes = []
+    for stream, smartflag in [('spotter', False), ('smart', True)]:
+        # Find the most recent monthly file of the stream,
+        # from no earlier than the year before the current year
+        datafiles = sorted([ii for ii in netcdf_index
+                            if (parse_netcdf_filename(loc_id, ii)[2] == smartflag) and
+                               (parse_netcdf_filename(loc_id, ii)[0] >= curyear-1)],
+                           key=lambda ii: parse_netcdf_filename(loc_id, ii)[:2])
+        if len(datafiles) == 0:
+            if smartflag:
+                continue
+            return None
+        lastfile = netcdf_index[datafiles[-1]]
+
+        stream_state = bb_state.get_stream_state(loc_id, stream)
+        if ((stream_state is None) or (stream_state['last_ingested'] is None) or
+            (lastfile['time_coverage_end'] is None) or
+            (stream_state['last_ingested'].strftime(DATETIME_FORMAT) != lastfile['time_coverage_end'])):
+            return None
+        lasttimes.append(stream_state['last_ingested'])
+
+        if not(smartflag):
+            firsttime = datetime.datetime.strptime(lastfile['time_coverage_start'], DATETIME_FORMAT)
+            olderFlag = len(datafiles) > 1
+
+    # Pull data since the later of the start of the data record,
+    # or the start of the day prior to the day of the latest data
+    lasttime = min(lasttimes)
+    if olderFlag:
+        firstshift = datetime.timedelta(hours=12)
+    else:
+        firstshift = datetime.timedelta(hours=0)
+    pull_starttime = max([firsttime-firstshift,
+                          (lasttime.replace(hour=0,minute=0,second=0,microsecond=0)
+                           - datetime.timedelta(hours=12))])
+
+    return {'pull_starttime': pull_starttime, 'lasttime': lasttime}
+
+
+# In[ ]:
+
+
+def check_for_new_data(loc_id, newest_times):
+
+    # Check if a location has anything to add to the data already
+    # processed, per the pipeline state, given the time of the newest
+    # data of each stream ({'spotter': ..., 'smart': ...}, in UTC;
+    # None, or missing, if the stream has no data): any data newer
+    # than the last data ingested for each stream, or any change to
+    # the QC limits or spotter authorizations (which change the
+    # existing data) since the last run.
+    #
+    # Note that data only added (or changed) in the API for times
+    # that were already ingested is picked up on the next run with
+    # newer data, as the pull window always overlaps the last day.
+    newest_times = {stream: newest_time for stream, newest_time in newest_times.items()
+                    if newest_time is not None}
+    if len(newest_times) == 0:
+        return True
+    for stream, newest_time in newest_times.items():
+        stream_state = bb_state.get_stream_state(loc_id, stream)
+        if (stream_state is None) or (stream_state['last_ingested'] is None):
+            return True
+        if pd.Timestamp(newest_time) > pd.Timestamp(stream_state['last_ingested']):
+            return True
+        if stream_state['qc_config_hash'] != get_qc_config_hash(loc_id, smartflag=(stream == 'smart')):
+            return True
+
+    if bb_state.get_spotter_authorizations(loc_id) != load_spotter_authorizations(loc_id):
+        return True
+
+    return False
+
+
+# In[ ]:
+
+
+def get_newest_data_times(loc_info):
+
+    # Get the time of the newest data of each stream of a location
+    # ({'spotter': ..., 'smart': ...}, as UTC datetimes), from its
+    # entry in bb_da.bbapi_get_locations(recentFlag=True), which
+    # holds the most recent record of each variable ('data').
+    # Records below the surface are smart mooring data.
+    newest_times = {}
+    for record in loc_info.get('data', []):
+        if record.get('timestamp') is None:
+            continue
+        stream = 'smart' if record.get('depth', 0) not in [0, None] else 'spotter'
+        record_time = datetime.datetime(1970,1,1) + datetime.timedelta(seconds=float(record['timestamp']))
+        if (stream not in newest_times) or (record_time > newest_times[stream]):
+            newest_times[stream] = record_time
+
+    return newest_times
+
+
+# In[ ]:
+
+
+def skip_unchanged_locations(loc_ids):
+
+    # Before updating a set of locations, find those with nothing
+    # new to process: those whose newest data, per a single
+    # bb_da.bbapi_get_locations(recentFlag=True) request, is no newer
+    # than the last data ingested (with unchanged QC limits and spotter
+    # authorizations; see check_for_new_data). Locations with no
+    # recent data, or whose pipeline state is not known (or does not
+    # match their netCDF files), are always updated.
+    #
+    # Returns the locations to update, the locations skipped, and
+    # the time the skipped locations took to process in their last
+    # runs (an estimate of the time saved).
+    recent_locs = bb_da.bbapi_get_locations(recentFlag=True)
+
+    update_locs = []
+    skipped_locs = []
+    saved_seconds = 0
+    for loc_id in loc_ids:
+        if ((loc_id not in recent_locs) or
+            (get_state_pull_window(loc_id) is None)):
+            update_locs.append(loc_id)
+            continue
+
+        newest_times = get_newest_data_times(recent_locs[loc_id])
+        if check_for_new_data(loc_id, newest_times):
+            update_locs.append(loc_id)
+            continue
+
+        print(loc_id + ': No new data since ' + 
+              bb_state.get_stream_state(loc_id, 'spotter')['last_ingested'].strftime(DATETIME_FORMAT) + 
+              '. Skip this location.')
+        skipped_locs.append(loc_id)
+        run_seconds = bb_state.get_run_seconds(loc_id)
+        if run_seconds is not None:
+            saved_seconds += run_seconds
+
+    return update_locs, skipped_locs, saved_seconds
+
+
+# In[ ]:
+
+
+def record_pipeline_state(loc_id, qc_time_intervals=None):
+
+    # Record the state of a location after its netCDF files have
+    # been written: for each stream, the last time in the files
+    # (from the netCDF index), the QC limits, and the median time
+    # step of the data the QC tests were run on (qc_time_intervals,
+    # keyed by the smart mooring flag), and the spotter authorizations
+    if qc_time_intervals is None:
+        qc_time_intervals = {}
+    for stream, smartflag in [('spotter', False), ('smart', True)]:
+        time_bounds = get_netcdf_time_bounds(loc_id, smartflag)
+        if time_bounds is not None:
+            bb_state.record_stream_state(loc_id, stream, time_bounds[1],
+                                         get_qc_config_hash(loc_id, smartflag),
+                                         qc_time_interval=qc_time_intervals.get(smartflag))
+    bb_state.record_spotter_authorizations(loc_id, load_spotter_authorizations(loc_id))
+
+
 # # Data processing function
 
 # In[ ]:
 
 
-def get_data_by_location(location_id, vars_to_get = 'ALL', 
+def pivot_observations(api_data, key_cols=('timestamp', 'platform_id')):
+
+    # This function is used to convert the variable data returned
+    # by the Backyard Buoys API (one record per variable, per
+    # observation) into "wide" dataframes, with one row per
+    # observation and one column per variable.
+    #
+    # Surface measurements (depth = 0) go into the surface dataframe,
+    # and subsurface measurements (depth != 0) go into the smart mooring
+    # dataframe. Observations are keyed by their integer timestamp and
+    # platform ID (and, for the smart mooring data, their depth, as a
+    # smart mooring may measure at several depths at once), and all
+    # variables are placed in a single pass, rather than folding the
+    # variables into the dataframe one at a time.
+
+    surface_frames = []  # Surface wave buoy variables
+    smart_frames = []    # Smart mooring sensor variables
+    for varname in api_data.keys():
+        var_df = pd.DataFrame(data=api_data[varname]['data'])
+        if (len(var_df) == 0) or ('value' not in var_df.columns):
+            continue
+
+        # Categorize the variable data by depth
+        is_surface = (var_df['depth'] == 0).to_numpy()
+        if any(is_surface):
+            surface_frames.append((varname, var_df[is_surface]))
+        if any(~is_surface):
+            smart_frames.append((varname, var_df[~is_surface]))
+
+    total_data = _pivot_variable_frames(surface_frames, list(key_cols))
+    smart_data = _pivot_variable_frames(smart_frames, list(key_cols) + ['depth'])
+
+    return total_data, smart_data
+
+
+def _pivot_variable_frames(var_frames, key_cols):
+
+    # This function is used to pivot a list of (variable name,
+    # variable dataframe) pairs into a single dataframe.
+    #
+    # Rows are ordered by the first appearance of each key, stepping
+    # through the variables in order, and the coordinate columns
+    # (lat, lon, depth, etc.) are taken from the first variable with
+    # that key. The columns are ordered as those of the first variable
+    # (with its values under its name), followed by any other
+    # coordinate columns and the other variables. If a variable has
+    # more than one record for the same key, the last record is kept
+    # (for every variable, including the first). The number of keys
+    # that each later variable adds (i.e., that do not match those
+    # of the variables before it) is printed.
+
+    if len(var_frames) == 0:
+        return None
+
+    # Stack the coordinate columns of all the variables together
+    varnames = [varname for varname, _ in var_frames]
+    var_lens = np.array([len(var_df) for _, var_df in var_frames])
+    var_bounds = np.concatenate([[0], np.cumsum(var_lens)])
+    long_df = pd.concat([var_df.drop(columns='value') for _, var_df in var_frames],
+                        ignore_index=True)
+
+    # Drop any observations that do not have a numeric timestamp
+    timestamps = pd.to_numeric(long_df['timestamp'], errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(timestamps)
+    valid_inds = np.flatnonzero(valid)
+    if len(valid_inds) == 0:
+        return None
+    long_df = long_df.iloc[valid_inds].reset_index(drop=True)
+    long_df['timestamp'] = timestamps[valid_inds].astype(np.int64)
+    valid_bounds = np.concatenate([[0], np.cumsum(valid)])[var_bounds]
+
+    # Build a single integer key from the key columns, and number
+    # each key in the order in which it first appears
+    row_keys = np.zeros(len(long_df), dtype=np.int64)
+    for col in [col for col in key_cols if col in long_df.columns]:
+        col_codes, col_uniques = pd.factorize(long_df[col], use_na_sentinel=False)
+        row_keys = row_keys * len(col_uniques) + col_codes
+    row_codes, key_uniques = pd.factorize(row_keys)
+    nrows = len(key_uniques)
+
+    # Find the last record of each key within each variable, and take
+    # the coordinate columns from the first variable with each key
+    var_rows = []
+    coord_rows = np.full(nrows, -1, dtype=np.int64)
+    for ii, varname in enumerate(varnames):
+        var_row_codes = row_codes[valid_bounds[ii]:valid_bounds[ii+1]]
+        var_codes, var_last = np.unique(var_row_codes[::-1], return_index=True)
+        var_last = len(var_row_codes) - 1 - var_last
+        var_rows.append((var_codes, var_last))
+
+        new_keys = coord_rows[var_codes] < 0
+        coord_rows[var_codes[new_keys]] = valid_bounds[ii] + var_last[new_keys]
+        if (ii > 0) and any(new_keys):
+            print('   ...Some mismatched for ' + varname + ': ' + str(int(new_keys.sum())) + ' points')
+    wide_df = long_df.iloc[coord_rows].reset_index(drop=True)
+
+    # Store categorical columns (e.g., platform ID) as plain values
+    for col in wide_df.columns:
+        if isinstance(wide_df[col].dtype, pd.CategoricalDtype):
+            wide_df[col] = wide_df[col].astype(wide_df[col].cat.categories.dtype)
+
+    # Place the values of each variable into their rows
+    for ii, varname in enumerate(varnames):
+        values = var_frames[ii][1]['value'].to_numpy()[valid[var_bounds[ii]:var_bounds[ii+1]]]
+        var_codes, var_last = var_rows[ii]
+        if values.dtype.kind in 'biuf':
+            var_col = np.nan*np.ones(nrows)
+        else:
+            var_col = np.full(nrows, np.nan, dtype=object)
+        var_col[var_codes] = values[var_last]
+        wide_df[varname] = var_col
+
+    # Order the columns as those of the first variable
+    first_cols = [varnames[0] if col == 'value' else col for col in var_frames[0][1].columns]
+    wide_df = wide_df[first_cols + [col for col in wide_df.columns if col not in first_cols]]
+
+    # Convert Unix timestamps to datetime objects,
+    # and drop any data with bad "time" values
+    wide_df['time'] = pd.to_datetime(wide_df['timestamp'], unit='s', errors='coerce')
+    wide_df = wide_df.dropna(subset='time').reset_index(drop=True)
+
+    return wide_df
+
+
+def get_data_by_location(location_id, vars_to_get = 'ALL',
                          time_start=None, time_end=None):
-    
+
     ####################################
     # Pull data for for a given location
-    location_data = bb_da.bbapi_get_location_data(location_id, vars_to_get, 
+    location_data = bb_da.bbapi_get_location_data(location_id, vars_to_get,
                                                   time_start, time_end)
     if (location_data is None) or (len(location_data) == 0):
         print('No data pulled.')
         return None, None
-        
-    
-    ###############################################
-    # Use location data to build a pandas dataframe
-    
-    def append_newvar(tot_dat, test_dat):
-        
-        # This function is used to append on each new variable 
-        # to the total dataframe
-        
-        if test_dat is None:
-            return tot_dat
-        elif (tot_dat is None) and (test_dat is not None):
-            # Return the test data as the initial dataset
-            return test_dat.copy()
-        
-        # Match timestamps between existing data and new variable data
-        # This ensures variables from the same observation are aligned
-        basematchinds = []  # Indices in the existing total_data
-        matchinds = []      # Indices in the new test_dat
-        nonmatchinds = []   # Indices in test_dat that don't match total_data
-        
-        if len(test_dat) > 1:
-            # Check each new data point against existing data
-            for ii in range(0,len(test_dat)):
-                # Look for matching point ID and platform ID
-                if any(np.logical_and(tot_dat.pt_id == 
-                                      test_dat.pt_id.to_numpy().squeeze()[ii],
-                                      tot_dat.platform_id == 
-                                      test_dat.platform_id.to_numpy().squeeze()[ii])):
-
-                    # Found a match - record both indices
-                    basematchinds.append(np.where(np.logical_and(tot_dat.pt_id == 
-                                                                 test_dat.pt_id.to_numpy().squeeze()[ii],
-                                                                 tot_dat.platform_id == 
-                                                                 test_dat.platform_id.to_numpy().squeeze()[ii]))[0][0])
-                    matchinds.append(ii)
-                else:
-                    # No match found - this is new data
-                    nonmatchinds.append(ii)
-
-
-            # Handle data merging based on matching results
-            if len(matchinds) == len(tot_dat):
-                # Perfect match - all timestamps align, just add the variable column
-                tot_dat.loc[basematchinds,varname] = test_dat.loc[matchinds,varname].to_numpy().squeeze()
-            else:
-                # Partial or no match - need to merge carefully
-
-                # First, add matching data points to their correct locations
-                if len(matchinds) > 0:
-                    tot_dat.loc[basematchinds,varname] = test_dat.loc[matchinds,varname].to_numpy().squeeze()
-
-                # Then append non-matching data as new rows
-                # Fill missing columns with NaNs
-                if len(nonmatchinds) > 0:
-                    # Create the variable column if it doesn't exist yet
-                    if varname not in tot_dat.columns:
-                        print('   ...Variable does not yet exist: ', varname)
-                        tot_dat.loc[:,varname] = np.nan*np.ones(len(tot_dat))
-                    # Concatenate the non-matching rows
-                    tot_dat = pd.concat([tot_dat, 
-                                         test_dat.iloc[nonmatchinds,:]]).reset_index(drop=True)
-                    print('   ...Some mismatched for ' + varname + ': ' + str(len(nonmatchinds)) + ' points') 
-
-
-        elif len(test_dat) == 1:
-            tot_dat.loc[0,varname] = test_dat.loc[0,varname]
-
-        return tot_dat
-    
-    # Extract variable data from location data and organize by depth
-    # Surface measurements (depth=0) go to varnames
-    # Subsurface measurements (depth≠0) go to smartvars (smart mooring sensors)
-    loc_data_topds = {}
-    varnames = []        # Surface wave buoy variables
-    smartvars = []       # Smart mooring sensor variables
-    smartdepths = []     # Depths of smart mooring sensors
-    
-    for varname in location_data.keys():
-        loc_data_topds[varname] = {}
-        loc_data_topds[varname]['units'] = location_data[varname]['units']
-        data_colnames = [ii for ii in location_data[varname]['data'].keys()]
-        temp_pd = pd.DataFrame(data = location_data[varname]['data'],
-                               columns=data_colnames)
-        # Rename 'value' column to the variable name for clarity
-        data_colnames = [varname if ii == 'value' else ii for ii in data_colnames]
-        loc_data_topds[varname]['data'] = temp_pd.rename(columns={"value": varname})
-        
-        # Categorize variables by depth
-        if any(loc_data_topds[varname]['data']['depth']==0):
-            varnames.append(varname)  # Surface measurement
-        if any(loc_data_topds[varname]['data']['depth']!=0):
-            smartvars.append(varname)  # Subsurface measurement
-            smartdepths.append(np.unique(loc_data_topds[varname]['data']['depth'])[0])
-    
-    # Initialize separate dataframes for surface and subsurface data
-    # Surface data: Wave buoy measurements (depth = 0)
-    # Smart data: Smart mooring sensors (depth ≠ 0)
-    if len(varnames) > 0:
-        # Start with the first surface variable
-        test_data = loc_data_topds[varnames[0]]['data'].copy()
-        total_data = test_data[test_data['depth'] == 0].reset_index(drop=True)
-
-        # Create a unique "point ID" for each observation
-        # Used to match data points across different variables
-        total_data['pt_id'] = [str(total_data['timestamp'][ii]) 
-                               for ii in range(0,len(total_data))]
-    else:
-        total_data = None
 
-    if len(smartvars) > 0:
-        # Start with the first smart mooring variable
-        test_data = loc_data_topds[smartvars[0]]['data'].copy()
-        smart_data = test_data[test_data['depth'] != 0].reset_index(drop=True)
 
-        # Create a unique "point ID" combining timestamp and depth
-        smart_data['pt_id'] = [str(smart_data['timestamp'][ii]) 
-                               for ii in range(0,len(smart_data))]
-    else:
-        smart_data = None
-
-        
-    
-    # Step through all additional variables, and append them
-    # to the total data dataframes
-    for varname in varnames[1:]:
-        # Extract out the data
-        alltest_data = loc_data_topds[varname]['data'].copy()
-        
-        # Create a "point ID", created as a combination of
-        # data timestamp and depth
-        alltest_data['pt_id'] = [str(alltest_data['timestamp'][ii]) 
-                                 for ii in range(0,len(alltest_data))]
-        
-        # Take each variables data, and put it into a dataframe
-        if any(alltest_data != 0):
-            test_data = alltest_data[alltest_data['depth'] == 0].reset_index(drop=True)
-            smarttest_data = alltest_data[alltest_data['depth'] != 0].reset_index(drop=True)
-            if smarttest_data.shape[0] == 0:
-                smarttest_data = None  
-        else:
-            test_data = alltest_data.copy()
-            smarttest_data = None
-            
-        total_data = append_newvar(total_data, test_data)
-        if smarttest_data is not None:
-            smart_data = append_newvar(smart_data, smarttest_data)
-            
-            
-    # Step through all additional variables, and append them
-    # to the total data dataframes
-    for varname in smartvars[1:]:
-        # Extract out the data
-        alltest_data = loc_data_topds[varname]['data'].copy()
-        
-        # Create a "point ID", created as a combination of
-        # data timestamp and depth
-        alltest_data['pt_id'] = [str(alltest_data['timestamp'][ii]) 
-                                 for ii in range(0,len(alltest_data))]
-        
-        # Take each variables data, and put it into a dataframe
-        if any(alltest_data != 0):
-            smarttest_data = alltest_data[alltest_data['depth'] != 0].reset_index(drop=True)
-        else:
-            smarttest_data = None
-            
-        if smarttest_data is not None:
-            smart_data = append_newvar(smart_data, smarttest_data)
-        
-        
-        
-        
+    ###############################################
+    # Use location data to build a pandas dataframe
+    total_data, smart_data = pivot_observations(location_data)
 
-            
-    
-    # Convert Unix timestamps to datetime objects
-    # Use vectorized pandas operation for efficiency
-    total_data_time = total_data.timestamp.to_numpy()
-    if len(total_data_time) > 1:
-        # Vectorized conversion is much faster than list comprehension
-        total_data['time'] = pd.to_datetime(total_data.timestamp, unit='s', errors='coerce')
-    else:
-        total_data['time'] = pd.to_datetime(total_data.timestamp, unit='s')
-    
-    # Drop any data with bad "time" values
-    total_data = total_data.dropna(subset='time').reset_index(drop=True)
-    
-    if smart_data is not None:
-        # Convert Unix timestamps to datetime objects using vectorized operation
-        total_data_time = smart_data.timestamp.to_numpy()
-        if len(total_data_time) > 1:
-            smart_data['time'] = pd.to_datetime(smart_data.timestamp, unit='s', errors='coerce')
-        else:
-            smart_data['time'] = pd.to_datetime(smart_data.timestamp, unit='s')
+    # If there is no surface data, return None for both dataframes
+    if total_data is None:
+        return None, None
 
-        # Drop any data with bad "time" values
-        smart_data = smart_data.dropna(subset='time').reset_index(drop=True)
-        
-    
-    # For any duplicate point IDs, combine the values,
-    # and drop the duplicate
-    #if any(total_data.duplicated(subset='pt_id')):
-    #    dupinds = np.where(total_data.duplicated(subset='pt_id'))[0]
-    #    for dupind in dupinds:
-    #        if dupind < len(total_data)-1:
-    #            total_data.iloc[dupind,:].combine_first(total_data.iloc[dupind+1,:])
-    #    total_data = total_data.drop_duplicates(subset=['pt_id'],keep='first').reset_index(drop=True)
-            
-    
     return total_data, smart_data
 
 
-def get_data_by_platform(platform_id, vars_to_get = 'ALL', 
+def get_data_by_platform(platform_id, vars_to_get = 'ALL',
                          time_start=None, time_end=None,
                          loc_bounds=None):
-    
+
     ####################################
     # Pull data for for a given location
-    platform_data = bb_da.bbapi_get_platform_data(platform_id, vars_to_get, 
+    platform_data = bb_da.bbapi_get_platform_data(platform_id, vars_to_get,
                                                   time_start, time_end)
     if (platform_data is None) or (len(platform_data) == 0):
         print('No data pulled.')
         return None, None
-    
+
     ####################################
     # Filter the data to the specified location bounds, if provided
-    max_datalen = 0
-    for checkvar in platform_data.keys():
-        spot_lats = platform_data[checkvar]['data']['lat']
-        spot_lons = platform_data[checkvar]['data']['lon']
-        keep_inds = [(loc_bounds['lat_s'] <= lat <= loc_bounds['lat_n']) and
-                    (loc_bounds['lon_w'] <= lon <= loc_bounds['lon_e']) 
-                    for lat, lon in zip(spot_lats, spot_lons)]
-        if any(keep_inds):
-            keep_inds = np.where(keep_inds)[0]
-        else:
-            keep_inds = []
-        platform_data[checkvar]['data'] = {key: [val[ii] for ii in keep_inds]
-                                           for key, val in platform_data[checkvar]['data'].items()}
-        max_datalen = max(max_datalen, len(platform_data[checkvar]['data']['lat']))
-    if max_datalen == 0:
-        print('No data within the specified location bounds.')
-        return None, None
-        
-    
-    ###############################################
-    # Use platform data to build a pandas dataframe
-    
-    def append_newvar(tot_dat, test_dat):
-        
-        # This function is used to append on each new variable 
-        # to the total dataframe
-        
-        if test_dat is None:
-            return tot_dat
-        elif (tot_dat is None) and (test_dat is not None):
-            # Return the test data as the initial dataset
-            return test_dat.copy()
-        
-        # Match timestamps between existing data and new variable data
-        # This ensures variables from the same observation are aligned
-        basematchinds = []  # Indices in the existing total_data
-        matchinds = []      # Indices in the new test_dat
-        nonmatchinds = []   # Indices in test_dat that don't match total_data
-        
-        if len(test_dat) > 1:
-            # Check each new data point against existing data
-            for ii in range(0,len(test_dat)):
-                # Look for matching point ID
-                if any(tot_dat.pt_id == test_dat.pt_id.to_numpy().squeeze()[ii]):
-
-                    # Found a match - record both indices
-                    basematchinds.append(np.where(tot_dat.pt_id == test_dat.pt_id.to_numpy().squeeze()[ii])[0][0])
-                    matchinds.append(ii)
-                else:
-                    # No match found - this is new data
-                    nonmatchinds.append(ii)
-
-
-            # Handle data merging based on matching results
-            if len(matchinds) == len(tot_dat):
-                # Perfect match - all timestamps align, just add the variable column
-                tot_dat.loc[basematchinds,varname] = test_dat.loc[matchinds,varname].to_numpy().squeeze()
-            else:
-                # Partial or no match - need to merge carefully
-
-                # First, add matching data points to their correct locations
-                if len(matchinds) > 0:
-                    tot_dat.loc[basematchinds,varname] = test_dat.loc[matchinds,varname].to_numpy().squeeze()
-
-                # Then append non-matching data as new rows
-                # Fill missing columns with NaNs
-                if len(nonmatchinds) > 0:
-                    # Create the variable column if it doesn't exist yet
-                    if varname not in tot_dat.columns:
-                        print('   ...Variable does not yet exist: ', varname)
-                        tot_dat.loc[:,varname] = np.nan*np.ones(len(tot_dat))
-                    # Concatenate the non-matching rows
-                    tot_dat = pd.concat([tot_dat, 
-                                         test_dat.iloc[nonmatchinds,:]]).reset_index(drop=True)
-                    print('   ...Some mismatched for ' + varname + ': ' + str(len(nonmatchinds)) + ' points') 
-
-
-        elif len(test_dat) == 1:
-            tot_dat.loc[0,varname] = test_dat.loc[0,varname]
-
-        return tot_dat
-    
-    # Extract variable data from location data and organize by depth
-    # Surface measurements (depth=0) go to varnames
-    # Subsurface measurements (depth≠0) go to smartvars (smart mooring sensors)
-    plat_data_topds = {}
-    varnames = []        # Surface wave buoy variables
-    smartvars = []       # Smart mooring sensor variables
-    smartdepths = []     # Depths of smart mooring sensors
-    
-    for varname in platform_data.keys():
-        plat_data_topds[varname] = {}
-        plat_data_topds[varname]['units'] = platform_data[varname]['units']
-        data_colnames = [ii for ii in platform_data[varname]['data'].keys()]
-        temp_pd = pd.DataFrame(data = platform_data[varname]['data'],
-                               columns=data_colnames)
-        # Rename 'value' column to the variable name for clarity
-        data_colnames = [varname if ii == 'value' else ii for ii in data_colnames]
-        plat_data_topds[varname]['data'] = temp_pd.rename(columns={"value": varname})
-        
-        # Categorize variables by depth
-        if any(plat_data_topds[varname]['data']['depth']==0):
-            varnames.append(varname)  # Surface measurement
-        if any(plat_data_topds[varname]['data']['depth']!=0):
-            smartvars.append(varname)  # Subsurface measurement
-            smartdepths.append(np.unique(plat_data_topds[varname]['data']['depth'])[0])
-    
-    # Initialize separate dataframes for surface and subsurface data
-    # Surface data: Wave buoy measurements (depth = 0)
-    # Smart data: Smart mooring sensors (depth ≠ 0)
-    if len(varnames) > 0:
-        # Start with the first surface variable
-        test_data = plat_data_topds[varnames[0]]['data'].copy()
-        total_data = test_data[test_data['depth'] == 0].reset_index(drop=True)
-
-        # Create a unique "point ID" for each observation
-        # Used to match data points across different variables
-        total_data['pt_id'] = [str(total_data['timestamp'][ii]) 
-                               for ii in range(0,len(total_data))]
-    else:
-        total_data = None
-
-    if len(smartvars) > 0:
-        # Start with the first smart mooring variable
-        test_data = plat_data_topds[smartvars[0]]['data'].copy()
-        smart_data = test_data[test_data['depth'] != 0].reset_index(drop=True)
+    if loc_bounds is not None:
+        max_datalen = 0
+        for checkvar in platform_data.keys():
+            var_data = platform_data[checkvar]['data']
+            spot_lats = np.asarray(var_data['lat'], dtype=float)
+            spot_lons = np.asarray(var_data['lon'], dtype=float)
+            keep_inds = np.flatnonzero((loc_bounds['lat_s'] <= spot_lats) & (spot_lats <= loc_bounds['lat_n']) &
+                                       (loc_bounds['lon_w'] <= spot_lons) & (spot_lons <= loc_bounds['lon_e']))
+            platform_data[checkvar]['data'] = {key: val[keep_inds]
+                                               for key, val in var_data.items()}
+            max_datalen = max(max_datalen, len(keep_inds))
+        if max_datalen == 0:
+            print('No data within the specified location bounds.')
+            return None, None
 
-        # Create a unique "point ID" combining timestamp and depth
-        smart_data['pt_id'] = [str(smart_data['timestamp'][ii]) 
-                               for ii in range(0,len(smart_data))]
-    else:
-        smart_data = None
 
-        
-    
-    # Step through all additional variables, and append them
-    # to the total data dataframes
-    for varname in varnames[1:]:
-        # Extract out the data
-        alltest_data = plat_data_topds[varname]['data'].copy()
-        
-        # Create a "point ID", created as a combination of
-        # data timestamp and depth
-        alltest_data['pt_id'] = [str(alltest_data['timestamp'][ii]) 
-                                 for ii in range(0,len(alltest_data))]
-        
-        # Take each variables data, and put it into a dataframe
-        if any(alltest_data != 0):
-            test_data = alltest_data[alltest_data['depth'] == 0].reset_index(drop=True)
-            smarttest_data = alltest_data[alltest_data['depth'] != 0].reset_index(drop=True)
-            if smarttest_data.shape[0] == 0:
-                smarttest_data = None  
-        else:
-            test_data = alltest_data.copy()
-            smarttest_data = None
-            
-        total_data = append_newvar(total_data, test_data)
-        if len(total_data) == 0:
-            total_data = None
-            return None, None
-        
-        if smarttest_data is not None:
-            smart_data = append_newvar(smart_data, smarttest_data)
-            
-            
-    # Step through all additional variables, and append them
-    # to the total data dataframes
-    for varname in smartvars[1:]:
-        # Extract out the data
-        alltest_data = plat_data_topds[varname]['data'].copy()
-        
-        # Create a "point ID", created as a combination of
-        # data timestamp and depth
-        alltest_data['pt_id'] = [str(alltest_data['timestamp'][ii]) 
-                                 for ii in range(0,len(alltest_data))]
-        
-        # Take each variables data, and put it into a dataframe
-        if any(alltest_data != 0):
-            smarttest_data = alltest_data[alltest_data['depth'] != 0].reset_index(drop=True)
-        else:
-            smarttest_data = None
-            
-        if smarttest_data is not None:
-            smart_data = append_newvar(smart_data, smarttest_data)
+    ###############################################
+    # Use platform data to build a pandas dataframe
+    total_data, smart_data = pivot_observations(platform_data)
 
     # If there is no data at the end, return None for both dataframes
     if total_data is None:
         return None, None
-            
-    
-    # Convert Unix timestamps to datetime objects
-    # Use vectorized pandas operation for efficiency
-    total_data_time = total_data.timestamp.to_numpy()
-    if len(total_data_time) > 1:
-        # Vectorized conversion is much faster than list comprehension
-        total_data['time'] = pd.to_datetime(total_data.timestamp, unit='s', errors='coerce')
-    else:
-        total_data['time'] = pd.to_datetime(total_data.timestamp, unit='s')
-    
-    # Drop any data with bad "time" values
-    total_data = total_data.dropna(subset='time').reset_index(drop=True)
-    
-    if smart_data is not None:
-        # Convert Unix timestamps to datetime objects using vectorized operation
-        total_data_time = smart_data.timestamp.to_numpy()
-        if len(total_data_time) > 1:
-            smart_data['time'] = pd.to_datetime(smart_data.timestamp, unit='s', errors='coerce')
-        else:
-            smart_data['time'] = pd.to_datetime(smart_data.timestamp, unit='s')
-
-        # Drop any data with bad "time" values
-        smart_data = smart_data.dropna(subset='time').reset_index(drop=True)
-        
 
     # Ensure that platform ID is a variable in the datasets
     if 'platform_id' not in total_data.columns:
         total_data['platform_id'] = [platform_id] * len(total_data)
     if smart_data is not None and 'platform_id' not in smart_data.columns:
         smart_data['platform_id'] = [platform_id] * len(smart_data)
-            
-    
+
+
     return total_data, smart_data
 
 
 # In[ ]:
 
 
+def get_rebuild_data(spotters, loc_bounds_list, max_workers=None):
+
+    # This function is used to pull the data for each spotter,
+    # over each window of the location history, when rebuilding
+    # a dataset.
+    #
+    # The (spotter, window) requests are independent of each other,
+    # so they are sent concurrently from a bounded pool of threads.
+    # The results are then concatenated once, in the same
+    # (spotter, window) order as the requests.
+
+    if max_workers is None:
+        max_workers = REBUILD_FETCH_WORKERS
+
+    requests_list = [(spotter, loc_bounds) for spotter in spotters
+                     for loc_bounds in loc_bounds_list]
+    if len(requests_list) == 0:
+        return None, None
+
+    for spotter in spotters:
+        print('   Pull data for spotter: ' + spotter)
+
+    def fetch_window(request):
+        spotter, loc_bounds = request
+        return get_data_by_platform(spotter, time_start=loc_bounds['loc_start'],
+                                    time_end=loc_bounds['loc_end'], loc_bounds=loc_bounds)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fetch_window, requests_list))
+
+    ds_list = [ds_temp for ds_temp, _ in results if ds_temp is not None]
+    ds_smart_list = [ds_smart_temp for _, ds_smart_temp in results if ds_smart_temp is not None]
+
+    ds = pd.concat(ds_list, axis=0).reset_index(drop=True) if len(ds_list) > 0 else None
+    ds_smart = pd.concat(ds_smart_list, axis=0).reset_index(drop=True) if len(ds_smart_list) > 0 else None
+
+    return ds, ds_smart
+
+
+# In[ ]:
+
+
 def check_for_necessary_variables(df, smartflag=False):
     
     if smartflag:
@@ -787,36 +908,74 @@ def rename_dataframe_columns(df, smartflag=False):
 # In[ ]:
 
 
-def get_buoy_qcflags(ds, loc_id, smartflag=False):
-    
-    dsnew_qcversion = ds.copy()
-    if not(smartflag):
-        # Convert period data into frequency for running the QC tests
-        dsnew_qcversion['sea_surface_wave_frequency_at_variance_spectral_density_maximum'] = 1 / dsnew_qcversion['sea_surface_wave_period_at_variance_spectral_density_maximum'].values
-        dsnew_qcversion['sea_surface_wave_mean_frequency'] = 1 / dsnew_qcversion['sea_surface_wave_mean_period'].values
+def get_buoy_qc_limits(ds, loc_id, smartflag=False):
 
-    # Run QARTOD tests on the data
+    # Load in the QC limits for the variables in a dataset
     if smartflag:
-        smart_vars = ds.keys()
         dropvars = ['depth', 'latitude', 'longitude', 
                     'platform_id', 'timestamp', 
                     'type', 'pt_id', 'time']
-        for var in dropvars:
-            smart_vars = smart_vars.drop(var)
-        qc_limits = bb_qc.load_all_smart_qc_limits(loc_id, [var for var in smart_vars])
+        smart_vars = [var for var in ds.keys() if var not in dropvars]
+        qc_limits = bb_qc.load_all_smart_qc_limits(loc_id, smart_vars)
     else:
         qc_limits = bb_qc.load_all_qc_limits(loc_id)
+
+    return qc_limits
+
+
+def get_buoy_qcflags(ds, loc_id, smartflag=False, qc_limits=None, engine=None,
+                     time_interval=None):
+    
+    dsnew_qcversion = ds.copy()
+    if not(smartflag):
+        # Convert period data into frequency for running the QC tests
+        dsnew_qcversion['sea_surface_wave_frequency_at_variance_spectral_density_maximum'] = 1 / dsnew_qcversion['sea_surface_wave_period_at_variance_spectral_density_maximum'].values
+        dsnew_qcversion['sea_surface_wave_mean_frequency'] = 1 / dsnew_qcversion['sea_surface_wave_mean_period'].values
+
+    # Run QARTOD tests on the data
+    if qc_limits is None:
+        qc_limits = get_buoy_qc_limits(ds, loc_id, smartflag)
         
     ds_qc = bb_qc.process_qartod_tests(dsnew_qcversion, dsnew_qcversion.columns,
-                                       qc_limits, smartflag)
+                                       qc_limits, smartflag, engine=engine,
+                                       time_interval=time_interval)
     
     return ds_qc
 
 
+def get_placeholder_qcflags(ds, ds_old):
+
+    # Placeholder QC flags for newly pulled data (the MISSING flag,
+    # for each of the flag variables of the existing data), used with
+    # incremental QC, where the flags of the new data are only found
+    # once it has been merged onto the existing data
+    flag_vars = [varname for varname in ds_old.keys() if '_qc_' in varname]
+
+    return pd.DataFrame({varname: np.full(len(ds), bb_flags.QARTOD_MISSING,
+                                          dtype=ds_old[varname].dtype)
+                         for varname in flag_vars}, index=ds.index)
+
+
 # In[ ]:
 
 
-def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_period=None):
+def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_period=None,
+                    time_window=None, time_intervals=None, times_only=False):
+
+    # If time_window is specified (in a rebuild), it should be a list of
+    # two datetime objects, and only the data from the start of the
+    # window up to (but not including) the end of the window is pulled
+    # and processed (see rebuild_data_by_window)
+    #
+    # If time_intervals is specified, it gives the time steps with which
+    # to run the QC tests of the surface (False) and smart mooring (True)
+    # data, in place of the median time steps of the data pulled (e.g.,
+    # those of the whole record, when it is rebuilt a window at a time).
+    # If times_only is set, only the times of the surface and smart
+    # mooring data pulled (and authorized) are returned, without
+    # processing the data (see get_rebuild_time_intervals).
+
+    import xarray as xr
     
     # Get location info from the metadata info json
     basedir = bb.get_datadir()
@@ -826,8 +985,7 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
     # If the info path already exists, 
     # load in the info json, and update the relevant fields
     if os.path.exists(infodir):
-        with open(infodir, 'r') as info_json:
-            infodict = json.load(info_json)
+        infodict = bb.load_json_file(infodir)
     else:
         infodict = None
 
@@ -920,17 +1078,51 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
             loc_bounds_list = None
     else:
         loc_bounds_list = None
+    
+    # In a rebuild of a single time window, only pull
+    # the part of each location window within it
+    if (loc_bounds_list is not None) and (time_window is not None):
+        window_bounds_list = []
+        for loc_bounds in loc_bounds_list:
+            loc_start = max([datetime.datetime.strptime(loc_bounds['loc_start'], DATETIME_FORMAT),
+                             time_window[0]])
+            if loc_bounds['loc_end'] is None:
+                loc_end = time_window[1]
+            else:
+                loc_end = min([datetime.datetime.strptime(loc_bounds['loc_end'], DATETIME_FORMAT),
+                               time_window[1]])
+            if loc_start < loc_end:
+                window_bounds_list.append(dict(loc_bounds, loc_start=loc_start.strftime(DATETIME_FORMAT),
+                                               loc_end=loc_end.strftime(DATETIME_FORMAT)))
+        loc_bounds_list = window_bounds_list
 
     
+    # On updates, get the pull window from the pipeline state, if it
+    # is known, so that the existing data is only loaded in if there
+    # is new data to add onto it
+    state_window = None
+    if PIPELINE_STATE and not(rebuild_flag):
+        state_window = get_state_pull_window(loc_id)
+    
     # Load in existing data, if it exists
-    if not(rebuild_flag):
+    if state_window is not None:
+        ds_old = None
+        ds_smart_old = None
+        olderFlag = False
+    elif not(rebuild_flag):
         ds_old, ds_smart_old, olderFlag = load_existing_netcdf(loc_id)
         if ds_old is not None:
             ds_old = ds_old.sortby('time')
         if ds_smart_old is not None:
             ds_smart_old = ds_smart_old.sortby('time')
     elif (rebuild_period is not None):
-        ds_old, ds_smart_old, olderFlag = load_existing_netcdf(loc_id, rebuild_period=rebuild_period)
+        if time_window is not None:
+            # Only load in the files of the rebuild period within the window
+            window_period = [max([rebuild_period[0], time_window[0]]),
+                             min([rebuild_period[1], time_window[1] - datetime.timedelta(seconds=1)])]
+            ds_old, ds_smart_old, olderFlag = load_existing_netcdf(loc_id, rebuild_period=window_period)
+        else:
+            ds_old, ds_smart_old, olderFlag = load_existing_netcdf(loc_id, rebuild_period=rebuild_period)
         if ds_old is not None:
             ds_old = ds_old.sortby('time')
         if ds_smart_old is not None:
@@ -940,7 +1132,12 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
         ds_smart_old = None
     
     # If there is any existing data, get the last time stamp
-    if (ds_old is not None) and (not(rebuild_flag) or (rebuild_period is not None)):
+    if state_window is not None:
+        print('   Last time stamp of the existing data (from the pipeline state): ' + 
+              state_window['lasttime'].strftime(DATETIME_FORMAT))
+        pull_starttime = state_window['pull_starttime']
+        pull_endtime = None
+    elif (ds_old is not None) and (not(rebuild_flag) or (rebuild_period is not None)):
         # Extract out the first and last date
         # of the existing dataset
         firsttime = pd.Timestamp(ds_old['time'].data[0]).to_pydatetime()
@@ -982,6 +1179,11 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
         ds_old = None
         ds_smart_old = None
     
+    # In a rebuild of a single time window, only the window is pulled
+    if time_window is not None:
+        pull_starttime = time_window[0]
+        pull_endtime = time_window[1]
+
     # Load in the data from the Backyard Buoys data API
     # Note, that for now, nothing is done with the smart mooring data (i.e., "ds_smart")
     if pull_starttime is not None and pull_endtime is not None:
@@ -1003,24 +1205,20 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
         ds, ds_smart = get_data_by_location(loc_id, time_start=pull_starttime,
                                             time_end=pull_endtime)
     else:
-        ds = None
-        ds_smart = None
-
-        for spotter in valid_spotters:
-            print('   Pull data for spotter: ' + spotter)
-            for ii in range(0,len(loc_bounds_list)):
-                loc_bounds = loc_bounds_list[ii]
-                ds_temp, ds_smart_temp = get_data_by_platform(spotter, time_start=loc_bounds['loc_start'],
-                                                              time_end=loc_bounds['loc_end'], loc_bounds=loc_bounds)
-            
-                if ds is None and ds_temp is not None:
-                    ds = ds_temp
-                elif ds_temp is not None:
-                    ds = pd.concat([ds, ds_temp], axis=0).reset_index(drop=True)
-                if ds_smart is None and ds_smart_temp is not None:
-                    ds_smart = ds_smart_temp
-                elif ds_smart_temp is not None:
-                    ds_smart = pd.concat([ds_smart, ds_smart_temp], axis=0).reset_index(drop=True)
+        ds, ds_smart = get_rebuild_data(valid_spotters, loc_bounds_list)
+
+    # Keep only the data within the time window (as the API
+    # may return the data at the end time of the request)
+    if (time_window is not None) and (ds is not None):
+        ds = ds[(ds['time'] >= time_window[0]) & 
+                (ds['time'] < time_window[1])].reset_index(drop=True)
+        if len(ds) == 0:
+            ds = None
+        if ds_smart is not None:
+            ds_smart = ds_smart[(ds_smart['time'] >= time_window[0]) & 
+                                (ds_smart['time'] < time_window[1])].reset_index(drop=True)
+            if len(ds_smart) == 0:
+                ds_smart = None
 
     if ds is None:
         print('   Return without processing any data')
@@ -1056,6 +1254,28 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
             if len(ds) == 0:
                 print('   No data remains to process. Return without processing any data.')
                 return None, None
+
+    if times_only:
+        if (ds_smart is not None) and check_spotters:
+            ds_smart = ds_smart[ds_smart['platform_id'].isin(valid_spotters)]
+        return (ds['time'].to_numpy(),
+                ds_smart['time'].to_numpy() if ds_smart is not None else None)
+    
+    # If the pull window came from the pipeline state, skip the
+    # location if there is nothing new since the last run, and
+    # otherwise, load in the existing data to add the new data onto
+    if state_window is not None:
+        newest_times = {'spotter': ds['time'].max(),
+                        'smart': ds_smart['time'].max() if ds_smart is not None else None}
+        if not(check_for_new_data(loc_id, newest_times)):
+            print('   No new data since the last run. Return without processing any data.')
+            return None, None
+        ds_old, ds_smart_old, olderFlag = load_existing_netcdf(loc_id)
+        if ds_old is not None:
+            ds_old = ds_old.sortby('time')
+            firsttime = pd.Timestamp(ds_old['time'].data[0]).to_pydatetime()
+        if ds_smart_old is not None:
+            ds_smart_old = ds_smart_old.sortby('time')
     
     # Check that the dataset has all the necessary columns
     ds = check_for_necessary_variables(ds)
@@ -1063,8 +1283,18 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
     # Rename the data columns
     ds = rename_dataframe_columns(ds)
 
-    # Run the QARTOD checks on the data
-    ds_qc = get_buoy_qcflags(ds, loc_id)
+    # Run the QARTOD checks on the data. With incremental QC, the new
+    # data is only given placeholder flags here, and its flags are
+    # found once it has been merged onto the existing data (unless
+    # all the QC tests are going to be rerun anyway)
+    incremental_qc = INCREMENTAL_QC and (ds_old is not None) and not(rerun_tests)
+    if incremental_qc:
+        ds_qc = get_placeholder_qcflags(ds, ds_old)
+    elif time_intervals is not None:
+        ds_qc = get_buoy_qcflags(ds, loc_id, engine='native',
+                                 time_interval=time_intervals[False])
+    else:
+        ds_qc = get_buoy_qcflags(ds, loc_id)
     
     # Combine all the data together
     ds_df = pd.concat([ds, ds_qc], axis=1)
@@ -1108,23 +1338,34 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
     if ds_old is not None:
         print('   Concat the datasets together')
         print('      Old dataset range: ' +  
-              pd.Timestamp(ds_old['time'].data[0]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ') + 
-             ' - ' + pd.Timestamp(ds_old['time'].data[-1]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ'))
+              format_time_range(ds_old['time'].data))
         print('      Old dataset size: ' + str(int(ds_old.sizes['time'])))
     if ds_xr is not None:
         print('      New dataset range: ' +  
-              pd.Timestamp(ds_xr['time'].data[0]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ') + 
-             ' - ' + pd.Timestamp(ds_xr['time'].data[-1]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ'))
+              format_time_range(ds_xr['time'].data))
         print('      New dataset size: ' + str(int(ds_xr.sizes['time'])))
         
     if (ds_old is not None) and (ds_xr is not None):
         ds_all = xr.concat([ds_old, ds_xr.sortby('time')], dim='time').sortby('time')
         print('      Merged dataset range: ' +  
-              pd.Timestamp(ds_all['time'].data[0]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ') + 
-             ' - ' + pd.Timestamp(ds_all['time'].data[-1]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ'))
+              format_time_range(ds_all['time'].data))
         print('      Merged dataset size: ' + str(int(ds_all.sizes['time'])))
     else:
         ds_all = ds_xr.sortby('time').copy()
+
+    # Run the QC tests from the start of the new data, so that the
+    # tests of the new data take the existing data into account. The
+    # existing records that the new data overlaps are dropped first,
+    # so that the tests do not see them as neighbours. The flags of
+    # the existing data are only kept if they were found with the
+    # same QC limits and time step (see check_qc_state).
+    if incremental_qc:
+        ds_all = check_duplicates(ds_all)
+        if check_qc_state(loc_id, get_qc_time_interval(ds_all)):
+            ds_all = rerun_qc_tests_since(ds_all, loc_id, ds_xr['time'].data[0])
+        else:
+            print('   The QC limits or time step of the existing flags are not those of this run.')
+            ds_all = rerun_qc_tests(ds_all, loc_id)
         
         
     
@@ -1155,8 +1396,15 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
         # Rename the data columns
         ds_smart = rename_dataframe_columns(ds_smart, smartflag=True)
 
-        # Run the QARTOD checks on the data
-        ds_smart_qc = get_buoy_qcflags(ds_smart, loc_id, smartflag=True)
+        # Run the QARTOD checks on the data (see above for incremental QC)
+        incremental_smart_qc = INCREMENTAL_QC and (ds_smart_old is not None) and not(rerun_tests)
+        if incremental_smart_qc:
+            ds_smart_qc = get_placeholder_qcflags(ds_smart, ds_smart_old)
+        elif (time_intervals is not None) and (time_intervals[True] is not None):
+            ds_smart_qc = get_buoy_qcflags(ds_smart, loc_id, smartflag=True, engine='native',
+                                           time_interval=time_intervals[True])
+        else:
+            ds_smart_qc = get_buoy_qcflags(ds_smart, loc_id, smartflag=True)
 
         # Combine all the data together
         ds_smart_df = pd.concat([ds_smart, ds_smart_qc], axis=1)
@@ -1200,13 +1448,9 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
         if ds_smart_old is not None:
             print('   Concat the smart datasets together')
             print('      Old dataset range: ' +  
-                  pd.Timestamp(ds_smart_old['time'].data[0]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ') + 
-                 ' - ' + 
-                  pd.Timestamp(ds_smart_old['time'].data[-1]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ'))
+                  format_time_range(ds_smart_old['time'].data))
             print('      New dataset range: ' +  
-                  pd.Timestamp(ds_smart_xr['time'].data[0]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ') + 
-                 ' - ' + 
-                  pd.Timestamp(ds_smart_xr['time'].data[-1]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ'))
+                  format_time_range(ds_smart_xr['time'].data))
             print('      Old dataset size: ' + str(int(ds_old.sizes['time'])))
             print('      New dataset size: ' + str(int(ds_xr.sizes['time'])))
 
@@ -1214,12 +1458,20 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
                                       ds_smart_xr.sortby('time')], 
                                      dim='time').sortby('time')
             print('      Merged dataset range: ' +  
-                  pd.Timestamp(ds_smart_all['time'].data[0]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ') + 
-                 ' - ' + 
-                  pd.Timestamp(ds_smart_all['time'].data[-1]).to_pydatetime().strftime('%Y-%m-%dT%H:%M:%SZ'))
+                  format_time_range(ds_smart_all['time'].data))
             print('      Merged dataset size: ' + str(int(ds_smart_all.sizes['time'])))
         else:
             ds_smart_all = ds_smart_xr.sortby('time').copy()
+
+        # Run the QC tests from the start of the new data
+        if incremental_smart_qc:
+            ds_smart_all = check_duplicates(ds_smart_all)
+            if check_qc_state(loc_id, get_qc_time_interval(ds_smart_all), smartflag=True):
+                ds_smart_all = rerun_qc_tests_since(ds_smart_all, loc_id, ds_smart_xr['time'].data[0],
+                                                    smartflag=True)
+            else:
+                print('   The QC limits or time step of the existing flags are not those of this run.')
+                ds_smart_all = rerun_qc_tests(ds_smart_all, loc_id, smartflag=True)
             
     else:
         ds_smart_all = None
@@ -1233,13 +1485,18 @@ def process_newdata(loc_id, rebuild_flag=False, rerun_tests=False, rebuild_perio
 # In[ ]:
 
 
-def rerun_qc_tests(ds_xr, loc_id, smartflag=False):
+def rerun_qc_tests(ds_xr, loc_id, smartflag=False, qc_limits=None, time_interval=None):
     
     # Make a copy of the xarray dataset
     ds_rerun = ds_xr.to_dataframe().reset_index()
     
-    # Rerun the QC flagging on the dataset
-    ds_qc = get_buoy_qcflags(ds_rerun, loc_id, smartflag)
+    # Rerun the QC flagging on the dataset (with the given time step,
+    # if any, in place of the median time step of the dataset)
+    if time_interval is not None:
+        ds_qc = get_buoy_qcflags(ds_rerun, loc_id, smartflag, qc_limits,
+                                 engine='native', time_interval=time_interval)
+    else:
+        ds_qc = get_buoy_qcflags(ds_rerun, loc_id, smartflag, qc_limits)
     
     # Update the results in the xarray 
     # dataset for each qc test
@@ -1249,17 +1506,98 @@ def rerun_qc_tests(ds_xr, loc_id, smartflag=False):
     return ds_xr
 
 
+def rerun_qc_tests_since(ds_xr, loc_id, since, smartflag=False, qc_limits=None,
+                         time_interval=None):
+
+    # This function is the incremental version of rerun_qc_tests.
+    # It reruns the QC tests for the data from the time "since"
+    # onward (and for the observation before it, whose spike test
+    # depends on the next observation), using only as much of the
+    # earlier data as the tests look back over. The flags are the
+    # same as those from rerunning the tests on the whole (time
+    # sorted) dataset, and the flags of the earlier data are kept.
+    #
+    # The flat line test converts its time period into a number of
+    # observations using the median time step of the data, so the
+    # tests are run with the native QARTOD engine, which can be
+    # given the median time step of the whole dataset (or the
+    # given time step, e.g., that of a longer record).
+
+    times = ds_xr['time'].to_numpy()
+    first_new = int(np.searchsorted(times, pd.Timestamp(since).to_datetime64()))
+    if first_new >= times.size:
+        print('   No data to rerun the QC tests on.')
+        return ds_xr
+
+    if qc_limits is None:
+        qc_limits = get_buoy_qc_limits(ds_xr, loc_id, smartflag)
+
+    # Find the first observation whose flags are recomputed,
+    # and the first observation needed to recompute them
+    qc_interval = time_interval
+    if qc_interval is None:
+        qc_interval = get_qc_time_interval(ds_xr)
+    lookback = bb_qc.qartod_lookback(qc_limits, qc_interval)
+    first_flag = max(first_new - 1, 0)
+    first_window = max(first_flag - lookback, 0)
+
+    # The flags from part of the data only match those from all of
+    # the data if the part does not change whether a sensor has no
+    # valid data (in which case the tests are not run)
+    for varname in ds_xr.keys():
+        if not(varname.endswith('_qc_agg')):
+            continue
+        sensor = varname[:-len('_qc_agg')]
+        values = ds_xr[sensor].data.flatten().astype(float)
+        window_values = values[first_window:]
+        if ((np.all(np.isnan(values)), np.all(values == -555)) !=
+            (np.all(np.isnan(window_values)), np.all(window_values == -555))):
+            print('   Rerun the QC tests on all of the data.')
+            return rerun_qc_tests(ds_xr, loc_id, smartflag, qc_limits, time_interval)
+
+    print('   Rerun the QC tests on ' + str(times.size - first_flag) +
+          ' of ' + str(times.size) + ' observations (' +
+          str(first_flag - first_window) + ' earlier observations used).')
+
+    # Rerun the QC flagging on the end of the dataset
+    ds_rerun = ds_xr.isel(time=slice(first_window, None)).to_dataframe().reset_index()
+    ds_qc = get_buoy_qcflags(ds_rerun, loc_id, smartflag, qc_limits,
+                             engine='native', time_interval=qc_interval)
+
+    # Update the results in the xarray dataset for each qc
+    # test, for the observations whose flags were recomputed,
+    # and count the observations whose packed flags changed
+    changed = np.zeros(times.size - first_flag, dtype=bool)
+    for varname in ds_xr.keys():
+        if not(varname.endswith('_qc_agg')):
+            continue
+        sensor = varname[:-len('_qc_agg')]
+        tests = [col[len(sensor + '_qartod_'):] for col in ds_qc.columns
+                 if col.startswith(sensor + '_qartod_')]
+        qc_cols = bb_flags.flag_varnames(sensor, tests, prefix='_qartod_')
+        qc_names = bb_flags.flag_varnames(sensor, tests)
+
+        old_planes = bb_flags.read_flag_planes(ds_xr, qc_names, start=first_flag)
+        new_planes = bb_flags.to_flag_planes([ds_qc[col].to_numpy()[first_flag-first_window:]
+                                              for col in qc_cols])
+        changed |= bb_flags.pack_flags(old_planes) != bb_flags.pack_flags(new_planes)
+        bb_flags.write_flag_planes(ds_xr, qc_names, new_planes, start=first_flag)
+
+    print('   QC flags changed for ' + str(np.count_nonzero(changed)) + ' observations.')
+
+    return ds_xr
+
+
 # In[ ]:
 
 
 def check_duplicates(ds_all):
     
-    ds_time = [pd.Timestamp(ii).to_pydatetime() 
-               for ii in ds_all.sortby('time').variables['time'].data]
+    ds_time = datetime64_to_epoch(ds_all.sortby('time').variables['time'].data)
 
     print('   Checking for duplicates...')
-    if np.any([np.diff(ds_time) == datetime.timedelta(seconds=0)]):
-        dupinds = np.where([ii == datetime.timedelta(seconds=0) for ii in np.diff(ds_time)])[0]
+    if np.any(np.diff(ds_time) == 0):
+        dupinds = np.where(np.diff(ds_time) == 0)[0]
         print('      Duplicates found to merge... # of duplicates: ' + str(len(dupinds)))
 
         ds_all_nodups = ds_all.copy().drop_duplicates(dim='time', keep='last')
@@ -1291,8 +1629,7 @@ def get_location_metadata(loc_id):
     if not(os.path.exists(pathdir)):
         return None
     else:
-        with open(pathdir) as meta_json:
-            meta = json.load(meta_json)
+        meta = bb.load_json_file(pathdir)
     
         
     return meta['metadata']
@@ -1391,10 +1728,70 @@ def netcdf_add_global_metadata(dataset, loc_id, smartflag=False):
 # In[ ]:
 
 
+def get_netcdf_encoding(varname, datatype, profile=None):
+
+    # Get the data type of a netCDF variable, and the encoding
+    # settings of the profile (by default, NETCDF_ENCODING).
+    # The data type is changed if part of the variable name
+    # matches one of the data types of the profile.
+    if profile is None:
+        profile = NETCDF_ENCODING
+    encoding = NETCDF_ENCODING_PROFILES[profile]
+    for name_part, name_datatype in encoding.get('datatypes', {}).items():
+        if name_part in varname:
+            datatype = name_datatype
+            break
+
+    return datatype, encoding
+
+
+# In[ ]:
+
+
+def netcdf_create_variable(dataset, varname, datatype, dimensions):
+
+    # Create a variable in a netCDF file, with the data type,
+    # compression, and chunking of the encoding profile.
+    #
+    # If the time dimension of the file is unlimited (so that new
+    # records can be appended to it), variables along time are
+    # chunked by NETCDF_TIME_CHUNK records (unless the profile sets
+    # the chunks), as the default chunks of an unlimited dimension
+    # hold a single record.
+    if isinstance(dimensions, str):
+        dimensions = (dimensions,)
+    datatype, encoding = get_netcdf_encoding(varname, datatype)
+    if 'time' not in dimensions:
+        return dataset.createVariable(varname, datatype, dimensions)
+
+    encoding_kwargs = {}
+    ntimes = len(dataset.dimensions['time'])
+    if dataset.dimensions['time'].isunlimited():
+        time_chunk = encoding.get('time_chunk') or NETCDF_TIME_CHUNK
+    elif ('time_chunk' in encoding) and (ntimes > 0):
+        time_chunk = min(encoding['time_chunk'] or ntimes, ntimes)
+    else:
+        time_chunk = None
+    if time_chunk is not None:
+        encoding_kwargs['chunksizes'] = [time_chunk if dim == 'time' else len(dataset.dimensions[dim])
+                                         for dim in dimensions]
+
+    # Variable length strings cannot be compressed
+    if encoding.get('zlib', False) and not(str(datatype).startswith('S')):
+        encoding_kwargs['zlib'] = True
+        encoding_kwargs['complevel'] = encoding.get('complevel', 4)
+        encoding_kwargs['shuffle'] = encoding.get('shuffle', True)
+
+    return dataset.createVariable(varname, datatype, dimensions, **encoding_kwargs)
+
+
+# In[ ]:
+
+
 def netcdf_add_variables(dataset, loc_id, ds):
     
     # Location platform Code
-    platform = dataset.createVariable('location_id','S'+str(int(len(loc_id))),('location_id',))
+    platform = netcdf_create_variable(dataset, 'location_id','S'+str(int(len(loc_id))),('location_id',))
     platform.long_name = 'location_id'
     platform.description = 'Backyard Buoys Location ID'
     platform.cf_role = 'timeseries_id'
@@ -1407,7 +1804,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     # Identifying variables
     
     # Time
-    datatime = dataset.createVariable('time','f8',('time'))
+    datatime = netcdf_create_variable(dataset, 'time','f8',('time'))
     datatime.standard_name = 'time'
     datatime.long_name = 'time'
     datatime.description = 'time of sampling'
@@ -1416,22 +1813,19 @@ def netcdf_add_variables(dataset, loc_id, ds):
     datatime.calendar = 'gregorian'
     datatime.gts_ingest = 'true'
     
-    datadates = [pd.Timestamp(ii).to_pydatetime() for ii in ds['time'].data]
-    reftime = datetime.datetime(1970,1,1)
-    timestamp = [(ii-reftime).total_seconds() for ii in datadates]
-    datatime[:] = timestamp
+    datatime[:] = datetime64_to_epoch(ds['time'].data)
     
     # Spotter ID code
-    spotter = dataset.createVariable('buoy_id','S11',('location_id','time'))
+    spotter = netcdf_create_variable(dataset, 'buoy_id','S11',('location_id','time'))
     spotter.long_name = 'buoy_id'
     spotter.description = 'Backyard Buoys Sofar Spotter Buoy ID'
     spotter.ioos_category = 'Identifier'
     spotter.units = '1'
     spotter.gts_ingest = 'false'
-    spotter[:] = ds['buoy_id'][0].data
+    spotter[:] = ds['buoy_id'].data
     
     # Latitude/longitude
-    latitude = dataset.createVariable('latitude','f8',('location_id','time'))
+    latitude = netcdf_create_variable(dataset, 'latitude','f8',('location_id','time'))
     latitude.standard_name = 'latitude'
     latitude.long_name = 'latitude'
     latitude.description = 'Latitude'
@@ -1440,7 +1834,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     latitude.gts_ingest = 'true'
     latitude[:] = ds['latitude']
     
-    longitude = dataset.createVariable('longitude','f8',('location_id','time'))
+    longitude = netcdf_create_variable(dataset, 'longitude','f8',('location_id','time'))
     longitude.standard_name = 'longitude'
     longitude.long_name = 'longitude'
     longitude.description = 'Longitude'
@@ -1474,7 +1868,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     ###
     # Wave height
     
-    waveheight = dataset.createVariable('sea_surface_wave_significant_height','f8',('location_id','time'))
+    waveheight = netcdf_create_variable(dataset, 'sea_surface_wave_significant_height','f8',('location_id','time'))
     waveheight.standard_name = 'sea_surface_wave_significant_height'
     waveheight.long_name = 'sea_surface_wave_significant_height'
     waveheight.description = 'Significant Wave Height of Surface Waves'
@@ -1488,7 +1882,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     ###
     # Mean period waves
     
-    meanperiod = dataset.createVariable('sea_surface_wave_mean_period','f8',('location_id','time'))
+    meanperiod = netcdf_create_variable(dataset, 'sea_surface_wave_mean_period','f8',('location_id','time'))
     meanperiod.standard_name = 'sea_surface_wave_mean_period'
     meanperiod.long_name = 'sea_surface_wave_mean_period'
     meanperiod.description = 'Mean Wave Period'
@@ -1499,7 +1893,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     meanperiod.ancillary_variables = make_ancvar_str('sea_surface_wave_mean_period')
     meanperiod[:] = ds['sea_surface_wave_mean_period']
     
-    meanperiod_direction = dataset.createVariable('sea_surface_wave_from_direction','f8',('location_id','time'))
+    meanperiod_direction = netcdf_create_variable(dataset, 'sea_surface_wave_from_direction','f8',('location_id','time'))
     meanperiod_direction.standard_name = 'sea_surface_wave_from_direction'
     meanperiod_direction.long_name = 'sea_surface_wave_from_direction'
     meanperiod_direction.description = 'Mean Wave Direction'
@@ -1510,7 +1904,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     meanperiod_direction.ancillary_variables = make_ancvar_str('sea_surface_wave_from_direction')
     meanperiod_direction[:] = ds['sea_surface_wave_from_direction']
     
-    meanperiod_spread = dataset.createVariable('sea_surface_wave_directional_spread','f8',('location_id','time'))
+    meanperiod_spread = netcdf_create_variable(dataset, 'sea_surface_wave_directional_spread','f8',('location_id','time'))
     meanperiod_spread.standard_name = 'sea_surface_wave_directional_spread'
     meanperiod_spread.long_name = 'sea_surface_wave_directional_spread'
     meanperiod_spread.description = 'Mean Wave Directional Spread'
@@ -1524,7 +1918,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     ###
     # Peak period waves
     
-    peakperiod = dataset.createVariable('sea_surface_wave_period_at_variance_spectral_density_maximum','f8',('location_id','time'))
+    peakperiod = netcdf_create_variable(dataset, 'sea_surface_wave_period_at_variance_spectral_density_maximum','f8',('location_id','time'))
     peakperiod.standard_name = 'sea_surface_wave_period_at_variance_spectral_density_maximum'
     peakperiod.long_name = 'sea_surface_wave_period_at_variance_spectral_density_maximum'
     peakperiod.description = 'Peak Wave Period'
@@ -1535,7 +1929,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     peakperiod.ancillary_variables = make_ancvar_str('sea_surface_wave_period_at_variance_spectral_density_maximum')
     peakperiod[:] = ds['sea_surface_wave_period_at_variance_spectral_density_maximum']
     
-    peakperiod_direction = dataset.createVariable('sea_surface_wave_from_direction_at_variance_spectral_density_maximum','f8',('location_id','time'))
+    peakperiod_direction = netcdf_create_variable(dataset, 'sea_surface_wave_from_direction_at_variance_spectral_density_maximum','f8',('location_id','time'))
     peakperiod_direction.standard_name = 'sea_surface_wave_from_direction_at_variance_spectral_density_maximum'
     peakperiod_direction.long_name = 'sea_surface_wave_from_direction_at_variance_spectral_density_maximum'
     peakperiod_direction.description = 'Peak Wave Direction'
@@ -1546,7 +1940,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     peakperiod_direction.ancillary_variables = make_ancvar_str('sea_surface_wave_from_direction_at_variance_spectral_density_maximum')
     peakperiod_direction[:] = ds['sea_surface_wave_from_direction_at_variance_spectral_density_maximum']
     
-    peakperiod_spread = dataset.createVariable('sea_surface_wave_directional_spread_at_variance_spectral_density_maximum','f8',('location_id','time'))
+    peakperiod_spread = netcdf_create_variable(dataset, 'sea_surface_wave_directional_spread_at_variance_spectral_density_maximum','f8',('location_id','time'))
     peakperiod_spread.standard_name = 'sea_surface_wave_directional_spread_at_variance_spectral_density_maximum'
     peakperiod_spread.long_name = 'sea_surface_wave_directional_spread_at_variance_spectral_density_maximum'
     peakperiod_spread.description = 'Peak Wave Directional Spread'
@@ -1560,7 +1954,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
     ###
     # Sea surface temperature
     
-    seatemp = dataset.createVariable('sea_water_temperature','f8',('location_id','time'))
+    seatemp = netcdf_create_variable(dataset, 'sea_water_temperature','f8',('location_id','time'))
     seatemp.standard_name = 'sea_water_temperature'
     seatemp.long_name = 'sea_water_temperature'
     seatemp.description = 'Sea Water Temperature at the Surface'
@@ -1612,14 +2006,17 @@ def netcdf_add_variables(dataset, loc_id, ds):
         origvar = orig_varnames[ii]
         var = varnames[ii]
         varlabel = varlabs[ii]
+
+        # Read all of the flags of the variable at once, as flag planes
+        qc_planes = bb_flags.read_flag_planes(ds, [var + '_' + origqc_var
+                                                   for origqc_var in origqc_vars])
         for jj in range(0,len(qc_vars)):
-            origqc_var = origqc_vars[jj]
             qc_var = qc_vars[jj]
             qc_standard = qc_standards[jj]
             qc_lab = qc_labs[jj]
             
             # Create new variable
-            temp_qcvar = dataset.createVariable(var + '_' + qc_var,'i4',('location_id','time'))
+            temp_qcvar = netcdf_create_variable(dataset, var + '_' + qc_var,'i4',('location_id','time'))
             temp_qcvar.standard_name = qc_standard
             temp_qcvar.long_name = var + '_' + qc_var
             temp_qcvar.description = varlabel + ' ' + qc_lab
@@ -1630,7 +2027,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
             temp_qcvar.flag_meanings = 'PASS NOT_EVALUATED SUSPECT FAIL MISSING'
             if qc_var == 'qc_agg':
                 temp_qcvar.gts_ingest = 'true'
-            temp_qcvar[:] = ds[var + '_' + origqc_var]
+            temp_qcvar[:] = qc_planes[jj][np.newaxis, :]
     
     
     return dataset
@@ -1642,7 +2039,7 @@ def netcdf_add_variables(dataset, loc_id, ds):
 def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
     
     # Location platform Code
-    platform = dataset.createVariable('location_id','S'+str(int(len(loc_id))),('location_id',))
+    platform = netcdf_create_variable(dataset, 'location_id','S'+str(int(len(loc_id))),('location_id',))
     platform.long_name = 'location_id'
     platform.description = 'Backyard Buoys Location ID'
     platform.cf_role = 'timeseries_id'
@@ -1655,7 +2052,7 @@ def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
     # Identifying variables
     
     # Time
-    datatime = dataset.createVariable('time','f8',('time'))
+    datatime = netcdf_create_variable(dataset, 'time','f8',('time'))
     datatime.standard_name = 'time'
     datatime.long_name = 'time'
     datatime.description = 'time of sampling'
@@ -1664,22 +2061,19 @@ def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
     datatime.calendar = 'gregorian'
     datatime.gts_ingest = 'true'
     
-    datadates = [pd.Timestamp(ii).to_pydatetime() for ii in ds_smart['time'].data]
-    reftime = datetime.datetime(1970,1,1)
-    timestamp = [(ii-reftime).total_seconds() for ii in datadates]
-    datatime[:] = timestamp
+    datatime[:] = datetime64_to_epoch(ds_smart['time'].data)
     
     # Spotter ID code
-    spotter = dataset.createVariable('buoy_id','S11',('location_id','time'))
+    spotter = netcdf_create_variable(dataset, 'buoy_id','S11',('location_id','time'))
     spotter.long_name = 'buoy_id'
     spotter.description = 'Backyard Buoys Sofar Spotter Buoy ID'
     spotter.ioos_category = 'Identifier'
     spotter.units = '1'
     spotter.gts_ingest = 'false'
-    spotter[:] = ds_smart['buoy_id'][0].data
+    spotter[:] = ds_smart['buoy_id'].data
     
     # Latitude/longitude
-    latitude = dataset.createVariable('latitude','f8',('location_id','time'))
+    latitude = netcdf_create_variable(dataset, 'latitude','f8',('location_id','time'))
     latitude.standard_name = 'latitude'
     latitude.long_name = 'latitude'
     latitude.description = 'Latitude'
@@ -1688,7 +2082,7 @@ def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
     latitude.gts_ingest = 'true'
     latitude[:] = ds_smart['latitude']
     
-    longitude = dataset.createVariable('longitude','f8',('location_id','time'))
+    longitude = netcdf_create_variable(dataset, 'longitude','f8',('location_id','time'))
     longitude.standard_name = 'longitude'
     longitude.long_name = 'longitude'
     longitude.description = 'Longitude'
@@ -1699,7 +2093,7 @@ def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
     
     # Depth
     
-    depth = dataset.createVariable('depth','f8',('location_id','time'))
+    depth = netcdf_create_variable(dataset, 'depth','f8',('location_id','time'))
     depth.standard_name = 'depth'
     depth.long_name = 'depth'
     depth.description = 'Z-coordinate of observation in vertical distance below reference. Down is positive. (reference is sea surface)'
@@ -1743,7 +2137,7 @@ def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
         
         if smartvar == 'sea_water_temperature':            
             # Water temperature
-            temper = dataset.createVariable('sea_water_temperature','f8',('location_id','time'))
+            temper = netcdf_create_variable(dataset, 'sea_water_temperature','f8',('location_id','time'))
             temper.standard_name = 'sea_water_temperature'
             temper.long_name = 'sea_water_temperature'
             temper.description = 'Sea Water Temperature'
@@ -1783,14 +2177,17 @@ def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
         origvar = orig_varnames[ii]
         var = varnames[ii]
         varlabel = varlabs[ii]
+
+        # Read all of the flags of the variable at once, as flag planes
+        qc_planes = bb_flags.read_flag_planes(ds_smart, [var + '_' + origqc_var
+                                                         for origqc_var in origqc_vars])
         for jj in range(0,len(qc_vars)):
-            origqc_var = origqc_vars[jj]
             qc_var = qc_vars[jj]
             qc_standard = qc_standards[jj]
             qc_lab = qc_labs[jj]
             
             # Create new variable
-            temp_qcvar = dataset.createVariable(var + '_' + qc_var,'i4',('location_id','time'))
+            temp_qcvar = netcdf_create_variable(dataset, var + '_' + qc_var,'i4',('location_id','time'))
             temp_qcvar.standard_name = qc_standard
             temp_qcvar.long_name = var + '_' + qc_var
             temp_qcvar.description = varlabel + ' ' + qc_lab
@@ -1801,7 +2198,7 @@ def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
             temp_qcvar.flag_meanings = 'PASS NOT_EVALUATED SUSPECT FAIL MISSING'
             if qc_var == 'qc_agg':
                 temp_qcvar.gts_ingest = 'true'
-            temp_qcvar[:] = ds_smart[var + '_' + origqc_var]
+            temp_qcvar[:] = qc_planes[jj][np.newaxis, :]
     
     
     return dataset
@@ -1810,12 +2207,589 @@ def netcdf_add_smart_variables(dataset, loc_id, ds_smart, smart_vars):
 # In[ ]:
 
 
-def write_netcdf(ds, loc_id, datayear, datamonth, smart_vars=None):
+def get_netcdf_filename(loc_id, datayear, datamonth, smartflag=False):
+
+    # Define the name of the monthly netCDF file
+    # of a location (e.g., bb_{loc_id}_202401.nc)
+    datayear_str = str(int(datayear))
+    if datamonth < 10:
+        datamonth_str = '0' + str(int(datamonth))
+    else:
+        datamonth_str = str(int(datamonth))
+    if smartflag:
+        return 'bb_' + loc_id + '_smart_' + datayear_str + datamonth_str + '.nc'
+    else:
+        return 'bb_' + loc_id + '_' + datayear_str + datamonth_str + '.nc'
+
+
+# In[ ]:
+
+
+def netcdf_record_values(ds, varname, datatype=None):
+
+    # Get the values of a (location_id, time) variable of the
+    # dataset, as they are written to the netCDF file (in the
+    # data type of the file variable, if given)
+    if '_qc_' in varname:
+        values = bb_flags.read_flag_planes(ds, [varname])[0]
+    else:
+        values = np.asarray(ds[varname].data).reshape(-1)
+        if varname == 'buoy_id':
+            return values
+        values = values.astype(float)
+        if varname == 'depth':
+            # The smart mooring depths are written as positive values
+            values = np.abs(values)
+    if datatype is not None:
+        values = values.astype(datatype)
+
+    return values
+
+
+# In[ ]:
+
+
+def parse_netcdf_filename(loc_id, ncfile):
+
+    # Get the data year, month, and smart mooring flag of a
+    # monthly netCDF file of a location from its name (the
+    # reverse of get_netcdf_filename), or None if the file
+    # is not a monthly netCDF file of the location
+    prefix = 'bb_' + loc_id + '_'
+    if not(ncfile.startswith(prefix)) or not(ncfile.endswith('.nc')):
+        return None
+    dataperiod = ncfile[len(prefix):-len('.nc')]
+    smartflag = dataperiod.startswith('smart_')
+    if smartflag:
+        dataperiod = dataperiod[len('smart_'):]
+    if (len(dataperiod) != 6) or not(dataperiod.isdigit()):
+        return None
+
+    return int(dataperiod[:4]), int(dataperiod[4:]), smartflag
+
+
+# In[ ]:
+
+
+def get_netcdf_index_path(loc_id):
+
+    # The index (catalog) of the monthly netCDF
+    # files of a location is kept with its metadata
+    basedir = bb.get_datadir()
+    return os.path.join(basedir, loc_id, 'metadata', loc_id + '_netcdf_index.json')
+
+
+# In[ ]:
+
+
+def get_netcdf_path(loc_id, ncfile, netcdf_index=None):
+
+    # Get the full path of a monthly netCDF file of a location
+    # (in the directory recorded in the index; otherwise, the
+    # data directory of the location)
+    basedir = bb.get_datadir()
+    if (netcdf_index is not None) and (ncfile in netcdf_index):
+        return os.path.join(basedir, netcdf_index[ncfile]['directory'], ncfile)
+
+    return os.path.join(basedir, loc_id, ncfile)
+
+
+# In[ ]:
+
+
+def load_netcdf_index(loc_id):
+
+    # Load the index (catalog) of the monthly netCDF files of a
+    # location, {filename: entry}, where each entry records:
+    #   'directory' - the directory of the file (loc_id, or
+    #                 loc_id + '_smart' for older smart mooring files)
+    #   'time_coverage_start', 'time_coverage_end' - the first and last times
+    #   'nrecords' - the number of records
+    #   'spotters' - the spotters with records in the file
+    #   'variables' - the (location_id, time) variables of the file
+    #   'fingerprint' - the hash of the contents (see netcdf_fingerprint)
+    #   'block_fingerprints' - the hashes of each block of records
+    #                          (see netcdf_block_fingerprints)
+    #   'metadata_hash' - the hash of the metadata the file was written
+    #                     with (see get_netcdf_metadata_hash)
+    #   'written' - the time the file was last written
+    #
+    # The first time the index is loaded in a run, it is
+    # checked against the files in the data directories,
+    # so files that are not in it (e.g., written before the index was
+    # kept) are opened once and added to it (with no fingerprint), and
+    # the entries of files that no longer exist are dropped. After that,
+    # the files written in the run are added by update_netcdf_index,
+    # so the index is read as it is. Otherwise, the files are found
+    # without opening them.
+    basedir = bb.get_datadir()
+    indexpath = get_netcdf_index_path(loc_id)
+    netcdf_index = read_netcdf_index(loc_id)
+    if indexpath in _netcdf_index_checked:
+        return netcdf_index
+
+    # Find the monthly files in the data directories
+    # (older smart mooring files are in their own directory,
+    #  which is used in place of the data directory)
+    ncfiles = {}
+    for datadir in [loc_id + '_smart', loc_id]:
+        if os.path.exists(os.path.join(basedir, datadir)):
+            for ncfile in os.listdir(os.path.join(basedir, datadir)):
+                if parse_netcdf_filename(loc_id, ncfile) is not None:
+                    ncfiles.setdefault(ncfile, datadir)
+
+    changedflag = False
+    for ncfile in list(netcdf_index):
+        if ((ncfile not in ncfiles) or
+            (netcdf_index[ncfile].get('directory', ncfiles[ncfile]) != ncfiles[ncfile])):
+            del netcdf_index[ncfile]
+            changedflag = True
+    for ncfile in sorted(ncfiles):
+        # Entries of older indexes (with only the fingerprint,
+        # number of records, and write time) are filled in
+        # from the file, keeping the fingerprint
+        if (ncfile not in netcdf_index) or ('directory' not in netcdf_index[ncfile]):
+            entry = index_netcdf_file(os.path.join(basedir, ncfiles[ncfile], ncfile))
+            entry['fingerprint'] = netcdf_index.get(ncfile, {}).get('fingerprint')
+            netcdf_index[ncfile] = entry
+            changedflag = True
+    if changedflag:
+        write_netcdf_index(loc_id, netcdf_index)
+    _netcdf_index_checked.add(indexpath)
+
+    return netcdf_index
+
+
+# In[ ]:
+
+
+def read_netcdf_index(loc_id):
+
+    # Read the index of the monthly netCDF files of a location as
+    # it is, without checking it against the data directories
+    # (see load_netcdf_index), or an empty index if there is none
+    indexpath = get_netcdf_index_path(loc_id)
+    if not(os.path.exists(indexpath)):
+        return {}
+
+    return bb.load_json_file(indexpath)
+
+
+# In[ ]:
+
+
+def netcdf_file_variables(ncpath):
+
+    # Get the names and data types of the (location_id, time)
+    # variables of a netCDF file (with None for string variables)
+    from netCDF4 import Dataset
+
+    with Dataset(ncpath, 'r') as dataset:
+        file_vars = {varname: (ncvar.dtype if isinstance(ncvar.dtype, np.dtype) else None)
+                     for varname, ncvar in dataset.variables.items()
+                     if ncvar.dimensions == ('location_id', 'time')}
+
+    return file_vars
+
+
+# In[ ]:
+
+
+def get_netcdf_metadata_hash(loc_id, smartflag=False):
+
+    # Get a hash of the metadata that the netCDF files of a location
+    # are written with: the location metadata (see make_projects_metadata
+    # in backyardbuoys_build_metadata), from which the global attributes
+    # are set, and the QC limits (see get_qc_config_hash)
+    metadata = {'metadata': get_location_metadata(loc_id),
+                'qc_config_hash': get_qc_config_hash(loc_id, smartflag)}
+    metadata_json = json.dumps(metadata, sort_keys=True, default=str)
+
+    return hashlib.sha256(metadata_json.encode()).hexdigest()
+
+
+# In[ ]:
+
+
+def netcdf_fingerprint(ds, file_vars, metadata_hash=None):
+
+    # Compute a fingerprint of the contents of a monthly netCDF file:
+    # a hash of the times and of the values (and flags) of each of
+    # the file variables ({name: data type}), as they are written to
+    # the file, of the encoding profile (so that the files are
+    # rewritten when the profile changes), and of the metadata hash
+    # (see get_netcdf_metadata_hash; so that the files are rewritten
+    # when their metadata changes). If any of the variables are
+    # missing, there is no fingerprint.
+    if any([varname not in ds.keys() for varname in file_vars]):
+        return None
+
+    fingerprint = hashlib.sha256(NETCDF_ENCODING.encode())
+    if metadata_hash is not None:
+        fingerprint.update(metadata_hash.encode())
+    timestamp = datetime64_to_epoch(ds['time'].data)
+    fingerprint.update(np.ascontiguousarray(timestamp, dtype='<f8').tobytes())
+    for varname in sorted(file_vars):
+        fingerprint.update(varname.encode())
+        netcdf_hash_values(fingerprint, netcdf_record_values(ds, varname, file_vars[varname]))
+
+    return fingerprint.hexdigest()
+
+
+# In[ ]:
+
+
+def netcdf_hash_values(fingerprint, values):
+
+    # Add the values of a variable, as they are
+    # written to the file, to a fingerprint (hash)
+    if values.dtype.kind in 'OSU':
+        fingerprint.update('\x00'.join([str(ii) for ii in values]).encode())
+    else:
+        # NaNs are given a single bit pattern
+        if values.dtype.kind == 'f':
+            values = np.where(np.isnan(values), np.nan, values)
+        fingerprint.update(np.ascontiguousarray(values, dtype=values.dtype.newbyteorder('<')).tobytes())
+
+
+# In[ ]:
+
+
+def netcdf_block_fingerprints(ds, file_vars):
+
+    # Compute the fingerprints of each block of NETCDF_APPEND_BLOCK
+    # records of a monthly netCDF file (the last block may be shorter),
+    # in the same way as netcdf_fingerprint. These are kept in the index,
+    # so that appending to a file only rewrites the records from the
+    # first block that changed, without reading the file.
+    # If any of the file variables are missing, there are no fingerprints.
+    if any([varname not in ds.keys() for varname in file_vars]):
+        return None
+
+    timestamp = datetime64_to_epoch(ds['time'].data)
+    record_values = {varname: netcdf_record_values(ds, varname, file_vars[varname])
+                     for varname in sorted(file_vars)}
+    block_fingerprints = []
+    for block_start in range(0, len(timestamp), NETCDF_APPEND_BLOCK):
+        block = slice(block_start, block_start + NETCDF_APPEND_BLOCK)
+        fingerprint = hashlib.sha256(NETCDF_ENCODING.encode())
+        fingerprint.update(np.ascontiguousarray(timestamp[block], dtype='<f8').tobytes())
+        for varname in record_values:
+            fingerprint.update(varname.encode())
+            netcdf_hash_values(fingerprint, record_values[varname][block])
+        # Short digests keep the index small
+        block_fingerprints.append(fingerprint.hexdigest()[:16])
+
+    return block_fingerprints
+
+
+# In[ ]:
+
+
+def netcdf_index_entry(datadir, times, spotters, file_vars, fingerprint, written,
+                       block_fingerprints=None, metadata_hash=None):
+
+    # Make the index entry of a monthly netCDF file
+    # (see load_netcdf_index), from its times (datetime64),
+    # spotters, and variables ({name: data type})
+    times = np.asarray(times, dtype='datetime64[ns]')
+    times = times[~np.isnat(times)]
+    if times.size > 0:
+        time_coverage = [pd.Timestamp(times.min()).strftime(DATETIME_FORMAT),
+                         pd.Timestamp(times.max()).strftime(DATETIME_FORMAT)]
+    else:
+        time_coverage = [None, None]
+    spotters = [ii.decode() if isinstance(ii, bytes) else str(ii)
+                for ii in pd.unique(np.ravel(spotters))]
+
+    return {'directory': datadir,
+            'time_coverage_start': time_coverage[0],
+            'time_coverage_end': time_coverage[1],
+            'nrecords': int(np.size(times)),
+            'spotters': sorted([ii for ii in spotters if ii != '']),
+            'variables': sorted(file_vars),
+            'fingerprint': fingerprint,
+            'block_fingerprints': block_fingerprints,
+            'metadata_hash': metadata_hash,
+            'written': written}
+
+
+# In[ ]:
+
+
+def index_netcdf_file(ncpath):
+
+    # Make the index entry of a monthly netCDF file that is
+    # not in the index, from the file itself. The fingerprint
+    # is not known, so the file is not skipped the next time
+    # it is written.
+    from netCDF4 import Dataset
+
+    file_vars = netcdf_file_variables(ncpath)
+    with Dataset(ncpath, 'r') as dataset:
+        times = np.ma.filled(np.ma.asarray(dataset['time'][:], dtype=float), np.nan)
+        if 'buoy_id' in dataset.variables:
+            spotters = np.ma.filled(dataset['buoy_id'][:], '')
+        else:
+            spotters = []
+    times = pd.to_datetime(times, unit='s').to_numpy(dtype='datetime64[ns]')
+    written = datetime.datetime.fromtimestamp(os.path.getmtime(ncpath),
+                                              datetime.timezone.utc).strftime(DATETIME_FORMAT)
+
+    return netcdf_index_entry(os.path.basename(os.path.dirname(ncpath)),
+                              times, spotters, file_vars, None, written)
+
+
+# In[ ]:
+
+
+def write_netcdf_index(loc_id, netcdf_index):
+
+    # Write the index of the monthly netCDF files of a location
+    indexpath = get_netcdf_index_path(loc_id)
+    if not(os.path.exists(os.path.dirname(indexpath))):
+        os.makedirs(os.path.dirname(indexpath))
+
+    # Write the index to a temporary file, and move it into
+    # place, so that the index is never partly written
+    with open(indexpath + '.tmp', 'w') as index_json:
+        json.dump(netcdf_index, index_json, indent=4)
+    os.replace(indexpath + '.tmp', indexpath)
+
+
+# In[ ]:
+
+
+def update_netcdf_index(loc_id, ncfile, ds):
+
+    # Record the entry (with the fingerprint) of a monthly
+    # netCDF file that was just written in the index of the location
+    # (the other entries are left as they are)
+    basedir = bb.get_datadir()
+    ncpath = os.path.join(basedir, loc_id, ncfile)
+    file_vars = netcdf_file_variables(ncpath)
+    metadata_hash = get_netcdf_metadata_hash(loc_id, parse_netcdf_filename(loc_id, ncfile)[2])
+
+    netcdf_index = read_netcdf_index(loc_id)
+    netcdf_index[ncfile] = netcdf_index_entry(loc_id, ds['time'].data,
+                                              ds['buoy_id'].data if 'buoy_id' in ds.keys() else [],
+                                              file_vars, netcdf_fingerprint(ds, file_vars, metadata_hash),
+                                              datetime.datetime.now(datetime.timezone.utc).strftime(DATETIME_FORMAT),
+                                              netcdf_block_fingerprints(ds, file_vars),
+                                              metadata_hash)
+    write_netcdf_index(loc_id, netcdf_index)
+
+
+# In[ ]:
+
+
+def get_netcdf_time_bounds(loc_id, smartflag=False):
+
+    # Get the first and last times (as datetimes) of the monthly
+    # netCDF files of a location, from the netCDF index (without
+    # opening the files), or None if there are no files
+    netcdf_index = load_netcdf_index(loc_id)
+    entries = [entry for ncfile, entry in netcdf_index.items()
+               if (parse_netcdf_filename(loc_id, ncfile)[2] == smartflag) and
+                  (entry['time_coverage_start'] is not None)]
+    if len(entries) == 0:
+        return None
+
+    return [datetime.datetime.strptime(min([entry['time_coverage_start'] for entry in entries]), DATETIME_FORMAT),
+            datetime.datetime.strptime(max([entry['time_coverage_end'] for entry in entries]), DATETIME_FORMAT)]
+
+
+# In[ ]:
+
+
+def get_netcdf_write_stats():
+
+    # Return the counts of the monthly netCDF files written,
+    # and skipped as unchanged, during this run
+    return dict(_netcdf_write_stats)
+
+
+# In[ ]:
+
+
+def reset_netcdf_write_stats():
+
+    # Reset the counts of the monthly netCDF files written
+    # (e.g., at the start of an update in a worker process)
+    for key in _netcdf_write_stats:
+        _netcdf_write_stats[key] = 0
+
+
+# In[ ]:
+
+
+def add_netcdf_write_stats(write_stats):
+
+    # Add the counts of the monthly netCDF files written by a
+    # worker process (see update_location_to_log) to the counts
+    # of this process, as the workers do not share them
+    for key in _netcdf_write_stats:
+        _netcdf_write_stats[key] += write_stats.get(key, 0)
+
+
+# In[ ]:
+
+
+def print_netcdf_write_stats():
+
+    # Print a summary of the monthly netCDF files written during this run
+    stats = get_netcdf_write_stats()
+    if stats['written'] + stats['skipped'] == 0:
+        return
+    print('NetCDF files: ' + str(stats['written']) + ' written, ' +
+          str(stats['skipped']) + ' skipped as unchanged')
+
+
+# In[ ]:
+
+
+def append_netcdf(ds, loc_id, datayear, datamonth, smart_vars=None):
+
+    # This function adds the new records of a month of data to
+    # the existing netCDF file of that month, rather than writing
+    # the whole file again. Records already in the file are only
+    # rewritten from the first block of records whose values (or
+    # flags) changed, which is found from the block fingerprints in
+    # the netCDF index, so the records in the file are not read.
+    #
+    # The records are written into a copy of the file, which is then
+    # renamed over the file, so that ERDDAP never sees a partly
+    # written file, and the file is left as it was if the append fails.
+    #
+    # If APPEND_NETCDF_IN_PLACE is set, the records are written into
+    # the file itself (saving the copy of the file, at the cost of
+    # ERDDAP possibly reading a partly appended file). While they are
+    # written, the fingerprints of the file are cleared from the index,
+    # so if the write fails (or is interrupted), the file is rewritten
+    # in full the next time.
+    #
+    # Returns True if the file is up to date, and False if the file
+    # has to be rewritten in full (e.g., if it does not exist, it
+    # has a fixed time dimension or no block fingerprints, or records
+    # were removed from it, or its metadata changed, as the global
+    # and variable attributes are not written again).
+
+    from netCDF4 import Dataset
+
+    smartflag = smart_vars is not None
+    datadir = os.path.join(bb.get_datadir(), loc_id)
+    tempfile = 'bb_tempfile.nc'
+    newfile = get_netcdf_filename(loc_id, datayear, datamonth, smartflag)
+    if not(os.path.exists(os.path.join(datadir, newfile))):
+        return False
+
+    netcdf_index = load_netcdf_index(loc_id)
+    entry = netcdf_index.get(newfile, {})
+    if entry.get('block_fingerprints') is None:
+        print('   ' + newfile + ' has no block fingerprints, and is rewritten.')
+        return False
+    if entry.get('metadata_hash') != get_netcdf_metadata_hash(loc_id, smartflag):
+        print('   The metadata of ' + newfile + ' changed, and it is rewritten.')
+        return False
+
+    nsamps = len(ds['time'])
+    nold = entry['nrecords']
+    if nold > nsamps:
+        print('   Records were removed from ' + newfile + ', which is rewritten.')
+        return False
+
+    # Check the file against its index entry
+    with Dataset(os.path.join(datadir, newfile), 'r') as dataset:
+        if not(dataset.dimensions['time'].isunlimited()):
+            print('   ' + newfile + ' has a fixed time dimension, and is rewritten.')
+            return False
+        if dataset.dimensions['time'].size != nold:
+            print('   ' + newfile + ' does not match its index entry, and is rewritten.')
+            return False
+        record_vars = {varname: (ncvar.dtype if isinstance(ncvar.dtype, np.dtype) else None)
+                       for varname, ncvar in dataset.variables.items()
+                       if ncvar.dimensions == ('location_id', 'time')}
+    if ((sorted(record_vars) != entry['variables']) or
+        any([varname not in ds.keys() for varname in record_vars]) or
+        (smartflag and (('sea_water_temperature' in smart_vars) !=
+                        ('sea_water_temperature' in record_vars)))):
+        print('   The variables of ' + newfile + ' changed, and it is rewritten.')
+        return False
+
+    # Find the first block of the existing records that changed
+    # (records inserted before the end of the file change the
+    # times of the block they are in, and all later blocks)
+    first_write = nold
+    old_blocks = entry['block_fingerprints']
+    new_blocks = netcdf_block_fingerprints(ds.isel(time=slice(0, nold)), record_vars)
+    for iblock in range(len(old_blocks)):
+        if (iblock >= len(new_blocks)) or (old_blocks[iblock] != new_blocks[iblock]):
+            first_write = iblock*NETCDF_APPEND_BLOCK
+            break
+    if first_write == nsamps:
+        print('   ' + newfile + ' is up to date.')
+        return True
+
+    if APPEND_NETCDF_IN_PLACE:
+        # Clear the fingerprints of the file in the index
+        # until the new (and changed) records are written
+        appendfile = newfile
+        entry['fingerprint'] = None
+        entry['block_fingerprints'] = None
+        write_netcdf_index(loc_id, netcdf_index)
+    else:
+        appendfile = tempfile
+        shutil.copyfile(os.path.join(datadir, newfile), os.path.join(datadir, tempfile))
+
+    # Write the new (and changed) records
+    dataset = Dataset(os.path.join(datadir, appendfile), 'a')
+    dataset.set_auto_mask(False)
+    success_ncflag = False
+    try:
+        timestamp = datetime64_to_epoch(ds['time'].data)
+        dataset['time'][first_write:nsamps] = timestamp[first_write:]
+        for varname in record_vars:
+            dataset[varname][0, first_write:nsamps] = netcdf_record_values(ds, varname, record_vars[varname])[first_write:]
+        dataset.creation_date = datetime.datetime.now().strftime('%Y-%m-%d')
+        success_ncflag = True
+    except Exception as e:
+        print('   ' + datetime.datetime.now().strftime(LOG_DATETIME_FORMAT) +
+              ': something went wrong')
+        print(e)
+    finally:
+        dataset.close()
+
+    if not(success_ncflag):
+        if appendfile == tempfile:
+            os.remove(os.path.join(datadir, tempfile))
+        return False
+
+    # Rename the appended copy over the file, so that
+    # ERDDAP only ever sees the complete file
+    if appendfile == tempfile:
+        os.replace(os.path.join(datadir, tempfile), os.path.join(datadir, newfile))
+    print('   ' + datetime.datetime.now().strftime(LOG_DATETIME_FORMAT) +
+          ': ' + newfile + ' appended (' + str(nsamps - nold) + ' new records, ' +
+          str(nold - first_write) + ' records rewritten).')
+
+    return True
+
+
+# In[ ]:
+
+
+def write_netcdf(ds, loc_id, datayear, datamonth, smart_vars=None, force=False):
+
+    # Returns True if the file was written, False if it was skipped
+    # as unchanged, and None if there was nothing (or failed) to write.
+    # Setting force=True writes the file even if it is unchanged.
+
+    from netCDF4 import Dataset
     
     # If there is no data in the dataframe, do not make a netCDF
     if len(ds) == 0:
         print('No data exists in this file. Do not make a netCDF.')
-        return
+        return None
     
     smartflag = False
     if smart_vars is not None:
@@ -1833,16 +2807,27 @@ def write_netcdf(ds, loc_id, datayear, datamonth, smart_vars=None):
     
     
     # Define the file name
-    datayear_str = str(int(datayear))
-    if datamonth < 10:
-        datamonth_str = '0' + str(int(datamonth))
-    else:
-        datamonth_str = str(int(datamonth))
     tempfile = 'bb_tempfile.nc'
-    if smartflag:
-        newfile = 'bb_' + loc_id + '_smart_' + datayear_str + datamonth_str + '.nc'
-    else:
-        newfile = 'bb_' + loc_id + '_' + datayear_str + datamonth_str + '.nc'
+    newfile = get_netcdf_filename(loc_id, datayear, datamonth, smartflag)
+    
+    # If the contents of the file are the same as when it was
+    # last written (per the fingerprint index), skip the file
+    if not(force) and os.path.exists(os.path.join(datadir, newfile)):
+        netcdf_index = load_netcdf_index(loc_id)
+        if ((newfile in netcdf_index) and
+            (netcdf_index[newfile]['fingerprint'] ==
+             netcdf_fingerprint(ds, netcdf_file_variables(os.path.join(datadir, newfile)),
+                                get_netcdf_metadata_hash(loc_id, smartflag)))):
+            print('   ' + newfile + ' is unchanged. Skip writing it.')
+            _netcdf_write_stats['skipped'] += 1
+            return False
+    
+    # If appending is turned on, only write the new
+    # records into the existing file, if possible
+    if APPEND_NETCDF and append_netcdf(ds, loc_id, datayear, datamonth, smart_vars):
+        update_netcdf_index(loc_id, newfile, ds)
+        _netcdf_write_stats['written'] += 1
+        return True
     
     # Check the number of samples in the file
     nsamps = len(ds['time'])
@@ -1858,9 +2843,13 @@ def write_netcdf(ds, loc_id, datayear, datamonth, smart_vars=None):
         # Write the global metadata for the netCDF
         dataset = netcdf_add_global_metadata(dataset, loc_id, smartflag)
         
-        # Create the dimensions of the file
+        # Create the dimensions of the file (with an unlimited
+        # time dimension, so that records can be appended)
         dataset.createDimension('location_id',1)
-        dataset.createDimension('time',nsamps)
+        if APPEND_NETCDF:
+            dataset.createDimension('time',None)
+        else:
+            dataset.createDimension('time',nsamps)
         
         # Add the variables
         if smartflag: 
@@ -1893,17 +2882,22 @@ def write_netcdf(ds, loc_id, datayear, datamonth, smart_vars=None):
                     os.path.join(datadir,newfile))
         print('   ' + datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S') + 
           ': ' + newfile + ' successfully replaced.')
+        update_netcdf_index(loc_id, newfile, ds)
+        _netcdf_write_stats['written'] += 1
     else:
         print('   ' + datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S') + 
           ': ' + tempfile + ' not replaced with ' + newfile)
         print('   Something went wrong. Check the error messages above.')
-        shutil.remove(os.path.join(datadir,tempfile))
-        
+        os.remove(os.path.join(datadir,tempfile))
+        return None
         
     
-    return
+    return True
 
 def add_wmo_code_to_data(loc_id):
+
+    from netCDF4 import Dataset
+
     # Get the path for the metadata info json
     basedir = bb.get_datadir()
     metadir = os.path.join(basedir, loc_id, 'metadata', loc_id +'_metadata.json')
@@ -1916,8 +2910,7 @@ def add_wmo_code_to_data(loc_id):
             return False
     
     # Load in the metadata json
-    with open(metadir, 'r') as meta_json:
-        metadict = json.load(meta_json)
+    metadict = bb.load_json_file(metadir)
         
     # Extract out the WMO code
     wmo_code = metadict['metadata']['wmo_code']
@@ -1926,9 +2919,9 @@ def add_wmo_code_to_data(loc_id):
         return False
     
     # Add the WMO code to the metadata for all netCDF files
-    ncfiles = [f for f in os.listdir(os.path.join(basedir, loc_id)) if f.endswith('.nc')]
-    for ncfile in ncfiles:
-        ncpath = os.path.join(basedir, loc_id, ncfile)
+    netcdf_index = load_netcdf_index(loc_id)
+    for ncfile in sorted(netcdf_index):
+        ncpath = get_netcdf_path(loc_id, ncfile, netcdf_index)
         dataset = Dataset(ncpath, 'a')
         dataset.wmo_platform_code = wmo_code
         dataset.id = wmo_code
@@ -1967,8 +2960,17 @@ def update_data_by_location(loc_id, rebuild_flag=False, rerun_tests=False, rebui
             print('Unable to make the data file for this project')
             return False
     
+    # On a rebuild, if need be, pull, process, and write
+    # the data a time window at a time
+    if rebuild_flag and (REBUILD_WINDOW_MONTHS is not None):
+        rebuild_windows = get_rebuild_windows(loc_id, rebuild_period)
+        if rebuild_windows is not None:
+            return rebuild_data_by_window(loc_id, rebuild_windows, rerun_tests=rerun_tests,
+                                          rebuild_period=rebuild_period)
+    
     # Download any new data
-    ds_all, ds_all_smart = process_newdata(loc_id, rebuild_flag=rebuild_flag, rebuild_period=rebuild_period)
+    ds_all, ds_all_smart = process_newdata(loc_id, rebuild_flag=rebuild_flag, rerun_tests=rerun_tests,
+                                           rebuild_period=rebuild_period)
     if ds_all is None:
         print('As there is no data, no netCDF is created. End the process, and move on.')
         return False
@@ -1980,21 +2982,14 @@ def update_data_by_location(loc_id, rebuild_flag=False, rerun_tests=False, rebui
     # Check all the data for duplicates
     ds_all = check_duplicates(ds_all.copy())
     
-    # Group all the data by year
-    ds_grouped = ds_all.groupby('time.year')
+    # Count the monthly files written, and skipped as unchanged
+    # (on a rebuild, all of the files are written)
+    write_stats = get_netcdf_write_stats()
     
-    # Loop through each unique year of data, 
-    # and write the netcdf file for the
-    # location ID for a given year
-    print('     Years of data to write:', list(ds_grouped.groups.keys()))
-    for year in ds_grouped.groups.keys():
-        
-        ds_subgrouped = ds_grouped[year].groupby('time.month')
-        print('     Months of data to write:', list(ds_subgrouped.groups.keys()))
-        for month in ds_subgrouped.groups.keys():
-            # Write the netcdf of the file
-            write_netcdf(ds_subgrouped[month].sortby('time'), 
-                         loc_id, year, month)
+    # Write the netCDF files of each month of data, keeping track of
+    # any files that fail to be written, so that the pipeline state
+    # is only recorded if all were written
+    write_results = write_netcdf_by_month(ds_all, loc_id, force=rebuild_flag)
             
             
     if ds_all_smart is not None:
@@ -2008,24 +3003,21 @@ def update_data_by_location(loc_id, rebuild_flag=False, rerun_tests=False, rebui
         # Check all the data for duplicates
         ds_all_smart = check_duplicates(ds_all_smart.copy())
 
-        # Group all the data by year
-        ds_smart_grouped = ds_all_smart.groupby('time.year')
-
-        # Loop through each unique year of data, 
-        # and write the netcdf file for the
-        # location ID for a given year
+        # Write the netCDF files of each month of data
         print('Smart Mooring data: ')
-        print('Years of data to write:', list(ds_smart_grouped.groups.keys()))
-        for year in ds_smart_grouped.groups.keys():
-
-            ds_subgrouped = ds_smart_grouped[year].groupby('time.month')
-            print('Months of data to write:', list(ds_subgrouped.groups.keys()))
-            for month in ds_subgrouped.groups.keys():
-                # Write the netcdf of the file
-                write_netcdf(ds_subgrouped[month].sortby('time'), 
-                             loc_id, year, month, smart_vars)
+        write_results += write_netcdf_by_month(ds_all_smart, loc_id, smart_vars, force=rebuild_flag)
         
-            
+    new_write_stats = get_netcdf_write_stats()
+    print(f"{loc_id}: netCDF months written: {new_write_stats['written'] - write_stats['written']}, "
+          f"skipped as unchanged: {new_write_stats['skipped'] - write_stats['skipped']}")
+    
+    # Record the pipeline state of the location
+    # (with the time step of the data the QC tests were run on)
+    if PIPELINE_STATE and all([result is not None for result in write_results]):
+        qc_time_intervals = {False: get_qc_time_interval(ds_all)}
+        if ds_all_smart is not None:
+            qc_time_intervals[True] = get_qc_time_interval(ds_all_smart)
+        record_pipeline_state(loc_id, qc_time_intervals)
     
     
     return True
@@ -2034,6 +3026,229 @@ def update_data_by_location(loc_id, rebuild_flag=False, rerun_tests=False, rebui
 # In[ ]:
 
 
+def write_netcdf_by_month(ds, loc_id, smart_vars=None, force=False):
+
+    # Write the netCDF file of each month of a dataset,
+    # and return the result of writing each file (see write_netcdf)
+    write_results = []
+
+    # Group all the data by year
+    ds_grouped = ds.groupby('time.year')
+
+    # Loop through each unique year of data, 
+    # and write the netcdf file for the
+    # location ID for each month of the year
+    print('     Years of data to write:', list(ds_grouped.groups.keys()))
+    for year in ds_grouped.groups.keys():
+
+        ds_subgrouped = ds_grouped[year].groupby('time.month')
+        print('     Months of data to write:', list(ds_subgrouped.groups.keys()))
+        for month in ds_subgrouped.groups.keys():
+            # Write the netcdf of the file
+            write_results.append(write_netcdf(ds_subgrouped[month].sortby('time'), 
+                                              loc_id, year, month, smart_vars, force=force))
+
+    return write_results
+
+
+# In[ ]:
+
+
+def split_into_month_windows(time_start, time_end, nmonths=1):
+
+    # Split a time range into windows of nmonths calendar months
+    # ([start, end] pairs, where each window ends at the start of
+    # the next). The first window starts at time_start, and the
+    # last window ends at time_end.
+    windows = []
+    window_start = time_start
+    month_start = datetime.datetime(time_start.year, time_start.month, 1)
+    while window_start < time_end:
+        month_index = month_start.month - 1 + nmonths
+        month_start = datetime.datetime(month_start.year + month_index // 12, month_index % 12 + 1, 1)
+        window_end = min([month_start, time_end])
+        windows.append([window_start, window_end])
+        window_start = window_end
+
+    return windows
+
+
+# In[ ]:
+
+
+def get_rebuild_windows(loc_id, rebuild_period=None):
+
+    # Get the time windows in which to rebuild the data of a location
+    # (of REBUILD_WINDOW_MONTHS calendar months each), from the start
+    # of its location history (as in process_newdata) or of the
+    # rebuild period, to the end of the rebuild period (or tomorrow).
+    #
+    # Returns None if the location has no location history, in which
+    # case the data is rebuilt all at once.
+    basedir = bb.get_datadir()
+    infodir = os.path.join(basedir, loc_id, 'metadata', loc_id +'_info.json')
+    if not(os.path.exists(infodir)):
+        return None
+    loc_history = bb.load_json_file(infodir).get('loc_history', {})
+    if len(loc_history) == 0:
+        return None
+
+    rebuild_start = rebuild_period[0] if rebuild_period is not None else datetime.datetime(2020,1,1)
+    first_loc = min([datetime.datetime.strptime(loc_date, DATETIME_FORMAT)
+                     for loc_date in loc_history.keys()])
+    time_start = max([rebuild_start, first_loc - datetime.timedelta(days=3)])
+    if rebuild_period is not None:
+        time_end = rebuild_period[1]
+    else:
+        time_end = datetime.datetime.now() + datetime.timedelta(days=1)
+
+    return split_into_month_windows(time_start, time_end, REBUILD_WINDOW_MONTHS)
+
+
+# In[ ]:
+
+
+def get_rebuild_time_intervals(loc_id, rebuild_windows, rerun_tests=False, rebuild_period=None):
+
+    # Get the time steps with which the QC tests are run in a rebuild
+    # a window at a time, for the surface (False) and smart mooring
+    # (True) data: the median time steps of the whole record (as used
+    # when it is rebuilt all at once), found from the times of the data
+    # of each window (the only data held in memory). The tests are run
+    # on the data as pulled, unless they are all rerun, in which case
+    # they are rerun on the time-sorted data.
+    #
+    # The time step of a stream with no data is None.
+    times = {False: [], True: []}
+    for window in rebuild_windows:
+        window_times = process_newdata(loc_id, rebuild_flag=True, rebuild_period=rebuild_period,
+                                       time_window=window, times_only=True)
+        for smartflag in [False, True]:
+            if window_times[smartflag] is not None:
+                times[smartflag].append(window_times[smartflag])
+
+    time_intervals = {}
+    for smartflag in [False, True]:
+        if len(times[smartflag]) == 0:
+            time_intervals[smartflag] = None
+            continue
+        time_seconds = bb_qc.qartod_time_seconds(np.concatenate(times[smartflag]))
+        if rerun_tests:
+            time_seconds = np.sort(time_seconds)
+        time_intervals[smartflag] = bb_qc.qartod_time_interval(time_seconds)
+    print('   QC time steps of the whole record: ' + str(time_intervals[False]) + ' s (spotter), ' +
+          str(time_intervals[True]) + ' s (smart mooring)')
+
+    return time_intervals
+
+
+# In[ ]:
+
+
+def rebuild_data_by_window(loc_id, rebuild_windows, rerun_tests=False, rebuild_period=None):
+
+    # This function is used to rebuild the data of a location a time
+    # window at a time (see get_rebuild_windows), so that only the data
+    # of about two windows is held in memory at once, however long the
+    # data record is.
+    #
+    # The data of each window is pulled, quality controlled, and checked
+    # for duplicates. The QC flags at the start of the window are then
+    # recomputed with the data of the previous window (see
+    # rerun_qc_tests_since), so that the tests that look back over
+    # earlier data (and the spike test of the last observation of the
+    # previous window) give the same flags as for the whole record.
+    # The tests of every window are run with the time step of the whole
+    # record (see get_rebuild_time_intervals), rather than that of the
+    # window, as the flat line test depends on it.
+    # The data of each window is written once the next window with data
+    # has been processed.
+
+    import xarray as xr
+
+    time_intervals = get_rebuild_time_intervals(loc_id, rebuild_windows, rerun_tests=rerun_tests,
+                                                rebuild_period=rebuild_period)
+
+    # Count the monthly files written (and skipped as unchanged)
+    write_stats = get_netcdf_write_stats()
+    write_results = []
+
+    def write_window(ds_window, smartflag):
+        if smartflag:
+            print('Smart Mooring data: ')
+            return write_netcdf_by_month(ds_window, loc_id, get_valid_smart_vars(ds_window), force=True)
+        return write_netcdf_by_month(ds_window, loc_id, force=True)
+
+    # The processed data of the previous window, not yet written,
+    # for the surface (False) and smart mooring (True) data
+    ds_held = {False: None, True: None}
+    for window in rebuild_windows:
+        print('   ' + datetime.datetime.now().strftime(LOG_DATETIME_FORMAT) + 
+              ': Rebuild window ' + window[0].strftime(DATETIME_FORMAT) + 
+              ' to ' + window[1].strftime(DATETIME_FORMAT))
+        ds_window, ds_smart_window = process_newdata(loc_id, rebuild_flag=True, rerun_tests=rerun_tests,
+                                                     rebuild_period=rebuild_period, time_window=window,
+                                                     time_intervals=time_intervals)
+
+        for smartflag, ds_new in [(False, ds_window), (True, ds_smart_window)]:
+            if ds_new is None:
+                continue
+
+            # If need be, rerun all the QC tests
+            if rerun_tests:
+                ds_new = rerun_qc_tests(ds_new, loc_id, smartflag=smartflag,
+                                        time_interval=time_intervals[smartflag])
+
+            # Check all the data for duplicates
+            ds_new = check_duplicates(ds_new.copy())
+
+            # Recompute the flags at the start of the window with
+            # the previous window, and write the previous window
+            if ds_held[smartflag] is not None:
+                nheld = ds_held[smartflag].sizes['time']
+                ds_both = xr.concat([ds_held[smartflag], ds_new], dim='time')
+                ds_both = rerun_qc_tests_since(ds_both, loc_id, ds_new['time'].data[0],
+                                               smartflag=smartflag,
+                                               time_interval=time_intervals[smartflag])
+
+                # Of the previous window, only the flags of the last
+                # observation change (the flags before it are final,
+                # even when the tests are rerun on all of ds_both)
+                ds_prev = ds_held[smartflag]
+                for varname in ds_prev.keys():
+                    if '_qc_' in varname:
+                        ds_prev[varname].data[:, -1] = ds_both[varname].data[:, nheld-1]
+                write_results += write_window(ds_prev, smartflag)
+                ds_new = ds_both.isel(time=slice(nheld, None)).copy(deep=True)
+                del ds_both
+            ds_held[smartflag] = ds_new
+
+        del ds_window, ds_smart_window
+        gc.collect()
+
+    if ds_held[False] is None:
+        print('As there is no data, no netCDF is created. End the process, and move on.')
+        return False
+
+    # Write the last window
+    for smartflag in [False, True]:
+        if ds_held[smartflag] is not None:
+            write_results += write_window(ds_held[smartflag], smartflag)
+
+    new_write_stats = get_netcdf_write_stats()
+    print(f"{loc_id}: netCDF months written: {new_write_stats['written'] - write_stats['written']}, "
+          f"skipped as unchanged: {new_write_stats['skipped'] - write_stats['skipped']}")
+
+    # Record the pipeline state of the location
+    if PIPELINE_STATE and all([result is not None for result in write_results]):
+        record_pipeline_state(loc_id, time_intervals)
+
+    return True
+
+
+# In[ ]:
+
+
 def get_valid_smart_vars(ds):
     
     valid_smart_vars = ['sea_water_temperature',
@@ -2051,7 +3266,7 @@ def get_valid_smart_vars(ds):
 # In[ ]:
 
 
-def update_all_locations(rebuild_flag=False, rerun_tests=False):
+def update_all_locations(rebuild_flag=False, rerun_tests=False, workers=1):
     
     # Get a list of the backyard buoys projects
     basedir = bb.get_datadir()
@@ -2078,8 +3293,8 @@ def update_all_locations(rebuild_flag=False, rerun_tests=False):
     add_projs = bb_meta.make_projects_metadata(missing_projs)
             
         
-    # Step through each project, and update the data
-    failed_locations = []
+    # Identify each project to update
+    update_locs = []
     for ii in range(0,len(loc_ids)):
 
         if loc_active[ii] or rebuild_flag:
@@ -2088,28 +3303,61 @@ def update_all_locations(rebuild_flag=False, rerun_tests=False):
             if not(os.path.exists(pathdir)):
                 print(loc_ids[ii] + ': No metadata exists for this project. Continue on')
                 continue
+            update_locs.append(loc_ids[ii])
 
+    # Skip the projects with no new data since the last run
+    skipped_locs = []
+    if PIPELINE_STATE and not(rebuild_flag):
+        prepass_start = time.perf_counter()
+        update_locs, skipped_locs, saved_seconds = skip_unchanged_locations(update_locs)
+        prepass_seconds = time.perf_counter() - prepass_start
+
+
+    # Step through each project, and update the data
+    failed_locations = []
+    if (workers is None) or (workers <= 1):
+        for loc_id in update_locs:
+            update_success = update_location_with_logging(loc_id, rebuild_flag, rerun_tests)
+            if update_success is None:
+                failed_locations.append(loc_id)
+    else:
+        # Update the projects concurrently, with each project
+        # processed in a separate worker process. The output for
+        # each project is written to its own log file, and printed
+        # once that project has finished. The worker processes
+        # start afresh, so they are given the warning filters and
+        # API cache setting of this process.
+        print('\nProcessing ' + str(len(update_locs)) + ' locations with ' 
+              + str(workers) + ' workers')
+        mp_context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=mp_context,
+                                                    initializer=_init_update_worker,
+                                                    initargs=(warnings.filters,
+                                                              bb_da.API_CACHE_ENABLED)) as executor:
+            futures = {executor.submit(update_location_to_log, loc_id,
+                                       rebuild_flag, rerun_tests): loc_id
+                       for loc_id in update_locs}
+            for future in concurrent.futures.as_completed(futures):
+                loc_id = futures[future]
+                try:
+                    update_success, logfile, write_stats, http_stats = future.result()
+                except Exception as exc:
+                    # The worker process itself failed
+                    print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S')
+                        + ': Error processing ' + loc_id + ': ' + str(exc))
+                    failed_locations.append(loc_id)
+                    continue
+
+                # Print the log for this project, and add up the
+                # netCDF files written and HTTP requests made by it
+                with open(logfile, 'r') as log:
+                    print(log.read(), end='')
+                add_netcdf_write_stats(write_stats)
+                bb_da.add_http_stats(http_stats)
+                if update_success is None:
+                    failed_locations.append(loc_id)
 
-            print('\n' + datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S') 
-                  + ': Processing data for ' + loc_ids[ii])
-            try:
-                update_success = update_data_by_location(loc_ids[ii], rebuild_flag, rerun_tests)
-            except Exception as exc:
-                print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S')
-                    + ': Error processing ' + loc_ids[ii] + ': ' + str(exc))
-                print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S')
-                    + ': Skipping this location and continuing with remaining locations.\n')
-                failed_locations.append(loc_ids[ii])
-                update_success = False
-                continue
-                
-            if update_success:
-                print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S') 
-                      + ': Data update complete\n')
-            else:
-                print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S') 
-                      + ': Data was not updated\n')
-    
     # Add new projects, as found in the projects with new metadata,
     # add that data to the ERDDAP datasets
     if add_projs is not None:
@@ -2118,25 +3366,106 @@ def update_all_locations(rebuild_flag=False, rerun_tests=False):
 
     if len(failed_locations) > 0:
         print('Locations with processing errors during this run: ' + ', '.join(failed_locations))
+    if PIPELINE_STATE and not(rebuild_flag):
+        print('Locations skipped with no new data: ' + str(len(skipped_locs)) + ' of ' + 
+              str(len(skipped_locs) + len(update_locs)) + 
+              ' (saving about {:.1f} s of processing, in a {:.1f} s check)'.format(saved_seconds, prepass_seconds))
             
     return
 
 
+def update_location_with_logging(loc_id, rebuild_flag=False, rerun_tests=False):
+
+    # This function is used to update the data for a single
+    # location as part of a run over all locations, logging
+    # the start and the outcome of the update.
+    #
+    # Returns True if the data was updated, False if it was not,
+    # and None if an error occurred while processing the location.
+
+    print('\n' + datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S') 
+          + ': Processing data for ' + loc_id)
+    start_time = time.perf_counter()
+    try:
+        update_success = update_data_by_location(loc_id, rebuild_flag, rerun_tests)
+
+        # Record how long the update took (on updates, rather than
+        # rebuilds), to estimate the time saved by skipping it
+        if PIPELINE_STATE and update_success and not(rebuild_flag):
+            bb_state.record_run_seconds(loc_id, time.perf_counter() - start_time)
+    except Exception as exc:
+        print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S')
+            + ': Error processing ' + loc_id + ': ' + str(exc))
+        print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S')
+            + ': Skipping this location and continuing with remaining locations.\n')
+        return None
+        
+    if update_success:
+        print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S') 
+              + ': Data update complete\n')
+    else:
+        print(datetime.datetime.now().strftime('%Y-%b-%d %H:%M:%S') 
+              + ': Data was not updated\n')
+
+    return update_success
+
+
+def _init_update_worker(warning_filters, api_cache_enabled=False):
+
+    # Use the same warning filters, and cache the API responses
+    # (or not), in the worker processes as in the main process
+    warnings.filters[:] = warning_filters
+    bb_da.configure_api_cache(enabled=api_cache_enabled)
+
+
+def update_location_to_log(loc_id, rebuild_flag=False, rerun_tests=False):
+
+    # This function is run in a worker process, to update the
+    # data for a single location, with all of the output written
+    # to a log file for that location:
+    #   {basedir}/{loc_id}/logs/{loc_id}_update.log
+    #
+    # Returns the result of update_location_with_logging, the path
+    # to the log file, the counts of the monthly netCDF files
+    # written and skipped (see get_netcdf_write_stats), and the
+    # counts of the HTTP requests made for the location (see
+    # backyardbuoys_dataaccess.get_http_stats), which are added up
+    # over the locations in the main process.
+
+    logdir = os.path.join(bb.get_datadir(), loc_id, 'logs')
+    if not(os.path.exists(logdir)):
+        os.makedirs(logdir)
+    logfile = os.path.join(logdir, loc_id + '_update.log')
+
+    with open(logfile, 'w') as log:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            bb_da.reset_api_cache_stats()
+            bb.reset_file_read_stats()
+            reset_netcdf_write_stats()
+            http_start = bb_da.get_http_stats()
+            update_success = update_location_with_logging(loc_id, rebuild_flag, rerun_tests)
+            bb_da.print_api_cache_stats()
+            bb.print_file_read_stats()
+
+    # (the worker process may have updated other locations before)
+    http_stats = {key: count - http_start[key] for key, count in bb_da.get_http_stats().items()}
+
+    return update_success, logfile, get_netcdf_write_stats(), http_stats
+
+
 # In[ ]:
 
 
 def update_netcdf_metadata_by_location(loc_id):
-    
-    # Get the base data directory# Get the base data directory
-    basedir = bb.get_datadir()
-    datadir = os.path.join(basedir, loc_id)
 
-    filelist = [ii for ii in os.listdir(datadir) if 
-                (('.nc' in ii) and ('temp_ncfile' not in ii))]
-    tmpfilepath = os.path.join(datadir, 'temp_ncfile.nc')
+    from netCDF4 import Dataset
+    
+    # Get the monthly netCDF files of the location from the netCDF index
+    netcdf_index = load_netcdf_index(loc_id)
 
-    for file in filelist:
-        filepath = os.path.join(datadir, file)
+    for file in sorted(netcdf_index):
+        filepath = get_netcdf_path(loc_id, file, netcdf_index)
+        tmpfilepath = os.path.join(os.path.dirname(filepath), 'temp_ncfile.nc')
         print(filepath)
 
         try:
@@ -2146,7 +3475,8 @@ def update_netcdf_metadata_by_location(loc_id):
             print('Update netcdf metadata')
             dataset = Dataset(tmpfilepath, 'a')
             try:
-                dataset = netcdf_add_global_metadata(dataset, loc_id)
+                dataset = netcdf_add_global_metadata(dataset, loc_id,
+                                                     smartflag=parse_netcdf_filename(loc_id, file)[2])
             except Exception as e2:
                 print('Error occured while updating metadata')
                 print(e2)
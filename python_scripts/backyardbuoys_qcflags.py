@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+BackyardBuoys ERDDAP - QARTOD Flag Packing
+==========================================
+
+This module converts QARTOD flags between the separate flag variables
+kept for each test (e.g., "sea_water_temperature_qc_spike_test") and
+two compact forms:
+
+    - flag planes : a uint8 array with one row (plane) per flag variable
+    - packed codes : one integer per observation, with one decimal digit
+      per test, in test order (e.g., flags 1, 4, 1, 9 are packed as 1419)
+
+All of the conversions are vectorized over the observations.
+
+Key Functions:
+    - to_flag_planes() : Stack flag arrays into flag planes
+    - pack_flags() : Pack flag planes into integer codes
+    - unpack_flags() : Unpack integer codes into flag planes
+    - flag_varnames() : Names of the flag variables of a data variable
+    - read_flag_planes() : Read the flag variables of a dataset into flag planes
+    - write_flag_planes() : Write flag planes into the flag variables of a dataset
+
+Organization: Backyard Buoys
+"""
+
+import numpy as np
+
+
+# QARTOD tests, in the order in which they are run (and packed)
+QARTOD_TESTS = ['gross_range_test', 'spike_test',
+                'rate_of_change_test', 'flat_line_test']
+
+# Flag value given to observations with no flag
+QARTOD_MISSING = 9
+
+
+# ============================================================================
+# Flag Planes and Packed Codes
+# ============================================================================
+
+def to_flag_planes(flag_arrays):
+    """
+    Stack flag arrays into flag planes.
+
+    Parameters
+    ----------
+    flag_arrays : list of array-like
+        Flags of each test (or other flag), all of the same length.
+        Masked, non-finite, and fill (e.g., -555) flags are given
+        the MISSING flag (9).
+
+    Returns
+    -------
+    numpy.ndarray
+        uint8 array of shape (number of flag arrays, number of observations)
+    """
+
+    nobs = np.size(flag_arrays[0]) if len(flag_arrays) > 0 else 0
+    planes = np.empty((len(flag_arrays), nobs), dtype=np.uint8)
+    for ii, flags in enumerate(flag_arrays):
+        flags = np.ma.filled(np.ma.asarray(flags, dtype=float).ravel(), np.nan)
+        valid = np.isfinite(flags) & (flags >= 0) & (flags <= 9)
+        planes[ii] = np.where(valid, flags, QARTOD_MISSING)
+
+    return planes
+
+
+def _code_dtype(ntests):
+
+    # The smallest signed integer type that holds a packed code
+    for code_dtype in [np.int16, np.int32, np.int64]:
+        if 10**ntests - 1 <= np.iinfo(code_dtype).max:
+            return code_dtype
+    raise ValueError('Too many tests to pack: ' + str(ntests))
+
+
+def pack_flags(planes):
+    """
+    Pack flag planes into integer codes, with one decimal digit per
+    test (the first test is the leading digit).
+
+    Parameters
+    ----------
+    planes : numpy.ndarray
+        Flag planes, of shape (number of tests, number of observations)
+
+    Returns
+    -------
+    numpy.ndarray
+        Packed code of each observation
+    """
+
+    planes = np.asarray(planes)
+    code_dtype = _code_dtype(planes.shape[0])
+    powers = 10**np.arange(planes.shape[0] - 1, -1, -1, dtype=code_dtype)
+
+    return (powers @ planes.astype(code_dtype)).astype(code_dtype)
+
+
+def unpack_flags(codes, ntests=len(QARTOD_TESTS)):
+    """
+    Unpack integer codes into flag planes.
+
+    Parameters
+    ----------
+    codes : array-like
+        Packed code of each observation
+    ntests : int, optional
+        Number of tests packed into each code
+
+    Returns
+    -------
+    numpy.ndarray
+        uint8 flag planes, of shape (number of tests, number of observations)
+    """
+
+    codes = np.asarray(codes, dtype=_code_dtype(ntests)).ravel()
+    powers = 10**np.arange(ntests - 1, -1, -1, dtype=codes.dtype)
+
+    return ((codes[np.newaxis, :] // powers[:, np.newaxis]) % 10).astype(np.uint8)
+
+
+# ============================================================================
+# Flag Variables
+# ============================================================================
+
+def flag_varnames(varname, tests=QARTOD_TESTS, agg=True, prefix='_qc_'):
+    """
+    Names of the flag variables of a data variable.
+
+    Parameters
+    ----------
+    varname : str
+        Name of the data variable
+    tests : list of str, optional
+        QARTOD tests
+    agg : bool, optional
+        If True, the aggregate flag ("{varname}_qc_agg") comes first
+    prefix : str, optional
+        Text between the variable and test names ("_qc_" in the
+        netCDF files, "_qartod_" in the QC test results)
+
+    Returns
+    -------
+    list of str
+        Flag variable names
+    """
+
+    names = [varname + prefix + test for test in tests]
+    if agg:
+        names = [varname + '_qc_agg'] + names
+
+    return names
+
+
+def read_flag_planes(ds, names, start=0):
+    """
+    Read flag variables from a dataset into flag planes.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset or pandas.DataFrame
+        Dataset with the flag variables (xarray variables may have a
+        leading location_id dimension of length 1)
+    names : list of str
+        Names of the flag variables
+    start : int, optional
+        First observation to read
+
+    Returns
+    -------
+    numpy.ndarray
+        uint8 flag planes, of shape (number of names, number of observations)
+    """
+
+    flag_arrays = []
+    for name in names:
+        flags = ds[name]
+        flags = flags.data if hasattr(flags, 'dims') else flags.to_numpy()
+        flag_arrays.append(np.ravel(flags)[start:])
+
+    return to_flag_planes(flag_arrays)
+
+
+def write_flag_planes(ds, names, planes, start=0):
+    """
+    Write flag planes into the existing flag variables of an
+    xarray dataset, in place, keeping the type of each variable.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Dataset with the flag variables, with dimensions
+        (location_id, time), with a single location
+    names : list of str
+        Names of the flag variables
+    planes : numpy.ndarray
+        Flag planes, of shape (number of names, number of observations)
+    start : int, optional
+        First observation to write
+    """
+
+    for name, plane in zip(names, planes):
+        ds[name][0, start:start+plane.size] = plane
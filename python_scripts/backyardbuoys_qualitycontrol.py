@@ -4,188 +4,179 @@
 # In[ ]:
 
 
-import datetime
+import concurrent.futures
+import copy
+import multiprocessing
 import shutil
+import threading
+import warnings
 
 import numpy as np
 import pandas as pd
 import requests
-import xarray as xr
 
 import os
 import sys
 import getopt
 import gc
 
-import json
-
-import matplotlib
-from matplotlib import pyplot as plt
-
 import backyardbuoys_general_functions as bb
+import backyardbuoys_qcflags as bb_flags
 import backyardbuoys_processdata as bb_process
 
-import ioos_qc
-from ioos_qc import qartod
-from ioos_qc.config import Config
-from ioos_qc.streams import PandasStream
-from ioos_qc.stores import PandasStore
 
+# QARTOD test engine used by process_qartod_tests:
+#   'ioos_qc' - run the tests through the ioos_qc streams
+#   'native'  - run the tests with the native NumPy engine (same flags)
+QARTOD_ENGINE = 'ioos_qc'
 
-# In[ ]:
-
+# Number of worker processes used by process_qartod_tests to run the
+# tests for different sensors at the same time (1 = no worker processes)
+QARTOD_WORKERS = 1
 
-def load_all_qc_limits(loc_id):
-    
-    basedir = bb.get_datadir()
-    qc_file = loc_id + '_qartod.json'
-    qc_path = os.path.join(basedir, loc_id, 'metadata', qc_file)
-    with open(qc_path) as qc_json:
-        qc_data = json.load(qc_json)
-
-    # Define the data variable names and the 
-    # associated limits sheet names
-    qc_vars = ['sea_surface_wave_mean_period',
-               'sea_surface_wave_mean_frequency',
-               'sea_surface_wave_from_direction',
-               'sea_surface_wave_directional_spread',
-               'sea_surface_wave_period_at_variance_spectral_density_maximum',
-               'sea_surface_wave_frequency_at_variance_spectral_density_maximum',
-               'sea_surface_wave_from_direction_at_variance_spectral_density_maximum',
-               'sea_surface_wave_directional_spread_at_variance_spectral_density_maximum',
-               'sea_surface_wave_significant_height',
-               'sea_water_temperature']
-    
-    bb_vars = ['sea_surface_wave_mean_period',
-               'sea_surface_wave_mean_frequency',
-               'sea_surface_wave_from_direction',
-               'sea_surface_wave_directional_spread',
-               'sea_surface_wave_period_at_variance_spectral_density_maximum',
-               'sea_surface_wave_frequency_at_variance_spectral_density_maximum',
-               'sea_surface_wave_from_direction_at_variance_spectral_density_maximum',
-               'sea_surface_wave_directional_spread_at_variance_spectral_density_maximum',
-               'sea_surface_wave_significant_height',
-               'sea_water_temperature']
 
-    # Initialize an empty dictionary to hold all the limits
-    qc_dict = {}
+# In[ ]:
 
-    # Step through each QC limit sheet name, and parse
-    # out the variable limits
-    qc_keys = [ii for ii in qc_data['qartod_limits'].keys()]
-    for var_id in range(0,len(bb_vars)):
-        
-        qc_var = qc_vars[var_id]
-        bb_var = bb_vars[var_id]
-        
-        qc_lim_inds = np.where([qc_var in ii for ii in qc_data['qartod_limits']])[0]
-        qc_varnames = [qc_keys[ii] for ii in qc_lim_inds]
-    
-        qc_tests = []
-        if any(['gross_range_test' in ii for ii in qc_varnames]):
-            qc_tests.append('gross_range_test')
-        if any(['spike_test' in ii for ii in qc_varnames]):
-            qc_tests.append('spike_test')
-        if any(['rate_of_change_test' in ii for ii in qc_varnames]):
-            qc_tests.append('rate_of_change_test')
-        if any(['flat_line_test' in ii for ii in qc_varnames]):
-            qc_tests.append('flat_line_test')
 
+# Names of the limits for each QARTOD test, as they appear in the
+# QARTOD limits jsons ("{variable}_{test}_{limit name}")
+QC_LIMIT_NAMES = {'gross_range_test': ['suspect_min', 'suspect_max', 'fail_min', 'fail_max'],
+                  'spike_test': ['suspect', 'fail'],
+                  'rate_of_change_test': ['threshold'],
+                  'flat_line_test': ['tolerance', 'suspect', 'fail']}
+
+# Spotter buoy variables with QC limits
+QC_VARIABLES = ['sea_surface_wave_mean_period',
+                'sea_surface_wave_mean_frequency',
+                'sea_surface_wave_from_direction',
+                'sea_surface_wave_directional_spread',
+                'sea_surface_wave_period_at_variance_spectral_density_maximum',
+                'sea_surface_wave_frequency_at_variance_spectral_density_maximum',
+                'sea_surface_wave_from_direction_at_variance_spectral_density_maximum',
+                'sea_surface_wave_directional_spread_at_variance_spectral_density_maximum',
+                'sea_surface_wave_significant_height',
+                'sea_water_temperature']
+
+# Compiled QC limits, keyed by location (and smart mooring flag),
+# along with the path, modification time, and size of their json
+_qc_limits_cache = {}
+_qc_limits_cache_lock = threading.Lock()
+
+
+def compile_qc_limits(qartod_limits):
+
+    # This function is used to parse the QC limits from a QARTOD limits
+    # json into the test configuration for each variable, in a single
+    # pass over the limit names. The limits are converted to floats,
+    # and the tests are given in the order in which they are run:
+    #
+    # {variable: {'gross_range_test': {'suspect_span': [min, max],
+    #                                  'fail_span': [min, max]},
+    #             'spike_test': {'suspect_threshold': ..., 'fail_threshold': ...},
+    #             'rate_of_change_test': {'threshold': ...},
+    #             'flat_line_test': {'tolerance': ..., 'suspect_threshold': ...,
+    #                                'fail_threshold': ...}}}
+
+    # Group the limits by variable and test
+    var_limits = {}
+    for limit_key, limit_value in qartod_limits.items():
+        for qc_test in QC_LIMIT_NAMES.keys():
+            test_ind = limit_key.find('_' + qc_test + '_')
+            if test_ind > 0:
+                var_name = limit_key[:test_ind]
+                limit_name = limit_key[test_ind+len(qc_test)+2:]
+                var_limits.setdefault(var_name, {}).setdefault(qc_test, {})[limit_name] = limit_value
+                break
+
+    # Build the test configuration for each variable
+    compiled_limits = {}
+    for var_name, test_limits in var_limits.items():
         var_dict = {}
-        for qc_test in qc_tests:
+        for qc_test in QC_LIMIT_NAMES.keys():
+            if qc_test not in test_limits:
+                continue
+            limits = test_limits[qc_test]
             if qc_test == 'gross_range_test':
                 var_dict['gross_range_test'] = {
-                    'suspect_span': [float(qc_data['qartod_limits'][qc_var+'_gross_range_test_suspect_min']),
-                                     float(qc_data['qartod_limits'][qc_var+'_gross_range_test_suspect_max'])],
-                    'fail_span': [float(qc_data['qartod_limits'][qc_var+'_gross_range_test_fail_min']),
-                                  float(qc_data['qartod_limits'][qc_var+'_gross_range_test_fail_max'])]
+                    'suspect_span': [float(limits['suspect_min']), float(limits['suspect_max'])],
+                    'fail_span': [float(limits['fail_min']), float(limits['fail_max'])]
                 }
             elif qc_test == 'spike_test':
                 var_dict['spike_test'] = {
-                    'suspect_threshold': float(qc_data['qartod_limits'][qc_var+'_spike_test_suspect']),
-                    'fail_threshold': float(qc_data['qartod_limits'][qc_var+'_spike_test_fail'])
+                    'suspect_threshold': float(limits['suspect']),
+                    'fail_threshold': float(limits['fail'])
                 }
             elif qc_test == 'rate_of_change_test':
                 var_dict['rate_of_change_test'] = {
-                    'threshold': float(qc_data['qartod_limits'][qc_var+'_rate_of_change_test_threshold'])
+                    'threshold': float(limits['threshold'])
                 }
             elif qc_test == 'flat_line_test':
                 var_dict['flat_line_test'] = {
-                    'tolerance': float(qc_data['qartod_limits'][qc_var+'_flat_line_test_tolerance']),
-                    'suspect_threshold': float(qc_data['qartod_limits'][qc_var+'_flat_line_test_suspect']),
-                    'fail_threshold': float(qc_data['qartod_limits'][qc_var+'_flat_line_test_fail'])
-
+                    'tolerance': float(limits['tolerance']),
+                    'suspect_threshold': float(limits['suspect']),
+                    'fail_threshold': float(limits['fail'])
                 }
+        compiled_limits[var_name] = var_dict
 
-        qc_dict[bb_var] = {}
-        qc_dict[bb_var]['qartod'] = var_dict
-        
-    return qc_dict
+    return compiled_limits
 
 
-# In[ ]:
+def get_compiled_qc_limits(loc_id, smartflag=False):
 
+    # This function is used to get the compiled QC limits for a
+    # location. The limits are only parsed from the QARTOD limits
+    # json when the json has changed since it was last parsed
+    # (based upon its modification time and size).
 
-def load_all_smart_qc_limits(loc_id, smart_vars):
-    
     basedir = bb.get_datadir()
-    qc_file = loc_id + '_smart_qartod.json'
+    if smartflag:
+        qc_file = loc_id + '_smart_qartod.json'
+    else:
+        qc_file = loc_id + '_qartod.json'
     qc_path = os.path.join(basedir, loc_id, 'metadata', qc_file)
-    with open(qc_path) as qc_json:
-        qc_data = json.load(qc_json)
-        
 
-    # Initialize an empty dictionary to hold all the limits
-    qc_dict = {}
+    file_stat = os.stat(qc_path)
+    file_key = (qc_path, file_stat.st_mtime_ns, file_stat.st_size)
+    with _qc_limits_cache_lock:
+        cached = _qc_limits_cache.get((loc_id, smartflag))
+    if (cached is not None) and (cached[0] == file_key):
+        return cached[1]
 
-    # Step through each QC limit sheet name, and parse
-    # out the variable limits
-    qc_keys = [ii for ii in qc_data['qartod_limits'].keys()]
-    for var_id in range(0,len(smart_vars)):
-        
-        smart_var = smart_vars[var_id]
+    qc_data = bb.load_json_file(qc_path)
+    compiled_limits = compile_qc_limits(qc_data['qartod_limits'])
+    with _qc_limits_cache_lock:
+        _qc_limits_cache[(loc_id, smartflag)] = (file_key, compiled_limits)
+
+    return compiled_limits
+
+
+def load_all_qc_limits(loc_id):
+
+    # Get the QC limits for each of the spotter buoy variables
+    # (copied, so that the compiled limits cannot be changed)
+    compiled_limits = get_compiled_qc_limits(loc_id)
+
+    qc_dict = {}
+    for bb_var in QC_VARIABLES:
+        qc_dict[bb_var] = {}
+        qc_dict[bb_var]['qartod'] = copy.deepcopy(compiled_limits.get(bb_var, {}))
         
-        qc_lim_inds = np.where([smart_var in ii for ii in qc_data['qartod_limits']])[0]
-        qc_varnames = [qc_keys[ii] for ii in qc_lim_inds]
-    
-        qc_tests = []
-        if any(['gross_range_test' in ii for ii in qc_varnames]):
-            qc_tests.append('gross_range_test')
-        if any(['spike_test' in ii for ii in qc_varnames]):
-            qc_tests.append('spike_test')
-        if any(['rate_of_change_test' in ii for ii in qc_varnames]):
-            qc_tests.append('rate_of_change_test')
-        if any(['flat_line_test' in ii for ii in qc_varnames]):
-            qc_tests.append('flat_line_test')
+    return qc_dict
 
-        var_dict = {}
-        for qc_test in qc_tests:
-            if qc_test == 'gross_range_test':
-                var_dict['gross_range_test'] = {
-                    'suspect_span': [float(qc_data['qartod_limits'][smart_var+'_gross_range_test_suspect_min']),
-                                     float(qc_data['qartod_limits'][smart_var+'_gross_range_test_suspect_max'])],
-                    'fail_span': [float(qc_data['qartod_limits'][smart_var+'_gross_range_test_fail_min']),
-                                  float(qc_data['qartod_limits'][smart_var+'_gross_range_test_fail_max'])]
-                }
-            elif qc_test == 'spike_test':
-                var_dict['spike_test'] = {
-                    'suspect_threshold': float(qc_data['qartod_limits'][smart_var+'_spike_test_suspect']),
-                    'fail_threshold': float(qc_data['qartod_limits'][smart_var+'_spike_test_fail'])
-                }
-            elif qc_test == 'rate_of_change_test':
-                var_dict['rate_of_change_test'] = {
-                    'threshold': float(qc_data['qartod_limits'][smart_var+'_rate_of_change_test_threshold'])
-                }
-            elif qc_test == 'flat_line_test':
-                var_dict['flat_line_test'] = {
-                    'tolerance': float(qc_data['qartod_limits'][smart_var+'_flat_line_test_tolerance']),
-                    'suspect_threshold': float(qc_data['qartod_limits'][smart_var+'_flat_line_test_suspect']),
-                    'fail_threshold': float(qc_data['qartod_limits'][smart_var+'_flat_line_test_fail'])
 
-                }
+# In[ ]:
 
+
+def load_all_smart_qc_limits(loc_id, smart_vars):
+
+    # Get the QC limits for each of the smart mooring variables
+    # (copied, so that the compiled limits cannot be changed)
+    compiled_limits = get_compiled_qc_limits(loc_id, smartflag=True)
+
+    qc_dict = {}
+    for smart_var in smart_vars:
         qc_dict[smart_var] = {}
-        qc_dict[smart_var]['qartod'] = var_dict
+        qc_dict[smart_var]['qartod'] = copy.deepcopy(compiled_limits.get(smart_var, {}))
         
     return qc_dict
 
@@ -429,6 +420,13 @@ def load_sensor_qartod_config(sensor):
 
 
 def run_qartod_tests(var_df, sensor, config):
+
+    # ioos_qc is imported within the functions that run the tests,
+    # so that it is not loaded for every command line call
+    from ioos_qc.config import Config
+    from ioos_qc.streams import PandasStream
+    from ioos_qc.stores import PandasStore
+    from ioos_qc import qartod
     
     # Ensure that the variable is a pandas dataframe
     if not(isinstance(var_df,pd.DataFrame)):
@@ -461,10 +459,428 @@ def run_qartod_tests(var_df, sensor, config):
     return results_store
 
 
+# In[ ]:
+
+
+# Native QARTOD engine
+#
+# These functions reproduce the ioos_qc QARTOD tests (ioos_qc 2.x/3.x)
+# with plain NumPy array operations, flag-for-flag, including the way
+# that ioos_qc treats missing data and repeated time stamps. They are
+# used in place of the ioos_qc streams when QARTOD_ENGINE = 'native'.
+
+QARTOD_GOOD = 1
+QARTOD_UNKNOWN = 2
+QARTOD_SUSPECT = 3
+QARTOD_FAIL = 4
+# The MISSING flag (9) is bb_flags.QARTOD_MISSING
+
+
+def native_gross_range_test(inp, fail_span, suspect_span=None):
+
+    # Flag data outside of the suspect span as SUSPECT,
+    # data outside of the fail span as FAIL, and any
+    # missing (non-finite) data as MISSING
+    inp = np.asarray(inp, dtype=np.float64)
+    fail_min, fail_max = sorted(fail_span)
+
+    flag_arr = np.full(inp.size, QARTOD_GOOD, dtype=np.uint8)
+    flag_arr[~np.isfinite(inp)] = bb_flags.QARTOD_MISSING
+
+    with np.errstate(invalid='ignore'):
+        if suspect_span is not None:
+            suspect_min, suspect_max = sorted(suspect_span)
+            if (suspect_min < fail_min) or (suspect_max > fail_max):
+                raise ValueError('Suspect span ' + str(suspect_span) +
+                                 ' must fall within the fail span ' + str(fail_span))
+            flag_arr[(inp < suspect_min) | (inp > suspect_max)] = QARTOD_SUSPECT
+        flag_arr[(inp < fail_min) | (inp > fail_max)] = QARTOD_FAIL
+
+    return flag_arr
+
+
+def native_spike_test(inp, suspect_threshold=None, fail_threshold=None):
+
+    # Compare each value against the average of its two neighbours.
+    # The first and last values cannot be tested (UNKNOWN), nor can
+    # values next to missing data (UNKNOWN).
+    inp = np.asarray(inp, dtype=np.float64)
+    missing = ~np.isfinite(inp)
+
+    ref = np.zeros(inp.size)
+    ref_missing = np.zeros(inp.size, dtype=bool)
+    with np.errstate(invalid='ignore', over='ignore'):
+        ref[1:-1] = (inp[:-2] + inp[2:]) / 2
+        ref_missing[1:-1] = ~np.isfinite(ref[1:-1])
+        diff = np.abs(inp - ref)
+
+    flag_arr = np.full(inp.size, QARTOD_GOOD, dtype=np.uint8)
+    with np.errstate(invalid='ignore'):
+        if suspect_threshold:
+            flag_arr[diff > suspect_threshold] = QARTOD_SUSPECT
+        if fail_threshold:
+            flag_arr[diff > fail_threshold] = QARTOD_FAIL
+
+    flag_arr[0] = QARTOD_UNKNOWN
+    flag_arr[-1] = QARTOD_UNKNOWN
+    flag_arr[ref_missing] = QARTOD_UNKNOWN
+    flag_arr[missing] = bb_flags.QARTOD_MISSING
+
+    return flag_arr
+
+
+def native_rate_of_change_test(inp, time_seconds, threshold, fail_threshold=None):
+
+    # Flag the absolute rate of change from the previous value
+    # (in units per second) if it exceeds the threshold
+    inp = np.asarray(inp, dtype=np.float64)
+
+    roc = np.zeros(inp.size)
+    with np.errstate(invalid='ignore', over='ignore'):
+        # Where the time step is zero, ioos_qc masks the division, and
+        # compares the (undivided) absolute difference to the threshold
+        dt = np.diff(time_seconds).astype(np.float64)
+        roc[1:] = np.abs(np.diff(inp) / np.where(dt == 0, 1, dt))
+
+    flag_arr = np.full(inp.size, QARTOD_GOOD, dtype=np.uint8)
+    with np.errstate(invalid='ignore'):
+        flag_arr[roc > threshold] = QARTOD_SUSPECT
+        if fail_threshold is not None:
+            flag_arr[roc > fail_threshold] = QARTOD_FAIL
+    flag_arr[~np.isfinite(inp)] = bb_flags.QARTOD_MISSING
+
+    return flag_arr
+
+
+def native_flat_line_test(inp, time_seconds, suspect_threshold, fail_threshold, tolerance=0,
+                          time_interval=None):
+
+    # Flag each value where the range of the values over the preceding
+    # threshold period (converted to a number of observations using the
+    # median time step) is less than the tolerance
+    #
+    # time_interval - the time step to use in place of the median time
+    #                 step of the input (e.g., that of a longer record,
+    #                 when only part of the record is being tested)
+    inp = np.asarray(inp, dtype=np.float64)
+    flag_arr = np.full(inp.size, QARTOD_GOOD, dtype=np.int64)
+
+    # With fewer than 3 points, the test cannot be run
+    if inp.size < 3:
+        return flag_arr
+
+    if time_interval is None:
+        time_interval = qartod_time_interval(time_seconds)
+    if time_interval == 0:
+        raise ValueError('cannot convert float infinity to integer')
+
+    # Rolling ranges ignore missing values, and are missing
+    # only if all the values in the window are missing
+    values = pd.Series(np.where(np.isfinite(inp), inp, np.nan))
+    for test_threshold, flag_value in [(suspect_threshold, QARTOD_SUSPECT),
+                                       (fail_threshold, QARTOD_FAIL)]:
+        count = int(int(test_threshold) / time_interval)
+        if (count < 0) or (count >= inp.size):
+            continue
+        window = values.rolling(count + 1, min_periods=1)
+        data_range = np.abs(window.max().to_numpy() - window.min().to_numpy())
+        with np.errstate(invalid='ignore'):
+            is_flat = data_range < tolerance
+        # Points before the end of the first window pass
+        is_flat[:count] = False
+        flag_arr[is_flat] = flag_value
+
+    flag_arr[~np.isfinite(inp)] = bb_flags.QARTOD_MISSING
+
+    return flag_arr
+
+
+def native_qartod_compare(flag_arrays):
+
+    # Aggregate the flags of several tests into a single flag, by
+    # precedence: MISSING < UNKNOWN < GOOD < SUSPECT < FAIL
+    priorities = [bb_flags.QARTOD_MISSING, QARTOD_UNKNOWN, QARTOD_GOOD,
+                  QARTOD_SUSPECT, QARTOD_FAIL]
+    flag_rank = np.zeros(bb_flags.QARTOD_MISSING + 1, dtype=np.int8)
+    for rank, flag in enumerate(priorities):
+        flag_rank[flag] = rank
+
+    flags = np.vstack([np.asarray(flag_arr, dtype=np.int64) for flag_arr in flag_arrays])
+
+    return np.array(priorities, dtype=np.uint8)[flag_rank[flags].max(axis=0)]
+
+
+def run_native_qartod_tests(values, time_seconds, sensor, config, time_interval=None,
+                            test_inputs=None):
+
+    # Native equivalent of run_qartod_tests: run each QARTOD test in
+    # the configuration for a sensor, and return a dataframe of the
+    # flags for each test (in configuration order), along with the
+    # aggregate (rollup) flags.
+    #
+    # values       - the sensor data
+    # time_seconds  - the time axis, as integer seconds since 1970-01-01
+    # time_interval - the time step for the flat line test, if it
+    #                 is not the median time step of the time axis
+    # test_inputs   - the input data for particular tests, if it is
+    #                 not the sensor data (e.g., unwrapped directions)
+    native_tests = {'gross_range_test': (native_gross_range_test, False),
+                    'spike_test': (native_spike_test, False),
+                    'rate_of_change_test': (native_rate_of_change_test, True),
+                    'flat_line_test': (native_flat_line_test, True)}
+
+    values = np.asarray(values, dtype=np.float64)
+    results_store = pd.DataFrame(index=pd.RangeIndex(values.size))
+    for test, test_kwargs in config[sensor]['qartod'].items():
+        if test not in native_tests:
+            raise ValueError('The native QARTOD engine does not support the ' + test)
+        test_func, needs_time = native_tests[test]
+        if (test_inputs is not None) and (test in test_inputs):
+            test_values = np.asarray(test_inputs[test], dtype=np.float64)
+        else:
+            test_values = values
+        try:
+            if test == 'flat_line_test':
+                flag_arr = test_func(test_values, time_seconds, time_interval=time_interval,
+                                     **test_kwargs)
+            elif needs_time:
+                flag_arr = test_func(test_values, time_seconds, **test_kwargs)
+            else:
+                flag_arr = test_func(test_values, **test_kwargs)
+        except ValueError as err:
+            # As with ioos_qc, a test that cannot be run is left out
+            print('Could not run "qartod.' + test + '": ' + str(err))
+            continue
+        results_store[sensor + '_qartod_' + test] = flag_arr
+
+    results_store[sensor + '_qartod_rollup_qc'] = native_qartod_compare(
+        [results_store[col].to_numpy() for col in results_store.columns])
+
+    return results_store
+
+
+def qartod_time_seconds(times):
+
+    # Convert a time axis into integer seconds since 1970-01-01,
+    # dropping any fractions of a second
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[s]').astype(np.int64)
+    return pd.to_datetime(times).to_numpy().astype('datetime64[s]').astype(np.int64)
+
+
+def qartod_time_interval(time_seconds):
+
+    # The time step used by the flat line test: the median time
+    # step, truncated to whole seconds (as in ioos_qc)
+    return float(np.trunc(np.median(np.diff(time_seconds))))
+
+
+def qartod_lookback(qc_limits, time_interval):
+
+    # The number of preceding observations needed to recompute the
+    # flags of an observation: one for the spike and rate of change
+    # tests, or the number of observations in the longest flat line
+    # test period (at the given time step)
+    lookback = 1
+    if time_interval <= 0:
+        return lookback
+    for sensor in qc_limits.keys():
+        flat_line = qc_limits[sensor]['qartod'].get('flat_line_test')
+        if flat_line is None:
+            continue
+        for test_threshold in [flat_line['suspect_threshold'], flat_line['fail_threshold']]:
+            lookback = max(lookback, int(int(test_threshold) / time_interval))
+
+    return lookback
+
+
 # In[1]:
 
 
-def process_qartod_tests(ds, sensor_names, qc_limits, smartflag=False):
+def unwrap_direction(values):
+
+    # Unwrap directions (in degrees), so that they change
+    # smoothly across north (e.g., 359 to 361, rather than 1).
+    # Only the finite directions are unwrapped (each one from the
+    # last finite direction before it), as np.unwrap would make
+    # all the directions after a missing direction missing.
+    unwrapped = np.array(values, dtype=float)
+    finite = np.isfinite(unwrapped)
+    unwrapped[finite] = np.unwrap(unwrapped[finite], period=360)
+    return unwrapped
+
+
+# Transformations of the sensor data used as the input of particular
+# QARTOD tests, for the sensors whose names include the given text.
+# The spike, rate of change, and flat line tests of directions are run
+# on the unwrapped directions, while the gross range test is run on
+# the directions themselves.
+QARTOD_TEST_TRANSFORMS = {'from_direction': {'spike_test': unwrap_direction,
+                                             'rate_of_change_test': unwrap_direction,
+                                             'flat_line_test': unwrap_direction}}
+
+
+def get_qartod_test_inputs(sensor, values, tests):
+
+    # Group the QARTOD tests of a sensor by their input data, and
+    # return a list of (input data, tests) pairs. Each transformation
+    # of the sensor data (see QARTOD_TEST_TRANSFORMS) is applied once.
+    test_transforms = {}
+    for sensor_text, transforms in QARTOD_TEST_TRANSFORMS.items():
+        if sensor_text in sensor:
+            test_transforms.update(transforms)
+
+    transform_tests = {}
+    for test in tests:
+        transform_tests.setdefault(test_transforms.get(test), []).append(test)
+
+    test_inputs = []
+    for transform, group_tests in transform_tests.items():
+        if transform is None:
+            test_inputs.append((values, group_tests))
+        else:
+            test_inputs.append((transform(values), group_tests))
+
+    return test_inputs
+
+
+def run_sensor_qartod_tests(sensor, values, time_seconds, sensor_limits, engine,
+                            time_interval=None):
+
+    # Run the QARTOD tests for a single sensor, and return a dictionary
+    # of the flags for each test (in configuration order), along with
+    # the aggregate flags ("{sensor}_qc_agg"), as integer arrays.
+    #
+    # values        - the sensor data, as floats (with NaN for bad data)
+    # time_seconds  - the time axis, as integer seconds since 1970-01-01
+    # sensor_limits - the QC limits for the sensor
+    NT = values.size
+
+    if np.all(np.isnan(values)) or np.all(values == -555):
+        # If all the data is bad, apply "fail" flags everywhere, and
+        # missing flags for each test, indicating that no tests were performed
+        sensor_flags = {sensor+'_qc_agg': 4*np.ones(NT).astype(int)}
+        qc_tests = load_sensor_qartod_config(sensor)
+        for test in qc_tests[sensor]['qartod'].keys():
+            sensor_flags[sensor+'_qartod_'+test] = 9*np.ones(NT).astype(int)
+        return sensor_flags
+
+    # Find the input data for each test (e.g., the spike, rate of change,
+    # and flat line tests of directions use the unwrapped directions)
+    sensor_qc_limits = {sensor: sensor_limits}
+    sensor_tests = list(sensor_limits['qartod'].keys())
+    test_inputs = get_qartod_test_inputs(sensor, values, sensor_tests)
+
+    # Perform the qartod tests for the specified sensor, running
+    # each test once, on its input data
+    if engine == 'native':
+        temp_qartod_df = run_native_qartod_tests(values, time_seconds, sensor, sensor_qc_limits,
+                                                 time_interval,
+                                                 {test: test_values for test_values, group_tests in test_inputs
+                                                  for test in group_tests})
+    elif len(test_inputs) == 1:
+        temp_qartod_df = run_qartod_tests(pd.DataFrame({'time': time_seconds.astype('datetime64[s]'),
+                                                        sensor: values}),
+                                          sensor, sensor_qc_limits)
+    else:
+        from ioos_qc import qartod
+
+        # Run each group of tests that share the same input data
+        # through ioos_qc, and combine the results (in the order
+        # of the tests in the configuration)
+        group_flags = {}
+        for test_values, group_tests in test_inputs:
+            group_qc_limits = {sensor: {'qartod': {test: sensor_limits['qartod'][test]
+                                                   for test in group_tests}}}
+            group_df = run_qartod_tests(pd.DataFrame({'time': time_seconds.astype('datetime64[s]'),
+                                                      sensor: test_values}),
+                                        sensor, group_qc_limits)
+            for col in group_df.columns:
+                group_flags[col] = group_df[col]
+        temp_qartod_df = pd.DataFrame({sensor + '_qartod_' + test: group_flags[sensor + '_qartod_' + test]
+                                       for test in sensor_tests
+                                       if sensor + '_qartod_' + test in group_flags})
+
+        # Create new aggregated flags, based upon
+        # the combined qc test results
+        temp_qartod_df[sensor + '_qartod_rollup_qc'] = qartod.qartod_compare(temp_qartod_df.to_numpy().T)
+
+    # The rollup flags are the aggregate flags
+    sensor_flags = {}
+    for col in temp_qartod_df.columns:
+        col_flags = np.ma.getdata(temp_qartod_df[col].to_numpy())
+        if col == sensor + '_qartod_rollup_qc':
+            sensor_flags[sensor + '_qc_agg'] = col_flags
+        else:
+            sensor_flags[col] = col_flags
+
+    return sensor_flags
+
+
+def _run_sensor_qartod_chunk(sensor_chunk, time_seconds, engine, time_interval):
+
+    # Run the QARTOD tests for a chunk of sensors in a worker process,
+    # where sensor_chunk is a list of (sensor, values, limits)
+    return [(sensor, run_sensor_qartod_tests(sensor, values, time_seconds,
+                                             sensor_limits, engine, time_interval))
+            for sensor, values, sensor_limits in sensor_chunk]
+
+
+def _init_qartod_worker(warning_filters):
+
+    # Use the same warning filters in the worker processes
+    # as in the main process
+    warnings.filters[:] = warning_filters
+
+
+# Pool of worker processes for the QARTOD tests, which is started
+# the first time it is needed, and then kept for later calls (as
+# starting the worker processes takes longer than running the tests)
+_qartod_executor = None
+_qartod_executor_workers = 0
+_qartod_executor_lock = threading.Lock()
+
+
+def get_qartod_executor(workers):
+
+    # Get the pool of worker processes for the QARTOD tests,
+    # starting a new pool if the number of workers has changed
+    global _qartod_executor, _qartod_executor_workers
+
+    with _qartod_executor_lock:
+        if (_qartod_executor is None) or (_qartod_executor_workers != workers):
+            if _qartod_executor is not None:
+                _qartod_executor.shutdown()
+            mp_context = multiprocessing.get_context('spawn')
+            _qartod_executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                                      mp_context=mp_context,
+                                                                      initializer=_init_qartod_worker,
+                                                                      initargs=(warnings.filters,))
+            _qartod_executor_workers = workers
+
+    return _qartod_executor
+
+
+# In[ ]:
+
+
+def process_qartod_tests(ds, sensor_names, qc_limits, smartflag=False, engine=None,
+                         time_interval=None, workers=None):
+
+    # Select the QARTOD test engine
+    if engine is None:
+        engine = QARTOD_ENGINE
+    if engine not in ['ioos_qc', 'native']:
+        raise ValueError('Unknown QARTOD engine: ' + str(engine))
+
+    # The time step of the flat line test can only be
+    # set from outside the data with the native engine
+    if (time_interval is not None) and (engine != 'native'):
+        raise ValueError('A flat line test time step requires the native QARTOD engine')
+
+    if workers is None:
+        workers = QARTOD_WORKERS
     
     if smartflag:
         qartod_valid_sensors = bb_process.get_valid_smart_vars(ds)
@@ -478,106 +894,53 @@ def process_qartod_tests(ds, sensor_names, qc_limits, smartflag=False):
                                 'sea_surface_wave_frequency_at_variance_spectral_density_maximum', 
                                 'sea_surface_wave_mean_frequency',
                                 'sea_water_temperature']
-    qartod_df = []
-    NT = ds['time'].size
-    
-    time_qartod = np.array([datetime.datetime.strptime(ii,'%Y-%m-%d %H:%M:%S') for ii in 
-                            [ii.strftime('%Y-%m-%d %H:%M:%S') for ii in 
-                             [pd.Timestamp(ii) for ii in ds['time'].to_numpy()]]])
-    
+
+    # Build the time axis for the tests once, for all of the
+    # sensors, as integer seconds since 1970-01-01
+    time_seconds = qartod_time_seconds(ds['time'].to_numpy())
+
+    # Extract out the data for each sensor to test, ensuring that any
+    # "bad" data is given as a NaN (and not None or any other missing
+    # value type)
+    sensor_data = []
     for sensor in sensor_names:
         if (sensor in qartod_valid_sensors):
-            var_df = ds.loc[:,['time',sensor]]
-            temp_sens = var_df[sensor].to_numpy().flatten()
-            
-            # Ensure that any "bad" data is given as a NaN
-            # (and not np.inf or any other invalid data type)
-            temp_sens[var_df[sensor].isna()] = np.nan
-            var_df[sensor] = temp_sens
-            var_df['time'] = time_qartod
-            
-            if not((all(var_df[sensor].isna())) or (all(var_df[sensor] == -555))):
-
-                # Perform the qartod tests for the specified sensor
-                sensor_qc_limits = {sensor: qc_limits[sensor]}
-                temp_qartod_df = run_qartod_tests(var_df, sensor, sensor_qc_limits)        
-                
-                
-                if 'from_direction' in sensor:
-                    # Make a copy of the dataframe, and unwrap the directional data in it
-                    var_df2 = var_df.copy()
-                    var_df2.loc[:,sensor] = np.unwrap(var_df.loc[:,sensor], period=360)
-                    
-                    # Rerun the QC tests on the unwrapped data
-                    temp_qartod_df2 = run_qartod_tests(var_df2, sensor, sensor_qc_limits)
-                    
-                    # Update the spike/rate-of-change/flat-line tests with the 
-                    # results from the unwrapped data tests
-                    temp_qartod_df[sensor + '_qartod_rate_of_change_test'] = temp_qartod_df2[sensor + '_qartod_rate_of_change_test']
-                    temp_qartod_df[sensor + '_qartod_spike_test'] = temp_qartod_df2[sensor + '_qartod_spike_test']
-                    temp_qartod_df[sensor + '_qartod_flat_line_test'] = temp_qartod_df2[sensor + '_qartod_flat_line_test']
-
-                    # Create new aggregated flags, based upon the 
-                    # new qc test results
-                    aggr_flags = qartod.qartod_compare(temp_qartod_df.drop(columns=[sensor + '_qartod_rollup_qc']).to_numpy().T)
-                    temp_qartod_df[sensor + '_qartod_rollup_qc'] = aggr_flags
-
-                temp_results = concat_test_results_into_string(temp_qartod_df)
-
-                temp_qartod_compiled = pd.DataFrame(data=list(zip(np.ndarray.flatten(temp_qartod_df[sensor+'_qartod_rollup_qc'].to_numpy()),
-                                                                  temp_results)),
-                                                    columns=[sensor+'_qc_agg',
-                                                             sensor+'_qc_tests'])
-            
-                temp_qartod_final = temp_qartod_df.copy()
-                for col in temp_qartod_compiled.columns:
-                    temp_qartod_final[col] = temp_qartod_compiled[col]
-                
+            sensor_data.append((sensor,
+                                ds[sensor].to_numpy(dtype=float, na_value=np.nan),
+                                qc_limits.get(sensor)))
+
+    if (workers <= 1) or (len(sensor_data) <= 1):
+        sensor_results = _run_sensor_qartod_chunk(sensor_data, time_seconds,
+                                                  engine, time_interval)
+    else:
+        # Run the tests for the sensors in separate worker processes.
+        # The sensors are split into one chunk per worker, so that only
+        # the sensor data and one copy of the time axis are sent to
+        # each worker.
+        nchunks = min(workers, len(sensor_data))
+        sensor_chunks = [sensor_data[ii::nchunks] for ii in range(nchunks)]
+        executor = get_qartod_executor(workers)
+        futures = [executor.submit(_run_sensor_qartod_chunk, sensor_chunk, time_seconds,
+                                   engine, time_interval)
+                   for sensor_chunk in sensor_chunks]
+        chunk_results = dict(result for future in futures for result in future.result())
+        sensor_results = [(sensor, chunk_results[sensor]) for sensor, _, _ in sensor_data]
+
+    # Gather the flag arrays of all the sensors, in order
+    qartod_flags = {}
+    for sensor, sensor_flags in sensor_results:
+        qartod_flags.update(sensor_flags)
 
-            else:
-                # If all the data is bad, apply "fail" flags everywhere, and assign 9999 for the tests, indicating
-                # that no tests were performed
-                temp_qartod_final = pd.DataFrame(data=list(zip(4*np.ones(NT).astype(int),
-                                                               9999*np.ones(NT).astype(int))),
-                                                 columns=[sensor+'_qc_agg',
-                                                          sensor+'_qc_tests']) 
-                qc_tests = load_sensor_qartod_config(sensor)
-                for test in qc_tests[sensor]['qartod'].keys():
-                    temp_qartod_final[sensor+'_qartod_'+test] = 9*np.ones(NT).astype(int)
-                
-        
-            
-            # Append on the newly created qartod flags to the qartod dataframe
-            if isinstance(qartod_df,list):
-                qartod_df = temp_qartod_final
-            else:
-                qartod_df = pd.concat([qartod_df, temp_qartod_final],axis=1)
-                
-    
     # Copy the flags for frequency into the flags for period
-    for col in qartod_df.columns:
+    for col in list(qartod_flags.keys()):
         if 'period' in col:
-            # Create the matching frequency columns name as the
-            # current period column name
-            freq_col = col.replace('period','frequency')            
-            
-            # Replace the values in the period column with
-            # those from the frequency column
-            qartod_df[col] = qartod_df[freq_col]
-            
-            # Drop the frequency columns
-            qartod_df = qartod_df.drop(columns=freq_col)
-            
-            
-    # Drop the rollup qc flag
-    for col in qartod_df.columns:
-        if 'qartod_rollup_qc' in col:
-            # Drop the rollup qc flag column
-            qartod_df = qartod_df.drop(columns=col)
-        if '_qc_tests' in col:
-            # Drop the rollup qc flag column
-            qartod_df = qartod_df.drop(columns=col)
+            # Replace the values in the period column with those
+            # from the matching frequency column, and drop the
+            # frequency column
+            qartod_flags[col] = qartod_flags.pop(col.replace('period','frequency'))
 
+    # Build the dataframe of flags in one step
+    qartod_df = pd.DataFrame(qartod_flags, index=ds.index)
             
     return qartod_df
 
@@ -585,42 +948,9 @@ def process_qartod_tests(ds, sensor_names, qc_limits, smartflag=False):
 # In[ ]:
 
 
-def concat_test_results_into_string(temp_qartod_df):
-    
-    # Initialize array to store concatenated QARTOD results
-    # Each row will contain a multi-digit number representing all test results
-    qartod_results = np.zeros(len(temp_qartod_df)).astype(int)
-    
-    # Get column names for all QC tests (exclude the aggregate rollup)
-    qar_cols = temp_qartod_df.columns
-    # Filter out the rollup column - we only want individual test results
-    qar_cols = [ii for ii in qar_cols if 'qartod_rollup_qc' not in ii]
-    
-    # Concatenate test results into a single multi-digit number
-    # Example: If there are 3 tests with results [1, 4, 1],
-    # the final result should be 141 (read left-to-right as test1-test2-test3)
-    # 
-    # Algorithm: Multiply each flag by the appropriate power of 10
-    #   Result = (10^2)*flag1 + (10^1)*flag2 + (10^0)*flag3
-    #          = 100*1 + 10*4 + 1*1 = 141
-    # 
-    # The exponent starts at (number of tests - 1) and decreases
-    fact = len(qar_cols) - 1  # Starting exponent
-    for column in qar_cols:
-        # Add this test's contribution: flag_value * 10^exponent
-        qartod_results = qartod_results + (temp_qartod_df.loc[:,column].astype(float) * (10**fact)).astype(int)
-        fact = fact - 1  # Decrease exponent for next test
-     
-    # Convert numpy array to Python list for JSON serialization
-    qartod_results = [ii for ii in qartod_results]
-
-    return qartod_results
-
-
-# In[ ]:
-
-
 def add_qc_attrs(ds, df_qc):
+
+    import xarray as xr
     
     # Create a new xarray Dataset to hold QC variables with proper attributes
     ds_qc = xr.Dataset()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The pipeline modules are run as scripts from python_scripts,
+# and import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'python_scripts'))
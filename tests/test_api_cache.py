@@ -0,0 +1,89 @@
+import concurrent.futures
+import multiprocessing
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import backyardbuoys_dataaccess as bb_da
+import backyardbuoys_processdata as bb_process
+
+
+def _timeseries_entry():
+    return {'created_at': 1704067200, 'fetched_at': 1704067200,
+            'start': 1704067200, 'end': 1704070800, 'open_ended': False,
+            'data': {'WaterTemp': {'units': 'degC',
+                                   'data': {'timestamp': np.array([1704067200, 1704069000]),
+                                            'value': np.array([10.5, np.nan]),
+                                            'platform_id': pd.Categorical(['SPOT-1', 'SPOT-2']),
+                                            'type': np.array(['spotter', None], dtype=object)}}}}
+
+
+def test_timeseries_entry_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(bb_da, '_api_cache_dir', str(tmp_path))
+    path = bb_da._get_api_cache_path('get_location_data', ['url', {'location_id': 'loc'}], '.npz')
+    entry = _timeseries_entry()
+
+    bb_da._write_api_cache(path, entry)
+    cached = bb_da._read_api_cache(path)
+
+    assert {key: cached[key] for key in cached if key != 'data'} == \
+           {key: entry[key] for key in entry if key != 'data'}
+    cached_var = cached['data']['WaterTemp']
+    assert cached_var['units'] == 'degC'
+    np.testing.assert_array_equal(cached_var['data']['timestamp'], [1704067200, 1704069000])
+    np.testing.assert_array_equal(cached_var['data']['value'], [10.5, np.nan])
+    assert isinstance(cached_var['data']['platform_id'], pd.Categorical)
+    assert list(cached_var['data']['platform_id']) == ['SPOT-1', 'SPOT-2']
+    assert list(cached_var['data']['type']) == ['spotter', None]
+
+
+def test_json_entry_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(bb_da, '_api_cache_dir', str(tmp_path))
+    path = bb_da._get_api_cache_path('get_locations', ['url', None])
+    entry = {'fetched_at': 1704067200.5, 'payload': [{'loc_id': 'loc', 'lat': 47.9}]}
+
+    bb_da._write_api_cache(path, entry)
+
+    assert path.endswith('.json')
+    assert bb_da._read_api_cache(path) == entry
+
+
+def test_eviction_removes_oldest_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(bb_da, '_api_cache_dir', str(tmp_path))
+    now = bb_da.time.time()
+
+    # An entry past the maximum age is always removed
+    expired = tmp_path / 'get_locations_expired.json'
+    expired.write_text('{}')
+    os.utime(expired, (now - bb_da.API_CACHE_MAX_AGE - 60,)*2)
+
+    # Above the size limit, the entries written longest ago are removed
+    paths = []
+    for ii in range(3):
+        path = tmp_path / ('get_platforms_' + str(ii) + '.json')
+        path.write_text('x'*1000)
+        os.utime(path, (now - 300 + ii,)*2)
+        paths.append(path)
+    monkeypatch.setattr(bb_da, 'API_CACHE_MAX_BYTES', 2500)
+
+    bb_da._evict_api_cache()
+
+    assert not(expired.exists())
+    assert [path.exists() for path in paths] == [False, True, True]
+
+
+def _api_cache_enabled():
+    return bb_da.API_CACHE_ENABLED
+
+
+def test_update_workers_use_api_cache_setting():
+    # The worker processes of update_all_locations are started
+    # afresh, with the API cache setting of the main process
+    mp_context = multiprocessing.get_context('spawn')
+    for enabled in [True, False]:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=mp_context,
+                                                    initializer=bb_process._init_update_worker,
+                                                    initargs=(warnings.filters, enabled)) as executor:
+            assert executor.submit(_api_cache_enabled).result() is enabled
@@ -0,0 +1,197 @@
+import contextlib
+import io
+import warnings
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import backyardbuoys_benchmarks as bb_bench
+import backyardbuoys_processdata as bb_process
+
+LOC_ID = 'synthetic'
+
+
+def _quiet(func, *args, **kwargs):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        result = func(*args, **kwargs)
+    return result, output.getvalue()
+
+
+@pytest.fixture(scope='module')
+def month_data():
+    # A month of half-hourly data, with the variables of a monthly file
+    qc_data, qc_limits = bb_bench.make_synthetic_qc_data(ndays=30)
+    ds = bb_bench._make_qc_dataset(qc_data, LOC_ID, qc_limits)
+    nsamps = ds.sizes['time']
+    ds['buoy_id'] = (('location_id', 'time'), np.array([['SPOT-00001']*nsamps], dtype=object))
+    ds['latitude'] = (('location_id', 'time'), np.full((1, nsamps), 47.5))
+    ds['longitude'] = (('location_id', 'time'), np.full((1, nsamps), -124.5))
+    for varname in list(ds.keys()):
+        peak_name = varname.replace('_at_variance_spectral_density_maximum', '')
+        if (peak_name != varname) and (peak_name not in ds.keys()):
+            ds[peak_name] = ds[varname]
+    ds['sea_surface_wave_mean_period'] = ds['sea_surface_wave_period_at_variance_spectral_density_maximum']
+    return ds
+
+
+@pytest.fixture
+def netcdf_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(bb_process.bb, 'get_datadir', lambda: str(tmp_path))
+    monkeypatch.setattr(bb_process, 'netcdf_add_global_metadata', lambda dataset, *args: dataset)
+    monkeypatch.setattr(bb_process, 'APPEND_NETCDF', True)
+
+    def write(ds):
+        first_time = ds['time'].to_index()[0]
+        _, output = _quiet(bb_process.write_netcdf, ds, LOC_ID, first_time.year, first_time.month)
+        ncpath = tmp_path / LOC_ID / bb_process.get_netcdf_filename(LOC_ID, first_time.year, first_time.month)
+        return ncpath, output
+
+    return write
+
+
+def _load(ncpath):
+    with xr.open_dataset(ncpath, mask_and_scale=False) as dataset:
+        dataset = dataset.load()
+    dataset.attrs.pop('creation_date', None)
+    return dataset
+
+
+@pytest.mark.parametrize('in_place', [False, True])
+def test_append_matches_full_rewrite(month_data, netcdf_writer, monkeypatch, in_place):
+    monkeypatch.setattr(bb_process, 'APPEND_NETCDF_IN_PLACE', in_place)
+    nold = month_data.sizes['time'] - 48
+    ncpath, _ = netcdf_writer(month_data.isel(time=slice(0, nold)))
+    inode = ncpath.stat().st_ino
+
+    # Change a value of an existing record, in the second-to-last block
+    ds_new = month_data.copy(deep=True)
+    changed = nold - bb_process.NETCDF_APPEND_BLOCK - 10
+    ds_new['sea_surface_wave_significant_height'][0, changed] = 9.0
+
+    # Only the records from the start of the block that changed
+    # are written (into a copy of the file that is renamed over it,
+    # or, in place, into the file itself), rather than the whole file
+    move = bb_process.shutil.move
+
+    def no_move(*args):
+        raise AssertionError('the file was rewritten, not appended to')
+    monkeypatch.setattr(bb_process.shutil, 'move', no_move)
+    _, output = netcdf_writer(ds_new)
+    first_write = (changed // bb_process.NETCDF_APPEND_BLOCK)*bb_process.NETCDF_APPEND_BLOCK
+    assert '(48 new records, ' + str(nold - first_write) + ' records rewritten)' in output
+    assert (ncpath.stat().st_ino == inode) == in_place
+    assert not((ncpath.parent / 'bb_tempfile.nc').exists())
+    ds_appended = _load(ncpath)
+    monkeypatch.setattr(bb_process.shutil, 'move', move)
+
+    # The appended file is the same as a file written in full
+    ncpath.unlink()
+    netcdf_writer(ds_new)
+    xr.testing.assert_identical(ds_appended, _load(ncpath))
+
+    # Writing the same data again leaves the file as it is
+    _, output = netcdf_writer(ds_new)
+    assert 'is unchanged' in output
+
+
+@pytest.mark.parametrize('in_place', [False, True])
+def test_failed_append_is_rewritten(month_data, netcdf_writer, monkeypatch, in_place):
+    monkeypatch.setattr(bb_process, 'APPEND_NETCDF_IN_PLACE', in_place)
+    nold = month_data.sizes['time'] - 48
+    ncpath, _ = netcdf_writer(month_data.isel(time=slice(0, nold)))
+
+    # If the records cannot be written, the file is left as it was
+    # (or, in place, its fingerprints are left cleared), and it is
+    # written in full instead
+    write_netcdf_index = bb_process.write_netcdf_index
+    copyfile = bb_process.shutil.copyfile
+    record_values = bb_process.netcdf_record_values
+    failing = []
+    published = []
+
+    def clearing_index(loc_id, netcdf_index):
+        write_netcdf_index(loc_id, netcdf_index)
+        if netcdf_index[ncpath.name]['block_fingerprints'] is None:
+            failing.append(True)
+
+    def copying_file(src, dst):
+        copyfile(src, dst)
+        failing.append(True)
+
+    def failing_values(ds, varname, datatype=None):
+        if failing:
+            failing.clear()
+            published.append(_load(ncpath).sizes['time'])
+            raise OSError('disk full')
+        return record_values(ds, varname, datatype)
+    monkeypatch.setattr(bb_process, 'write_netcdf_index', clearing_index)
+    monkeypatch.setattr(bb_process.shutil, 'copyfile', copying_file)
+    monkeypatch.setattr(bb_process, 'netcdf_record_values', failing_values)
+    _, output = netcdf_writer(month_data)
+    monkeypatch.setattr(bb_process, 'write_netcdf_index', write_netcdf_index)
+    monkeypatch.setattr(bb_process.shutil, 'copyfile', copyfile)
+    monkeypatch.setattr(bb_process, 'netcdf_record_values', record_values)
+    assert 'disk full' in output
+    # (in place, the published file was partly appended to)
+    assert (published == [nold]) != in_place
+    assert 'successfully replaced' in output
+    entry = bb_process.load_netcdf_index(LOC_ID)[ncpath.name]
+    assert entry['nrecords'] == month_data.sizes['time']
+    assert entry['block_fingerprints'] is not None
+
+    # Records removed from the end of the file are not appended
+    _, output = netcdf_writer(month_data.isel(time=slice(0, nold)))
+    assert 'Records were removed' in output
+    assert _load(ncpath).sizes['time'] == nold
+
+
+def test_index_is_checked_once_per_run(month_data, netcdf_writer, monkeypatch):
+    ncpath, _ = netcdf_writer(month_data.isel(time=slice(0, 480)))
+    index_entries = bb_process.read_netcdf_index(LOC_ID)
+
+    # The data directories are listed the first time the index is
+    # loaded, and not when files are written or the index is reloaded
+    listdir = bb_process.os.listdir
+    listed = []
+
+    def counted_listdir(path):
+        listed.append(path)
+        return listdir(path)
+    monkeypatch.setattr(bb_process.os, 'listdir', counted_listdir)
+    bb_process._netcdf_index_checked.clear()
+    assert bb_process.load_netcdf_index(LOC_ID) == index_entries
+    assert len(listed) == 1
+    netcdf_writer(month_data)
+    bb_process.load_netcdf_index(LOC_ID)
+    assert len(listed) == 1
+    monkeypatch.setattr(bb_process.os, 'listdir', listdir)
+
+    # Writing a file only changes its own entry
+    other_file = 'bb_' + LOC_ID + '_190001.nc'
+    index_entries = bb_process.read_netcdf_index(LOC_ID)
+    index_entries[other_file] = dict(index_entries[ncpath.name], nrecords=1)
+    bb_process.write_netcdf_index(LOC_ID, index_entries)
+    netcdf_writer(month_data.isel(time=slice(0, 960)))
+    index_entries = bb_process.read_netcdf_index(LOC_ID)
+    assert index_entries[other_file]['nrecords'] == 1
+    assert index_entries[ncpath.name]['nrecords'] == 960
+
+
+def test_metadata_change_rewrites_file(month_data, netcdf_writer, monkeypatch):
+    metadata = {'location_name': 'Synthetic'}
+    monkeypatch.setattr(bb_process, 'get_location_metadata', lambda loc_id: dict(metadata))
+    nold = month_data.sizes['time'] - 48
+    netcdf_writer(month_data.isel(time=slice(0, nold)))
+
+    # A file whose metadata changed is neither skipped as
+    # unchanged nor appended to, but written in full
+    metadata['location_name'] = 'Synthetic Bay'
+    _, output = netcdf_writer(month_data.isel(time=slice(0, nold)))
+    assert 'is unchanged' not in output
+    assert 'The metadata of ' in output
+    assert 'successfully replaced' in output
+    _, output = netcdf_writer(month_data)
+    assert 'appended (48 new records, 0 records rewritten)' in output
@@ -0,0 +1,29 @@
+import backyardbuoys_dataaccess as bb_da
+import backyardbuoys_processdata as bb_process
+
+LOC_ID = 'synthetic'
+
+
+def test_worker_http_stats_are_added_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(bb_process.bb, 'get_datadir', lambda: str(tmp_path))
+    monkeypatch.setattr(bb_da, '_http_session', None)
+    monkeypatch.setattr(bb_da, '_http_stats', {'requests': 5, 'retries': 1, 'closed_connections': 2})
+
+    # A worker that has already updated another location
+    # returns only the requests made for this location
+    def requesting_update(loc_id, rebuild_flag=False, rerun_tests=False):
+        bb_da._http_stats['requests'] += 3
+        bb_da._http_stats['retries'] += 1
+        bb_da._http_stats['closed_connections'] += 1
+        return True
+    monkeypatch.setattr(bb_process, 'update_location_with_logging', requesting_update)
+    update_success, _, _, http_stats = bb_process.update_location_to_log(LOC_ID)
+    assert update_success is True
+    assert http_stats == {'requests': 3, 'retries': 1, 'connections_opened': 1, 'connections_reused': 2}
+
+    # The main process adds the requests of each worker to its own
+    monkeypatch.setattr(bb_da, '_http_stats', {'requests': 4, 'retries': 0, 'closed_connections': 1})
+    bb_da.add_http_stats(http_stats)
+    bb_da.add_http_stats(http_stats)
+    assert bb_da.get_http_stats() == {'requests': 10, 'retries': 2,
+                                      'connections_opened': 3, 'connections_reused': 7}
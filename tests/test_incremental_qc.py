@@ -0,0 +1,137 @@
+import contextlib
+import io
+import json
+import warnings
+
+import numpy as np
+import pytest
+
+import backyardbuoys_benchmarks as bb_bench
+import backyardbuoys_processdata as bb_process
+import backyardbuoys_qualitycontrol as bb_qc
+
+LOC_ID = 'synthetic'
+PLATFORMS = ('SPOT-00001', 'SPOT-00002')
+
+
+def _quiet(func, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return func(*args, **kwargs)
+
+
+@pytest.fixture
+def update_run(tmp_path, monkeypatch):
+    # A location whose existing data and newly pulled data are
+    # served from memory, as process_newdata would pull them
+
+    metadir = tmp_path / LOC_ID / 'metadata'
+    metadir.mkdir(parents=True)
+    spotter_data = {platform: {'can_data_archive': 'yes', 'can_share_ndbc_nws': 'yes'}
+                    for platform in PLATFORMS}
+    (metadir / (LOC_ID + '_info.json')).write_text(
+        json.dumps({'spotter_ids': ','.join(PLATFORMS), 'spotter_data': spotter_data,
+                    'loc_history': {}}))
+
+    _, qc_limits = bb_bench.make_synthetic_qc_data(ndays=1)
+    monkeypatch.setattr(bb_process.bb, 'get_datadir', lambda: str(tmp_path))
+    monkeypatch.setattr(bb_process, 'get_buoy_qc_limits', lambda ds, loc_id, smartflag=False: qc_limits)
+    monkeypatch.setattr(bb_process.bb_da, 'bbapi_get_location_data',
+                        lambda *args, **kwargs: {'WaveHeightSig': {'data': {'platform_id': list(PLATFORMS)}}})
+
+    pulls = {}
+    monkeypatch.setattr(bb_process, 'get_data_by_location',
+                        lambda loc_id, time_start=None, time_end=None: (pulls['new'].copy(), None))
+    monkeypatch.setattr(bb_process, 'load_existing_netcdf',
+                        lambda loc_id, rebuild_period=None: (pulls['old'], None, False))
+
+    # The pipeline state of the last run, which found the existing
+    # flags with the same QC limits and (half-hourly) time step
+    stream_state = {'qc_config_hash': 'qc-limits', 'qc_time_interval': 1800.0}
+    monkeypatch.setattr(bb_process, 'PIPELINE_STATE', True)
+    monkeypatch.setattr(bb_process, 'get_state_pull_window', lambda loc_id: None)
+    monkeypatch.setattr(bb_process, 'get_qc_config_hash', lambda loc_id, smartflag=False: 'qc-limits')
+    monkeypatch.setattr(bb_process.bb_state, 'get_stream_state',
+                        lambda loc_id, stream='spotter': stream_state)
+
+    def run(old_df, new_df, incremental_qc):
+        monkeypatch.setattr(bb_process, 'INCREMENTAL_QC', incremental_qc)
+        pulls['old'] = None
+        pulls['new'] = old_df
+        ds_old, _ = _quiet(bb_process.process_newdata, LOC_ID)
+        pulls['old'] = _quiet(bb_process.check_duplicates, ds_old)
+        pulls['new'] = new_df
+        qc_calls.clear()
+        ds_all, _ = _quiet(bb_process.process_newdata, LOC_ID)
+        return _quiet(bb_process.check_duplicates, ds_all)
+
+    # Record the number of observations given to each QC run
+    qc_calls = []
+    get_buoy_qcflags = bb_process.get_buoy_qcflags
+
+    def counted_qcflags(ds, *args, **kwargs):
+        qc_calls.append(len(ds))
+        return get_buoy_qcflags(ds, *args, **kwargs)
+    monkeypatch.setattr(bb_process, 'get_buoy_qcflags', counted_qcflags)
+    run.qc_calls = qc_calls
+    run.stream_state = stream_state
+    run.qc_limits = qc_limits
+
+    return run
+
+
+def test_incremental_qc_matches_full_recompute(update_run):
+    # Two weeks of existing data, and a new pull that
+    # overlaps the last day and a half of it
+    api_data = bb_bench.make_synthetic_api_data(14*48*9, smartflag=False, platforms=PLATFORMS)
+    frames, _ = bb_process.pivot_observations(api_data)
+    frames = frames.sort_values('time').reset_index(drop=True)
+    old_end = len(frames) - 48
+    new_start = old_end - 72
+
+    # Directions are only missing early in the record, well before
+    # the QC window, which must not change the flags of the
+    # (unwrapped) directions in the window
+    direction_cols = ['WaveDirMean', 'WaveDirPeak']
+    frames[direction_cols] = frames[direction_cols].fillna(0.5)
+    frames.loc[10, direction_cols] = np.nan
+    old_df = frames.iloc[:old_end].reset_index(drop=True)
+    new_df = frames.iloc[new_start:].reset_index(drop=True)
+
+    ds_incremental = update_run(old_df, new_df, incremental_qc=True)
+
+    # The tests are run once, on the new data and the
+    # existing data that they look back over
+    assert len(update_run.qc_calls) == 1
+    lookback = bb_qc.qartod_lookback(update_run.qc_limits, 1800)
+    assert update_run.qc_calls[0] == len(new_df) + 1 + lookback
+
+    # The flags must match those from rerunning all the
+    # tests on the final (deduplicated) record
+    assert ds_incremental.sizes['time'] == len(frames)
+    assert np.all(np.diff(ds_incremental['time'].to_numpy()) > np.timedelta64(0))
+    ds_full = _quiet(bb_process.rerun_qc_tests, ds_incremental.copy(deep=True), LOC_ID)
+    flag_vars = [varname for varname in ds_full.keys() if '_qc_' in varname]
+    assert len(flag_vars) > 0
+    for varname in flag_vars:
+        np.testing.assert_array_equal(ds_incremental[varname].to_numpy(),
+                                      ds_full[varname].to_numpy(), err_msg=varname)
+    spike_flags = bb_process.bb_flags.read_flag_planes(
+        ds_full, ['sea_surface_wave_from_direction_qc_spike_test'])[0]
+    assert not(np.all(spike_flags[11:] == bb_process.bb_flags.QARTOD_MISSING))
+
+
+@pytest.mark.parametrize('changed', ['qc_config_hash', 'qc_time_interval'])
+def test_changed_qc_config_reruns_all_tests(update_run, changed):
+    api_data = bb_bench.make_synthetic_api_data(4*48*9, smartflag=False, platforms=PLATFORMS)
+    frames, _ = bb_process.pivot_observations(api_data)
+    frames = frames.sort_values('time').reset_index(drop=True)
+    old_df = frames.iloc[:len(frames) - 48].reset_index(drop=True)
+    new_df = frames.iloc[len(frames) - 96:].reset_index(drop=True)
+
+    # If the existing flags were found with other QC limits, or
+    # another time step, the tests are rerun on all of the data
+    update_run.stream_state[changed] = 'other-limits' if changed == 'qc_config_hash' else 600.0
+    ds_all = update_run(old_df, new_df, incremental_qc=True)
+    assert update_run.qc_calls == [len(frames)]
+    assert ds_all.sizes['time'] == len(frames)
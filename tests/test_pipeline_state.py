@@ -0,0 +1,70 @@
+import contextlib
+import datetime
+import io
+import sqlite3
+
+import pytest
+
+import backyardbuoys_processdata as bb_process
+
+LOC_ID = 'synthetic'
+
+
+@pytest.fixture
+def state_calls(monkeypatch):
+    # Record the calls to the pipeline state store, for an
+    # update of a location that always succeeds
+    calls = []
+    monkeypatch.setattr(bb_process, 'update_data_by_location',
+                        lambda loc_id, rebuild_flag=False, rerun_tests=False: True)
+    monkeypatch.setattr(bb_process.bb_state, 'record_run_seconds',
+                        lambda loc_id, run_seconds: calls.append(loc_id))
+    return calls
+
+
+def _update(loc_id):
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        update_success = bb_process.update_location_with_logging(loc_id)
+    return update_success, output.getvalue()
+
+
+def test_state_is_only_recorded_with_pipeline_state(state_calls, monkeypatch):
+    monkeypatch.setattr(bb_process, 'PIPELINE_STATE', False)
+    assert _update(LOC_ID)[0] is True
+    assert state_calls == []
+
+    monkeypatch.setattr(bb_process, 'PIPELINE_STATE', True)
+    assert _update(LOC_ID)[0] is True
+    assert state_calls == [LOC_ID]
+
+
+def test_state_store_errors_are_handled_per_location(state_calls, monkeypatch):
+    def locked_store(loc_id, run_seconds):
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(bb_process, 'PIPELINE_STATE', True)
+    monkeypatch.setattr(bb_process.bb_state, 'record_run_seconds', locked_store)
+
+    update_success, output = _update(LOC_ID)
+    assert update_success is None
+    assert 'Error processing ' + LOC_ID + ': database is locked' in output
+
+
+def test_qc_time_interval_is_added_to_existing_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(bb_process.bb_state.bb, 'get_datadir', lambda: str(tmp_path))
+
+    # A state database from before the QC time step was recorded
+    with contextlib.closing(sqlite3.connect(bb_process.bb_state.get_state_path())) as connection:
+        connection.execute('CREATE TABLE stream_state (loc_id TEXT NOT NULL, stream TEXT NOT NULL, '
+                           'last_ingested TEXT, last_success TEXT, qc_config_hash TEXT, '
+                           'PRIMARY KEY (loc_id, stream))')
+        connection.execute("INSERT INTO stream_state VALUES (?, 'spotter', '2024-01-31T23:30:00Z', "
+                           "'2024-02-01T00:00:00Z', 'qc-limits')", (LOC_ID,))
+        connection.commit()
+    assert bb_process.bb_state.get_stream_state(LOC_ID)['qc_time_interval'] is None
+
+    last_ingested = datetime.datetime(2024, 2, 29, 23, 30)
+    bb_process.bb_state.record_stream_state(LOC_ID, 'spotter', last_ingested, 'qc-limits',
+                                            qc_time_interval=1800.0)
+    stream_state = bb_process.bb_state.get_stream_state(LOC_ID)
+    assert stream_state['last_ingested'] == last_ingested
+    assert stream_state['qc_time_interval'] == 1800.0
@@ -0,0 +1,68 @@
+import numpy as np
+
+import backyardbuoys_processdata as bb_process
+
+
+def _var_data(timestamps, values, depths, platform='SPOT-00001'):
+    npts = len(timestamps)
+    return {'units': '',
+            'data': {'timestamp': list(timestamps),
+                     'value': list(values),
+                     'lat': [47.9]*npts,
+                     'lon': [-124.6]*npts,
+                     'depth': list(depths),
+                     'platform_id': [platform]*npts}}
+
+
+def test_smart_mooring_keeps_each_depth():
+    # Two smart mooring variables, each measured at two depths at
+    # the same three times, along with a surface variable
+    times = [1704067200, 1704069000, 1704070800]
+    smart_times = np.repeat(times, 2)
+    smart_depths = np.tile([-5.0, -10.0], 3)
+    api_data = {'WaterTemp': _var_data(list(times) + list(smart_times),
+                                       [10.0, 11.0, 12.0] + list(smart_depths*100 + smart_times % 7),
+                                       [0.0]*3 + list(smart_depths)),
+                'Pressure': _var_data(smart_times, list(-smart_depths + smart_times % 5),
+                                      smart_depths)}
+
+    total_data, smart_data = bb_process.pivot_observations(api_data)
+
+    assert len(total_data) == 3
+    np.testing.assert_array_equal(total_data['WaterTemp'], [10.0, 11.0, 12.0])
+    assert 'Pressure' not in total_data.columns
+
+    assert len(smart_data) == 6
+    np.testing.assert_array_equal(smart_data['timestamp'], smart_times)
+    np.testing.assert_array_equal(smart_data['depth'], smart_depths)
+    np.testing.assert_array_equal(smart_data['WaterTemp'], smart_depths*100 + smart_times % 7)
+    np.testing.assert_array_equal(smart_data['Pressure'], -smart_depths + smart_times % 5)
+
+
+def test_columns_follow_the_first_variable():
+    times = [1704067200, 1704069000]
+    api_data = {'WaveHeightSig': _var_data(times, [1.0, 2.0], [0.0, 0.0]),
+                'WaterTemp': _var_data(times, [10.0, 11.0], [0.0, 0.0])}
+
+    total_data, smart_data = bb_process.pivot_observations(api_data)
+
+    assert smart_data is None
+    assert list(total_data.columns) == ['timestamp', 'WaveHeightSig', 'lat', 'lon', 'depth',
+                                        'platform_id', 'WaterTemp', 'time']
+
+
+def test_last_record_of_each_key_is_kept(capsys):
+    # Both variables have two records for the second time, and
+    # the second variable has a time that the first does not
+    times = [1704067200, 1704069000, 1704069000]
+    api_data = {'WaveHeightSig': _var_data(times, [1.0, 2.0, 2.5], [0.0]*3),
+                'WaterTemp': _var_data(times + [1704070800], [10.0, 11.0, 11.5, 12.0], [0.0]*4)}
+    api_data['WaveHeightSig']['data']['lat'] = [47.9, 47.9, 48.0]
+
+    total_data, _ = bb_process.pivot_observations(api_data)
+
+    np.testing.assert_array_equal(total_data['timestamp'], [1704067200, 1704069000, 1704070800])
+    np.testing.assert_array_equal(total_data['WaveHeightSig'], [1.0, 2.5, np.nan])
+    np.testing.assert_array_equal(total_data['WaterTemp'], [10.0, 11.5, 12.0])
+    np.testing.assert_array_equal(total_data['lat'], [47.9, 48.0, 47.9])
+    assert 'Some mismatched for WaterTemp: 1 points' in capsys.readouterr().out
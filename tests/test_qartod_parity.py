@@ -0,0 +1,204 @@
+import contextlib
+import io
+import warnings
+
+import numpy as np
+import pytest
+
+import backyardbuoys_benchmarks as bb_bench
+import backyardbuoys_qcflags as bb_flags
+import backyardbuoys_qualitycontrol as bb_qc
+
+qartod = pytest.importorskip('ioos_qc.qartod')
+
+
+# Each QARTOD test, as run through ioos_qc and through the native engine
+QARTOD_TEST_PAIRS = {
+    'gross_range_test':
+        (lambda values, times, seconds: qartod.gross_range_test(values, fail_span=[-5, 5],
+                                                                suspect_span=[-1, 2]),
+         lambda values, times, seconds: bb_qc.native_gross_range_test(values, fail_span=[-5, 5],
+                                                                      suspect_span=[-1, 2])),
+    'spike_test':
+        (lambda values, times, seconds: qartod.spike_test(values, suspect_threshold=1,
+                                                          fail_threshold=3),
+         lambda values, times, seconds: bb_qc.native_spike_test(values, suspect_threshold=1,
+                                                                fail_threshold=3)),
+    'rate_of_change_test':
+        (lambda values, times, seconds: qartod.rate_of_change_test(values, times,
+                                                                   threshold=1/1800),
+         lambda values, times, seconds: bb_qc.native_rate_of_change_test(values, seconds,
+                                                                         threshold=1/1800)),
+    'flat_line_test':
+        (lambda values, times, seconds: qartod.flat_line_test(values, times,
+                                                              suspect_threshold=3*1800,
+                                                              fail_threshold=6*1800,
+                                                              tolerance=0.05),
+         lambda values, times, seconds: bb_qc.native_flat_line_test(values, seconds,
+                                                                    suspect_threshold=3*1800,
+                                                                    fail_threshold=6*1800,
+                                                                    tolerance=0.05)),
+}
+
+
+def _run_test(test, values, times, seconds):
+    # Flags of a test (filled, for the ioos_qc masked arrays),
+    # or None if the test rejects its input
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return np.ma.filled(test(values, times, seconds))
+    except ValueError:
+        return None
+
+
+def _random_series(rng):
+    # A short random series, with missing and non-finite values, flat
+    # lines, -555 fill values, and uneven (including repeated) time steps
+    npts = int(rng.choice([1, 2, 3, 4, 5, 10, 50, 300]))
+    values = np.resize(rng.choice([rng.normal(0, 3, npts),
+                                   np.round(rng.normal(0, 1, npts), 1),
+                                   np.repeat(rng.normal(0, 1, npts), 5)[:npts]]), npts)
+    bad = rng.random(npts)
+    values[bad < 0.08] = np.nan
+    values[(bad > 0.08) & (bad < 0.1)] = np.inf
+    values[(bad > 0.1) & (bad < 0.11)] = -np.inf
+    values[(bad > 0.11) & (bad < 0.12)] = -555
+    seconds = 1704067200 + np.cumsum(rng.choice([1800, 1800, 1800, 900, 0, 3600, 1801], npts))
+
+    return values, seconds.astype('datetime64[s]'), seconds
+
+
+@pytest.mark.parametrize('test_name', list(QARTOD_TEST_PAIRS.keys()))
+def test_native_test_matches_ioos_qc(test_name):
+    ioos_test, native_test = QARTOD_TEST_PAIRS[test_name]
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        values, times, seconds = _random_series(rng)
+        ioos_flags = _run_test(ioos_test, values, times, seconds)
+        native_flags = _run_test(native_test, values, times, seconds)
+        if (ioos_flags is None) or (native_flags is None):
+            assert (ioos_flags is None) and (native_flags is None)
+        else:
+            np.testing.assert_array_equal(ioos_flags, native_flags)
+
+
+def _process_qartod_tests(qc_data, qc_limits, engine):
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return bb_qc.process_qartod_tests(qc_data, qc_data.columns, qc_limits,
+                                          engine=engine, workers=1)
+
+
+def _assert_engines_match(qc_data, qc_limits):
+    ioos_flags = _process_qartod_tests(qc_data, qc_limits, 'ioos_qc')
+    native_flags = _process_qartod_tests(qc_data, qc_limits, 'native')
+
+    assert list(ioos_flags.columns) == list(native_flags.columns)
+    for col in ioos_flags.columns:
+        assert ioos_flags[col].dtype == native_flags[col].dtype
+        np.testing.assert_array_equal(np.ma.filled(ioos_flags[col].to_numpy()),
+                                      native_flags[col].to_numpy(), err_msg=col)
+
+
+def test_engines_match_on_all_sensors():
+    # The synthetic record has gaps, repeated time stamps, missing
+    # values, spikes, flat lines, and wrapped directions
+    qc_data, qc_limits = bb_bench.make_synthetic_qc_data(ndays=20)
+
+    assert any('from_direction' in sensor for sensor in qc_data.columns)
+    assert (np.diff(qc_data['time'].to_numpy()) == np.timedelta64(0)).any()
+    _assert_engines_match(qc_data, qc_limits)
+
+
+def test_engines_match_with_fill_values():
+    qc_data, qc_limits = bb_bench.make_synthetic_qc_data(ndays=10, seed=1)
+    qc_data.loc[::17, 'sea_surface_wave_significant_height'] = -555
+    qc_data.loc[::23, 'sea_surface_wave_from_direction'] = -555
+
+    _assert_engines_match(qc_data, qc_limits)
+
+
+@pytest.mark.parametrize('missing', [np.nan, -555])
+def test_engines_match_on_all_missing_sensor(missing):
+    qc_data, qc_limits = bb_bench.make_synthetic_qc_data(ndays=5, seed=2)
+    qc_data['sea_water_temperature'] = missing
+    qc_data['sea_surface_wave_from_direction'] = missing
+
+    _assert_engines_match(qc_data, qc_limits)
+
+    flags = _process_qartod_tests(qc_data, qc_limits, 'native')
+    assert (flags['sea_water_temperature_qc_agg'] == 4).all()
+    assert (flags['sea_surface_wave_from_direction_qartod_spike_test'] == 9).all()
+
+
+def test_worker_processes_match_single_process():
+    qc_data, qc_limits = bb_bench.make_synthetic_qc_data(ndays=5, seed=3)
+
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        single_flags = bb_qc.process_qartod_tests(qc_data, qc_data.columns, qc_limits,
+                                                  engine='native', workers=1)
+        worker_flags = bb_qc.process_qartod_tests(qc_data, qc_data.columns, qc_limits,
+                                                  engine='native', workers=2)
+
+    np.testing.assert_array_equal(single_flags.columns, worker_flags.columns)
+    for col in single_flags.columns:
+        np.testing.assert_array_equal(single_flags[col], worker_flags[col], err_msg=col)
+
+
+def test_unwrap_direction_skips_missing_directions():
+    # A missing direction does not make the later directions missing
+    directions = np.array([350, 10, np.nan, 30, np.inf, 340])
+    np.testing.assert_array_equal(bb_qc.unwrap_direction(directions),
+                                  [350, 370, np.nan, 390, np.inf, 340])
+
+
+@pytest.mark.parametrize('engine', ['ioos_qc', 'native'])
+def test_direction_flags_against_whole_series_unwrap(engine, monkeypatch):
+    # Pin the flags of the unwrapped directions against those from
+    # unwrapping the whole series with np.unwrap (as before missing
+    # directions were skipped when unwrapping)
+    qc_data, qc_limits = bb_bench.make_synthetic_qc_data(ndays=10, seed=4)
+    direction_cols = [sensor for sensor in qc_data.columns if 'from_direction' in sensor]
+    qc_data[direction_cols] = qc_data[direction_cols].fillna(0.5)
+    unwrapped_tests = ['spike_test', 'rate_of_change_test', 'flat_line_test']
+
+    def whole_series_unwrap(values):
+        return np.unwrap(values, period=360)
+    whole_series_transforms = {'from_direction': {test: whole_series_unwrap
+                                                  for test in unwrapped_tests}}
+
+    def process(qc_data, transforms):
+        monkeypatch.setattr(bb_qc, 'QARTOD_TEST_TRANSFORMS', transforms)
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return bb_qc.process_qartod_tests(qc_data, qc_data.columns, qc_limits,
+                                              engine=engine, workers=1)
+    transforms = bb_qc.QARTOD_TEST_TRANSFORMS
+
+    # With no missing directions, the flags are unchanged
+    complete_flags = process(qc_data, transforms)
+    baseline_flags = process(qc_data, whole_series_transforms)
+    for col in complete_flags.columns:
+        np.testing.assert_array_equal(complete_flags[col], baseline_flags[col], err_msg=col)
+
+    # With a missing direction, the flags before it are unchanged. After
+    # it, the whole-series unwrap flagged every direction as missing;
+    # now they are flagged as without the missing direction (away from
+    # the observations whose tests look back over it)
+    gap = 100
+    after_gap = gap + bb_qc.qartod_lookback(qc_limits, 1800) + 2
+    qc_data.loc[gap, direction_cols] = np.nan
+    new_flags = process(qc_data, transforms)
+    baseline_flags = process(qc_data, whole_series_transforms)
+    for sensor in direction_cols:
+        for test in unwrapped_tests:
+            col = sensor + '_qartod_' + test
+            np.testing.assert_array_equal(new_flags[col][:gap], baseline_flags[col][:gap], err_msg=col)
+            assert (baseline_flags[col][gap:] == bb_flags.QARTOD_MISSING).all()
+            assert new_flags[col][gap] == bb_flags.QARTOD_MISSING
+            np.testing.assert_array_equal(new_flags[col][after_gap:],
+                                          complete_flags[col][after_gap:], err_msg=col)
+        col = sensor + '_qartod_gross_range_test'
+        np.testing.assert_array_equal(new_flags[col], baseline_flags[col], err_msg=col)
@@ -0,0 +1,104 @@
+import contextlib
+import datetime
+import io
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import backyardbuoys_benchmarks as bb_bench
+import backyardbuoys_processdata as bb_process
+
+LOC_ID = 'synthetic'
+PLATFORM = 'SPOT-00001'
+REBUILD_PERIOD = [datetime.datetime(2024, 1, 1), datetime.datetime(2024, 3, 1)]
+
+
+def _quiet(func, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return func(*args, **kwargs)
+
+
+@pytest.fixture
+def rebuild_run(tmp_path, monkeypatch):
+    # A location rebuilt over two months of data, sampled half-hourly
+    # in the first month and every ten minutes in the second, where
+    # the data are served from memory, and the datasets written are
+    # kept rather than written to netCDF files
+
+    metadir = tmp_path / LOC_ID / 'metadata'
+    metadir.mkdir(parents=True)
+    (metadir / (LOC_ID + '_metadata.json')).write_text('{}')
+    (metadir / (LOC_ID + '_info.json')).write_text(json.dumps(
+        {'spotter_ids': PLATFORM,
+         'spotter_data': {PLATFORM: {'can_data_archive': 'yes', 'can_share_ndbc_nws': 'yes'}},
+         'loc_history': {'2024-01-01T00:00:00Z': {'lat_s': 47.0, 'lat_n': 48.5, 'lon_w': -125.0,
+                                                  'lon_e': -124.0, 'status': 'active'}}}))
+
+    api_data = bb_bench.make_synthetic_api_data(60*144*len(bb_bench.SURFACE_VARS), platforms=(PLATFORM,),
+                                                smartflag=False, time_step=600)
+    feb_start = datetime.datetime(2024, 2, 1, tzinfo=datetime.timezone.utc).timestamp()
+    for var_info in api_data.values():
+        timestamps = np.asarray(var_info['data']['timestamp'])
+        keep = (timestamps >= feb_start) | (timestamps % 1800 == 0)
+        var_info['data'] = {key: np.asarray(val)[keep] for key, val in var_info['data'].items()}
+
+    def platform_data(platform_id, vars_to_get='ALL', time_start=None, time_end=None):
+        time_start = pd.Timestamp(time_start).timestamp() if time_start is not None else -np.inf
+        time_end = pd.Timestamp(time_end).timestamp() if time_end is not None else np.inf
+        pulled = {}
+        for varname, var_info in api_data.items():
+            keep = ((var_info['data']['timestamp'] >= time_start) &
+                    (var_info['data']['timestamp'] <= time_end))
+            pulled[varname] = {'units': '', 'data': {key: val[keep] for key, val in var_info['data'].items()}}
+        return pulled
+
+    # Limits under which a fair share of the (uniformly random)
+    # values are flagged by each test
+    qc_limits = {varname: {'qartod': {'gross_range_test': {'suspect_span': [0.05, 0.95],
+                                                           'fail_span': [0.01, 0.99]},
+                                      'spike_test': {'suspect_threshold': 0.5, 'fail_threshold': 0.8},
+                                      'rate_of_change_test': {'threshold': 0.0004},
+                                      'flat_line_test': {'tolerance': 0.3, 'suspect_threshold': 3600,
+                                                         'fail_threshold': 7200}}}
+                 for varname in bb_process.bb_qc.QC_VARIABLES}
+
+    monkeypatch.setattr(bb_process.bb, 'get_datadir', lambda: str(tmp_path))
+    monkeypatch.setattr(bb_process.bb_meta, 'make_location_info_json', lambda *args, **kwargs: True)
+    monkeypatch.setattr(bb_process.bb_da, 'bbapi_get_platform_data', platform_data)
+    monkeypatch.setattr(bb_process, 'get_buoy_qc_limits', lambda ds, loc_id, smartflag=False: qc_limits)
+
+    written = []
+
+    def kept_netcdf_by_month(ds, loc_id, smart_vars=None, force=False):
+        written.append(ds)
+        return [True]
+    monkeypatch.setattr(bb_process, 'write_netcdf_by_month', kept_netcdf_by_month)
+
+    def run(window_months, rerun_tests=False):
+        monkeypatch.setattr(bb_process, 'REBUILD_WINDOW_MONTHS', window_months)
+        written.clear()
+        assert _quiet(bb_process.update_data_by_location, LOC_ID, rebuild_flag=True,
+                      rerun_tests=rerun_tests, rebuild_period=REBUILD_PERIOD)
+        return xr.concat(written, dim='time')
+
+    return run
+
+
+@pytest.mark.parametrize('rerun_tests', [False, True])
+def test_windowed_rebuild_matches_whole_rebuild(rebuild_run, rerun_tests):
+    ds_whole = rebuild_run(None, rerun_tests)
+    ds_windowed = rebuild_run(1, rerun_tests)
+
+    # The flags of each window are those of the whole record, although
+    # the time step of the first month differs from that of the record
+    assert ds_windowed.sizes['time'] == ds_whole.sizes['time']
+    flag_vars = [varname for varname in ds_whole.keys() if '_qc_' in varname]
+    assert len(flag_vars) > 0
+    for varname in flag_vars:
+        np.testing.assert_array_equal(ds_windowed[varname].to_numpy(),
+                                      ds_whole[varname].to_numpy(), err_msg=varname)